@@ -29,10 +29,9 @@ D_in = np.random.uniform(low=0, high=1e-3, size=shape)
 Dp_in = np.random.uniform(low=0, high=1e-1, size=shape)
 S0 = 1000  # Setting a constant S0 for simplicity
 bvals = np.array([0, 50, 100, 500, 1000])
-bvals_reshaped = np.broadcast_to(bvals, shape)
 
-# Generate IVIM signal
-signals = gd.ivim_signal(D_in, Dp_in, f_in, S0, bvals_reshaped)
+# Generate IVIM signal, of shape (10, 10, 5, number of b-values)
+signals = gd.ivim_signal(D_in, Dp_in, f_in, S0, bvals)
 
 # Save the generated image as a NIfTI file
 save_nifti_file(signals, "ivim_simulation.nii.gz")
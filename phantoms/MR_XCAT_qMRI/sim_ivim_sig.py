@@ -1,10 +1,9 @@
 import numpy as np
-from scipy.io import loadmat
 import nibabel as nib
 import json
 import argparse
 import os
-from utilities.data_simulation.Download_data import download_data
+from utilities.data_simulation.Download_data import download_data, load_mat_variable
 import pathlib
 
 ##########
@@ -13,24 +12,17 @@ import pathlib
 # This code generates a 4D IVIM phantom as nifti file
 
 def phantom(bvalue, noise, TR=3000, TE=40, motion=False, rician=False, interleaved=False,T1T2=True):
-    download_data()
+    data_folder = download_data()
     np.random.seed(42)
     if motion:
         states = range(1,21)
     else:
         states = [1]
+    D, f, Ds = contrast_curve_calc()
+    # With motion, the respiratory states are processed one at a time, and each only contributes the (slice, b-value)
+    # pairs that motion_schedule assigns to it, so only one state is held in memory besides the output.
     for state in states:
-        # Load the .mat file
-        project_root = pathlib.Path(__file__).resolve().parent.parent
-        filename = f'XCAT5D_RP_{state}_CP_1.mat'
-        mat_path = project_root / '..' /'download' / 'Phantoms' / 'XCAT_MAT_RESP' / filename
-        mat_data = loadmat(mat_path)
-
-        # Access the variables in the loaded .mat file
-        XCAT = mat_data['IMG']
-        XCAT = XCAT[-1:0:-2,-1:0:-2,10:160:4]
-
-        D, f, Ds = contrast_curve_calc()
+        XCAT = load_XCAT_state(state, data_folder)
         S, Dim, fim, Dpim, legend = XCAT_to_MR_IVIM(XCAT, TR, TE, bvalue, D, f, Ds,T1T2=T1T2)
         if state == 1:
             Dim_out = Dim
@@ -41,47 +33,43 @@ def phantom(bvalue, noise, TR=3000, TE=40, motion=False, rician=False, interleav
             S = np.abs(S + np.random.normal(loc=0, scale = noise, size = np.shape(S)) + 1j * np.random.normal(loc=0, scale = noise, size = np.shape(S)))
         else:
             S = S + np.random.normal(loc=0, scale = noise, size = np.shape(S))
-        try:
-            totsig=np.append(totsig,np.expand_dims(S, 4), axis=4)
-        except:
-            totsig = np.expand_dims(S, 4)
-    if motion:
-        state = 0
-        state2 = 0
-        slices_per_resp_phase = round(np.shape(XCAT)[2]/20*6000/TR)
-        for b in range(np.shape(totsig)[3]):
-            if not interleaved:
-                for a in range(np.shape(totsig)[2]):
-                    S[:,:,a,b]=totsig[:,:,a,b,state]
-                    if state2 == slices_per_resp_phase:
-                        state2 = 0
-                        state = state + 1
-                        if state == 20:
-                            state = 0
-                    else:
-                        state2 = state2+1
-            else:
-                for a in range(0,np.shape(totsig)[2],2):
-                    S[:,:,a,b]=totsig[:,:,a,b,state]
-                    if state2 == slices_per_resp_phase:
-                        state2 = 0
-                        state = state + 1
-                        if state == 20:
-                            state = 0
-                    else:
-                        state2 = state2+1
-                for a in range(1,np.shape(totsig)[2],2):
-                    S[:,:,a,b]=totsig[:,:,a,b,state]
-                    if state2 == slices_per_resp_phase:
-                        state2 = 0
-                        state = state + 1
-                        if state == 20:
-                            state = 0
-                    else:
-                        state2 = state2+1
+        if not motion:
+            return np.squeeze(S), XCAT, Dim_out, fim_out, Dpim_out, legend
+        if state == 1:
+            slices_per_resp_phase = round(np.shape(XCAT)[2]/20*6000/TR)
+            schedule = motion_schedule(np.shape(S)[2], np.shape(S)[3], slices_per_resp_phase, interleaved, len(states))
+            S_out = np.empty_like(S)
+        slices, bvalues = np.nonzero(schedule == state - 1)
+        S_out[:, :, slices, bvalues] = S[:, :, slices, bvalues]
+    return S_out, XCAT, Dim_out, fim_out, Dpim_out, legend
+
+
+def load_XCAT_state(state, data_folder):
+    # Load the label volume of a respiratory state and crop it as the phantom uses it. The .mat file is decoded once
+    # into a memory-mapped .npy cache, from which only the cropped voxels are read.
+    filename = f'XCAT5D_RP_{state}_CP_1.mat'
+    mat_path = pathlib.Path(data_folder) / 'Phantoms' / 'XCAT_MAT_RESP' / filename
+    XCAT = load_mat_variable(mat_path, 'IMG', data_folder)
+    return np.array(XCAT[-1:0:-2,-1:0:-2,10:160:4])
+
+
+def motion_schedule(n_slices, n_bvalues, slices_per_resp_phase, interleaved=False, n_states=20):
+    """
+    Respiratory state (0 to n_states - 1) that each (slice, b-value) of the motion phantom is acquired in. Slices are
+    acquired per b-value, in order or (interleaved) first the even and then the odd slices, and the respiratory
+    state advances after every slices_per_resp_phase + 1 slices, cycling through the states.
+
+    Returns:
+        schedule: integer array of shape (n_slices, n_bvalues)
+    """
+    schedule = np.empty((n_slices, n_bvalues), dtype=int)
+    if interleaved:
+        order = list(range(0, n_slices, 2)) + list(range(1, n_slices, 2))
     else:
-        S=np.squeeze(totsig)
-    return S, XCAT, Dim_out, fim_out, Dpim_out, legend
+        order = list(range(n_slices))
+    acquisition = np.arange(n_slices * n_bvalues)
+    schedule[np.tile(order, n_bvalues), np.repeat(np.arange(n_bvalues), n_slices)] = (acquisition // (slices_per_resp_phase + 1)) % n_states
+    return schedule
 
 
 def ivim(bvalues,D,f,Ds):
@@ -192,7 +180,7 @@ def contrast_curve_calc():
     return D, f, Ds
 
 
-def XCAT_to_MR_IVIM(XCAT, TR, TE, bvalue, D, f, Ds, b0=3, ivim_cont = True, T1T2=True):
+def XCAT_to_MR_IVIM(XCAT, TR, TE, bvalue, D, f, Ds, b0=3, ivim_cont = True, T1T2=True, dtype=np.float64, out=None):
     ###########################################################################################
     # This script converts XCAT tissue values to MR contrast based on the SSFP signal equation.
     # Christopher W. Roy 2018-12-04 # fetal.xcmr@gmail.com
@@ -356,10 +344,10 @@ def XCAT_to_MR_IVIM(XCAT, TR, TE, bvalue, D, f, Ds, b0=3, ivim_cont = True, T1T2
     # Tissue[72, :] = [312.4, 117.4, 377, 97.5]
     Tissue[72, :] = [9999999999, 0.00000001, 999999999, 0.00000001] ## fat suppression
     Tissue[73, :] = [0, 0, 1676, 64]
-    Dim= np.zeros(XCAT.shape, dtype=np.float32)
-    fim= np.zeros(XCAT.shape, dtype=np.float32)
-    Dpim= np.zeros(XCAT.shape, dtype=np.float32)
-    MR = np.zeros(XCAT.shape+(len(bvalue),), dtype=np.float32)
+    # Look-up tables with the signal and IVIM parameters of every tissue label; row 0 (background) stays zero.
+    # The images are then a single gather of the tables on the label volume, instead of a masked sum per tissue.
+    MR_lut = np.zeros((len(Tissue), len(bvalue)))
+    param_lut = np.zeros((len(Tissue), 3))  # D, f, Dp
     for iTissue in range(len(Tissue)):
         if iTissue != 0:
             if b0 == 1.5:
@@ -380,14 +368,26 @@ def XCAT_to_MR_IVIM(XCAT, TR, TE, bvalue, D, f, Ds, b0=3, ivim_cont = True, T1T2
             S0 = ivim(bvalue,Dtemp,ftemp,Dstemp)
             if T1T2:
                 if T1 > 0 or T2 > 0:
-                    MR = MR + np.tile(np.expand_dims(XCAT == iTissue,3),len(S0)) * S0 * (1 - 2 * np.exp(-(TR - TE / 2) / T1) + np.exp(-TR / T1)) * np.exp(-TE / T2)
+                    MR_lut[iTissue] = S0 * (1 - 2 * np.exp(-(TR - TE / 2) / T1) + np.exp(-TR / T1)) * np.exp(-TE / T2)
             else:
-                MR = MR + np.tile(np.expand_dims(XCAT == iTissue,3),len(S0)) * S0
-            Dim = Dim + (XCAT == iTissue) * Dtemp
-            fim = fim + (XCAT == iTissue) * ftemp
-            Dpim = Dpim + (XCAT == iTissue) * Dstemp
+                MR_lut[iTissue] = S0
+            param_lut[iTissue] = [np.squeeze(Dtemp), np.squeeze(ftemp), np.squeeze(Dstemp)]
+    labels = tissue_labels(XCAT, len(Tissue))
+    MR = np.take(MR_lut.astype(dtype), labels, axis=0, out=out)
+    Dim, fim, Dpim = np.moveaxis(np.take(param_lut.astype(dtype), labels, axis=0), -1, 0)
     return MR, Dim, fim, Dpim, legend
 
+
+def tissue_labels(XCAT, n_tissues):
+    """
+    Converts the XCAT label volume to indices into the tissue look-up tables; labels that are not a whole number
+    in [0, n_tissues) map to the background row 0, as they match no tissue
+    """
+    labels = np.asarray(XCAT)
+    if not np.issubdtype(labels.dtype, np.integer):
+        labels = np.where(labels == np.floor(labels), labels, 0)
+    return np.where((labels >= 0) & (labels < n_tissues), labels, 0).astype(np.intp)
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description=f"""
     A commandline for generating a 4D IVIM phantom as nifti file
@@ -23,13 +23,13 @@ def simulate_brain_phantom(regime=DIFFUSIVE_REGIME, snr=100, sim_relaxation=True
     TR: repetition time in seconds
     resolution: voxel size in mm
     '''
-    download_data()
+    data_folder = download_data()
 
 
     folder = os.path.dirname(__file__)
 
     # Ground truth
-    nii = nib.load(os.path.join(os.path.split(os.path.split(folder)[0])[0],'download','Phantoms','brain','ground_truth','hrgt_icbm_2009a_nls_3t.nii.gz'))
+    nii = nib.load(os.path.join(data_folder,'Phantoms','brain','ground_truth','hrgt_icbm_2009a_nls_3t.nii.gz'))
     segmentation = np.squeeze(nii.get_fdata()[...,-1])
 
     with open(os.path.join(folder,'ground_truth',regime+'_groundtruth.json'), 'r') as f:
@@ -26,6 +26,7 @@ Requirements:
 
 import numpy as np
 import warnings
+from utilities.ivim.ivim_models import weighted_linreg
 
 
 def _weighted_linreg(x, y, weights):
@@ -41,12 +42,31 @@ def _weighted_linreg(x, y, weights):
     Returns:
         (intercept, slope) tuple.
     """
-    W = np.diag(weights)
-    X = np.column_stack([np.ones_like(x), x])
-    # Weighted normal equations: (X^T W X) beta = X^T W y
-    XtW = X.T @ W
-    beta = np.linalg.solve(XtW @ X, XtW @ y)
-    return beta[0], beta[1]  # intercept, slope
+    intercept, slope = weighted_linreg(x, y[np.newaxis, :], weights[np.newaxis, :])
+    if not (np.isfinite(intercept[0]) and np.isfinite(slope[0])):
+        raise np.linalg.LinAlgError("Singular matrix")
+    return intercept[0], slope[0]  # intercept, slope
+
+
+def _wls_monoexp_array(b, S, engine=None):
+    """Weighted log-linear fit of S = A * exp(-b * k) with Veraart weights S^2.
+
+    Args:
+        b: 1D array (n_obs) of b-values.
+        S: 2D array (n_voxels x n_obs) of positive signals.
+        engine: None for the closed-form regression of this module, or the
+            engine ("auto", "numba" or "numpy") of the compiled kernel in
+            utilities.ivim.kernels.
+
+    Returns:
+        (log A, k) tuple of 1D arrays (n_voxels).
+    """
+    if engine is None:
+        return weighted_linreg(-b, np.log(S), S ** 2)
+    from utilities.ivim.kernels import fit_monoexp_wls
+    k, A = fit_monoexp_wls(b, S, engine=engine).T
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.log(A), k
 
 
 def _rlm_linreg(x, y):
@@ -69,6 +89,68 @@ def _rlm_linreg(x, y):
     return result.params[0], result.params[1]  # intercept, slope
 
 
+def _rlm_linreg_array(x, Y, t=1.345, max_iter=50, tol=1e-8):
+    """Robust linear regression y = a + b*x with Huber's T norm for many voxels.
+
+    Vectorized IRLS that follows the defaults of statsmodels' RLM: OLS start,
+    MAD scale estimate (re-estimated every iteration), Huber weights
+    w = min(1, t/|r/scale|) and convergence on the change in deviance. Each
+    voxel stops iterating as soon as it has converged.
+
+    Args:
+        x: 1D array (n_obs), independent variable shared by all voxels.
+        Y: 2D array (n_voxels x n_obs), dependent variable.
+        t: Huber tuning constant. Default: 1.345.
+        max_iter: Maximum number of iterations (including the OLS start).
+        tol: Convergence tolerance on the deviance.
+
+    Returns:
+        (intercept, slope, n_iter) tuple of 1D arrays (n_voxels).
+    """
+    n_voxels, n_obs = Y.shape
+    df_resid = n_obs - 2
+
+    def mad_scale(resid):
+        return np.median(np.abs(resid), axis=-1) / 0.6744897501960817
+
+    def deviance(resid, W):
+        # statsmodels scales the residuals with the weighted residual variance
+        with np.errstate(divide='ignore', invalid='ignore'):
+            wls_scale = np.sum(W * resid ** 2, axis=-1) / df_resid
+            z = np.abs(resid / wls_scale[:, np.newaxis])
+        rho = np.where(z <= t, 0.5 * z ** 2, z * t - 0.5 * t ** 2)
+        return np.sum(rho, axis=-1)
+
+    W = np.ones_like(Y)
+    intercept, slope = weighted_linreg(x, Y, W)
+    resid = Y - intercept[:, np.newaxis] - slope[:, np.newaxis] * x
+    scale = mad_scale(resid)
+    dev = deviance(resid, W)
+    n_iter = np.ones(n_voxels, dtype=int)
+
+    active = np.isfinite(dev)
+    for iteration in range(2, max_iter + 1):
+        active &= scale > 0
+        if not np.any(active):
+            break
+        idx = np.flatnonzero(active)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            z = np.abs(resid[idx] / scale[idx, np.newaxis])
+        W = np.where(z <= t, 1.0, t / z)
+        a, b = weighted_linreg(x, Y[idx], W)
+        r = Y[idx] - a[:, np.newaxis] - b[:, np.newaxis] * x
+        new_dev = deviance(r, W)
+
+        intercept[idx], slope[idx], resid[idx] = a, b, r
+        scale[idx] = mad_scale(r)
+        n_iter[idx] = iteration
+        converged = ~(np.abs(new_dev - dev[idx]) > tol)
+        dev[idx] = new_dev
+        active[idx[converged]] = False
+
+    return intercept, slope, n_iter
+
+
 def wls_ivim_fit(bvalues, signal, cutoff=200, method="WLS"):
     """
     IVIM fit using WLS or RLM (segmented approach).
@@ -168,3 +250,96 @@ def wls_ivim_fit(bvalues, signal, cutoff=200, method="WLS"):
     except Exception:
         # If fit fails, return zeros (consistent with other algorithms)
         return 0.0, 0.0, 0.0
+
+
+def wls_ivim_fit_array(bvalues, signals, cutoff=200, method="WLS", engine=None):
+    """
+    IVIM fit using WLS or RLM (segmented approach) on many voxels at once.
+
+    Vectorized counterpart of :func:`wls_ivim_fit`: all voxels are fitted
+    simultaneously with the closed-form weighted regression (WLS) or the
+    batched IRLS (RLM).
+
+    Args:
+        bvalues (array-like): 1D array of b-values (s/mm²).
+        signals (array-like): 2D array (n_voxels x n_bvalues) of signal
+            intensities (will be normalized).
+        cutoff (float): b-value threshold separating D from D* fitting.
+                        Default: 200 s/mm².
+        method (str): Regression method to use, "WLS" (default) or "RLM".
+        engine (str, optional): Run the WLS regressions in the compiled
+            kernel of utilities.ivim.kernels with this engine ("auto",
+            "numba" or "numpy"). Only for method="WLS".
+
+    Returns:
+        tuple: (D, f, Dp) 1D arrays (n_voxels). Voxels that cannot be
+            fitted (no positive S(b=0), non-finite signal or a singular
+            regression) are returned as zeros.
+    """
+    method = method.upper()
+    if method not in ("WLS", "RLM"):
+        raise ValueError(f"Unknown method '{method}'. Use 'WLS' or 'RLM'.")
+    if engine is not None and method != "WLS":
+        raise ValueError("The kernel engine only supports method 'WLS'.")
+
+    bvalues = np.array(bvalues, dtype=float)
+    signals = np.atleast_2d(np.array(signals, dtype=float))
+    n_voxels = signals.shape[0]
+
+    D_out = np.zeros(n_voxels)
+    f_out = np.zeros(n_voxels)
+    Dp_out = np.zeros(n_voxels)
+
+    # Normalize signal to S(b=0)
+    if not np.any(bvalues == 0):
+        return D_out, f_out, Dp_out
+    with np.errstate(invalid='ignore'):
+        s0 = np.mean(signals[:, bvalues == 0], axis=1)
+        valid = np.all(np.isfinite(signals), axis=1) & (s0 > 0)
+    if not np.any(valid):
+        return D_out, f_out, Dp_out
+    signal = signals[valid] / s0[valid, np.newaxis]
+
+    # ── Step 1: Estimate D from high b-values ─────────────────────
+    high_mask = bvalues >= cutoff
+    b_high = bvalues[high_mask]
+    s_high = np.maximum(signal[:, high_mask], 1e-8)
+
+    if method == "WLS":
+        intercept, D = _wls_monoexp_array(b_high, s_high, engine)
+    else:
+        intercept, D, _ = _rlm_linreg_array(-b_high, np.log(s_high))
+
+    f = 1.0 - np.exp(intercept)
+    D = np.clip(D, 0, 0.005)
+    f = np.clip(f, 0, 1)
+
+    # ── Step 2: Estimate D* from low b-value residuals ────────────
+    residual = signal - (1 - f)[:, np.newaxis] * np.exp(-np.outer(D, bvalues))
+
+    low_mask = (bvalues < cutoff) & (bvalues > 0)
+    b_low = bvalues[low_mask]
+    r_low = np.maximum(residual[:, low_mask], 1e-8)
+
+    if len(b_low) >= 2:
+        if method == "WLS":
+            _, Dp = _wls_monoexp_array(b_low, r_low, engine)
+        else:
+            _, Dp, _ = _rlm_linreg_array(-b_low, np.log(r_low))
+        Dp = np.clip(Dp, 0.005, 0.2)
+    else:
+        Dp = np.full(D.shape, 0.01)  # fallback
+
+    # Ensure D* > D (by convention)
+    swap = Dp < D
+    D, Dp = np.where(swap, Dp, D), np.where(swap, D, Dp)
+    f = np.where(swap, 1 - f, f)
+
+    # Failed regressions are returned as zeros, as in the single-voxel fit
+    fitted = np.isfinite(D) & np.isfinite(f) & np.isfinite(Dp)
+    valid_idx = np.flatnonzero(valid)[fitted]
+    D_out[valid_idx] = D[fitted]
+    f_out[valid_idx] = f[fitted]
+    Dp_out[valid_idx] = Dp[fitted]
+
+    return D_out, f_out, Dp_out
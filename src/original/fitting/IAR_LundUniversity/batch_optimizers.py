@@ -0,0 +1,293 @@
+"""
+Batched optimizers for fitting many voxels at once.
+
+The IAR fitting methods run SciPy optimizers voxel by voxel through the
+DIPY ``multi_voxel_fit`` decorator, so the Python overhead of every cost
+evaluation is paid once per voxel. The functions in this module run the same
+kind of searches for a whole batch of voxels simultaneously: every cost and
+Jacobian evaluation is a single array operation over all voxels (and, for the
+global search, over all candidates of every voxel's population).
+"""
+
+import numpy as np
+
+
+def differential_evolution_batch(cost, bounds, n_voxels, popsize=15, maxiter=1000,
+                                 mutation=(0.5, 1), recombination=0.7, tol=0.01,
+                                 atol=0, rng=None):
+    """
+    Batched differential evolution (``best1bin``) for independent voxels.
+
+    Every voxel evolves its own population, following the default strategy
+    of :func:`scipy.optimize.differential_evolution`: Latin hypercube
+    initialization, ``best1bin`` mutation with dithering, binomial crossover,
+    greedy selection and the population energy spread as convergence
+    criterion. The cost of all candidates of all voxels is evaluated in one
+    call per generation.
+
+    Parameters
+    ----------
+    cost : callable
+        ``cost(x)`` with ``x`` of shape (V, P, N) returning an array of shape
+        (V, P) with the cost of every candidate.
+    bounds : array-like, shape (N, 2)
+        Lower and upper bound of every parameter.
+    n_voxels : int
+        Number of voxels V.
+    popsize : int, optional
+        Multiplier for the population size, as in SciPy; the population has
+        ``popsize * N`` members.
+    maxiter : int, optional
+        Maximum number of generations.
+    mutation : float or tuple, optional
+        Mutation constant, or (min, max) for dithering per generation.
+    recombination : float, optional
+        Crossover probability.
+    tol, atol : float, optional
+        A voxel has converged when
+        ``std(energies) <= atol + tol * abs(mean(energies))``.
+    rng : numpy.random.Generator or int, optional
+        Random number generator or seed.
+
+    Returns
+    -------
+    x : np.ndarray, shape (V, N)
+        Best candidate of every voxel.
+    fun : np.ndarray, shape (V,)
+        Cost of the best candidate.
+    """
+    rng = np.random.default_rng(rng)
+    bounds = np.asarray(bounds, dtype=float)
+    lower, upper = bounds[:, 0], bounds[:, 1]
+    scale = upper - lower
+    n_params = bounds.shape[0]
+    n_pop = max(popsize * n_params, 5)
+    voxels = np.arange(n_voxels)[:, np.newaxis]
+    members = np.arange(n_pop)[np.newaxis, :]
+
+    # Latin hypercube initialization in the unit cube
+    segments = (np.arange(n_pop) + rng.random((n_voxels, n_params, n_pop))) / n_pop
+    population = np.swapaxes(rng.permuted(segments, axis=-1), 1, 2)
+    energies = cost(lower + population * scale)
+    energies = np.where(np.isfinite(energies), energies, np.inf)
+
+    converged = np.zeros(n_voxels, dtype=bool)
+    for _ in range(maxiter):
+        best = np.argmin(energies, axis=1)
+        finite = np.isfinite(energies)
+        spread = np.std(np.where(finite, energies, 0), axis=1)
+        level = np.abs(np.mean(np.where(finite, energies, 0), axis=1))
+        converged |= np.all(finite, axis=1) & (spread <= atol + tol * level)
+        if np.all(converged):
+            break
+
+        # best1bin: bprime = best + F * (r1 - r2), with r1 != r2 != member
+        r1 = rng.integers(0, n_pop - 1, size=(n_voxels, n_pop))
+        r1 += r1 >= members
+        r2 = rng.integers(0, n_pop - 2, size=(n_voxels, n_pop))
+        low, high = np.minimum(members, r1), np.maximum(members, r1)
+        r2 += r2 >= low
+        r2 += r2 >= high
+        if np.ndim(mutation) > 0:
+            F = rng.uniform(mutation[0], mutation[1], size=(n_voxels, 1, 1))
+        else:
+            F = mutation
+        bprime = population[voxels, best[:, np.newaxis]] + F * (population[voxels, r1] - population[voxels, r2])
+
+        crossover = rng.random((n_voxels, n_pop, n_params)) < recombination
+        fill_point = rng.integers(0, n_params, size=(n_voxels, n_pop))
+        crossover[voxels, members, fill_point] = True
+        trial = np.where(crossover, bprime, population)
+        # out-of-bounds entries are replaced by random positions, as in SciPy
+        outside = (trial < 0) | (trial > 1)
+        trial[outside] = rng.random(np.count_nonzero(outside))
+
+        trial_energies = cost(lower + trial * scale)
+        trial_energies = np.where(np.isfinite(trial_energies), trial_energies, np.inf)
+        improved = (trial_energies <= energies) & ~converged[:, np.newaxis]
+        population = np.where(improved[..., np.newaxis], trial, population)
+        energies = np.where(improved, trial_energies, energies)
+
+    best = np.argmin(energies, axis=1)
+    return lower + population[np.arange(n_voxels), best] * scale, energies[np.arange(n_voxels), best]
+
+
+def least_squares_batch(fun, jac, x0, bounds, max_iter=100, xtol=1e-8, ftol=1e-8):
+    """
+    Batched bound-constrained Levenberg-Marquardt for independent voxels.
+
+    Minimizes ``sum(fun(x)**2)`` for every voxel. Parameters that sit on a
+    bound with the gradient pointing outwards are held fixed for that step
+    (active set), the remaining step is clipped to the bounds. Voxels are
+    dropped from the iteration as soon as they have converged.
+
+    Parameters
+    ----------
+    fun : callable
+        ``fun(x, index)`` returning the residuals, shape (n, M), for the
+        parameters ``x`` of shape (n, N) of the voxels ``index``.
+    jac : callable
+        ``jac(x, index)`` returning the Jacobian of the residuals, shape
+        (n, M, N).
+    x0 : np.ndarray, shape (V, N)
+        Starting point of every voxel.
+    bounds : tuple of array-like
+        (lower, upper), each broadcastable to (V, N).
+    max_iter : int, optional
+        Maximum number of iterations.
+    xtol, ftol : float, optional
+        Convergence tolerances on the relative step size and on the relative
+        reduction of the cost.
+
+    Returns
+    -------
+    x : np.ndarray, shape (V, N)
+        Solution of every voxel.
+    cost : np.ndarray, shape (V,)
+        Sum of squared residuals at the solution.
+    """
+    x0 = np.asarray(x0, dtype=float)
+    lower = np.broadcast_to(np.asarray(bounds[0], dtype=float), x0.shape)
+    upper = np.broadcast_to(np.asarray(bounds[1], dtype=float), x0.shape)
+    x = np.clip(x0, lower, upper)
+    n_voxels, n_params = x.shape
+    everything = np.arange(n_voxels)
+    cost = np.sum(fun(x, everything) ** 2, axis=-1)
+    damping = np.full(n_voxels, 1e-3)
+    active = np.isfinite(cost)
+    eye = np.eye(n_params)
+
+    for _ in range(max_iter):
+        index = np.flatnonzero(active)
+        if index.size == 0:
+            break
+        x_a = x[index]
+        J = jac(x_a, index)
+        r = fun(x_a, index)
+        JtJ = np.einsum('vmi,vmj->vij', J, J)
+        gradient = np.einsum('vmi,vm->vi', J, r)
+
+        # hold parameters on a bound if the descent direction points outwards
+        free = ~(((x_a <= lower[index]) & (gradient > 0)) | ((x_a >= upper[index]) & (gradient < 0)))
+        diagonal = np.diagonal(JtJ, axis1=1, axis2=2)
+        diagonal = np.maximum(diagonal, 1e-12 * np.max(diagonal, axis=1, keepdims=True) + 1e-300)
+        A = JtJ + damping[index, np.newaxis, np.newaxis] * diagonal[:, np.newaxis, :] * eye
+        pair = free[:, :, np.newaxis] & free[:, np.newaxis, :]
+        A = np.where(pair, A, eye)
+        rhs = np.where(free, -gradient, 0)
+        step = np.linalg.solve(A, rhs[..., np.newaxis])[..., 0]
+
+        x_new = np.clip(x_a + step, lower[index], upper[index])
+        cost_new = np.sum(fun(x_new, index) ** 2, axis=-1)
+        better = cost_new < cost[index]
+
+        x[index[better]] = x_new[better]
+        step_size = np.linalg.norm(x_new - x_a, axis=1)
+        small_step = step_size <= xtol * (xtol + np.linalg.norm(x_a, axis=1))
+        small_gain = better & (cost[index] - cost_new <= ftol * cost[index])
+        cost[index[better]] = cost_new[better]
+        damping[index] = np.where(better, np.maximum(damping[index] / 10, 1e-12), damping[index] * 10)
+        done = small_step | small_gain | (damping[index] > 1e12) | ~np.isfinite(cost[index])
+        active[index[done]] = False
+
+    return x, cost
+
+
+def fractions_lsq(phi, signal, lower, upper):
+    """
+    Closed-form constrained least squares for the two IVIM volume fractions.
+
+    Solves ``min ||phi @ f - signal||^2`` subject to ``sum(f) == 1`` and
+    ``lower <= f <= upper`` for any number of problems at once. With the sum
+    constraint the problem has a single free variable ``f[0]``, so the
+    unconstrained minimizer along the constraint line is exact and the box
+    constraints reduce to clipping it to the feasible interval (the active
+    set is either empty or one of the interval ends).
+
+    Parameters
+    ----------
+    phi : np.ndarray, shape (..., M, 2)
+        Basis matrices, the columns being the perfusion and diffusion
+        exponentials.
+    signal : np.ndarray, shape (..., M)
+        Measured signals, broadcastable against ``phi[..., 0]``.
+    lower, upper : array-like, shape (2,)
+        Bounds of the two fractions.
+
+    Returns
+    -------
+    f : np.ndarray, shape (..., 2)
+        The two volume fractions of every problem.
+
+    Raises
+    ------
+    ValueError
+        If no fractions summing to 1 satisfy the bounds.
+    """
+    phi = np.asarray(phi, dtype=float)
+    signal = np.asarray(signal, dtype=float)
+    # feasible interval of f[0] given f[1] = 1 - f[0]
+    f_min = max(lower[0], 1 - upper[1])
+    f_max = min(upper[0], 1 - lower[1])
+    if f_min > f_max:
+        raise ValueError(f"no volume fractions summing to 1 lie within the bounds {lower} and {upper}")
+
+    difference = phi[..., 0] - phi[..., 1]
+    norm = np.sum(difference ** 2, axis=-1)
+    projection = np.sum(difference * (signal - phi[..., 1]), axis=-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        f = np.where(norm > 0, projection / norm, f_min)
+    f = np.minimum(np.maximum(f, f_min), f_max)
+    return np.stack((f, 1 - f), axis=-1)
+
+
+def monoexp_fit_batch(bvals, data, bounds, x0, max_iter=100):
+    """
+    Batched bounded least squares fit of ``S0 * exp(-b * D)``.
+
+    Every voxel starts from the log-linear (closed-form) estimate, or from
+    ``x0`` if its signal is not strictly positive, and is refined by
+    :func:`least_squares_batch` on the signal itself, so the result is the
+    same least squares solution as a bounded ``curve_fit`` of the
+    mono-exponential.
+
+    Parameters
+    ----------
+    bvals : np.ndarray, shape (M,)
+        b-values of the fitted signal.
+    data : np.ndarray, shape (V, M)
+        Signal of every voxel.
+    bounds : tuple of array-like
+        ((lower S0, lower D), (upper S0, upper D)).
+    x0 : array-like, shape (2,) or (V, 2)
+        Fallback starting point (S0, D).
+    max_iter : int, optional
+        Maximum number of iterations of the refinement.
+
+    Returns
+    -------
+    x : np.ndarray, shape (V, 2)
+        S0 and D of every voxel.
+    """
+    bvals = np.asarray(bvals, dtype=float)
+    data = np.asarray(data, dtype=float)
+    x0 = np.broadcast_to(np.asarray(x0, dtype=float), (data.shape[0], 2))
+
+    positive = np.all(data > 0, axis=1)
+    log_data = np.log(np.where(positive[:, np.newaxis], data, 1))
+    b_centered = bvals - np.mean(bvals)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = log_data @ b_centered / np.sum(b_centered ** 2)
+    intercept = np.mean(log_data, axis=1) - slope * np.mean(bvals)
+    start = np.column_stack((np.exp(intercept), -slope))
+    start = np.where((positive & np.all(np.isfinite(start), axis=1))[:, np.newaxis], start, x0)
+
+    def residuals(x, index):
+        return x[:, 0:1] * np.exp(-bvals * x[:, 1:2]) - data[index]
+
+    def jacobian(x, index):
+        decay = np.exp(-bvals * x[:, 1:2])
+        return np.stack((decay, -bvals * x[:, 0:1] * decay), axis=-1)
+
+    x, _ = least_squares_batch(residuals, jacobian, start, bounds, max_iter=max_iter)
+    return x
@@ -2,7 +2,8 @@
 import numpy as np
 from scipy.optimize import curve_fit
 from dipy.reconst.base import ReconstModel
-from dipy.reconst.multi_voxel import multi_voxel_fit
+from .multi_voxel import multi_voxel_fit
+from utilities.ivim.ivim_models import biexp_jacobian
 from dipy.utils.optpkg import optional_package
 
 
@@ -48,7 +49,7 @@ class IvimModelBiExp(ReconstModel):
         
         # Perform the fit
         popt, pcov = curve_fit(self.ivim_model, self.bvals, data, p0=self.initial_guess,\
-            bounds=self.bounds, maxfev=10000)
+            bounds=self.bounds, maxfev=10000, jac=self.ivim_model_jacobian)
         
         # Set the results and rescale S0
         result = popt
@@ -58,6 +59,10 @@ class IvimModelBiExp(ReconstModel):
 
     def ivim_model(self, b, S0, f, D_star, D):
         return S0*(f*np.exp(-b*D_star) + (1-f)*np.exp(-b*D))
+
+    def ivim_model_jacobian(self, b, S0, f, D_star, D):
+        """ Jacobian of :func: `ivim_model` with respect to S0, f, D* and D. """
+        return biexp_jacobian(b, D, f, D_star, S0)[..., [3, 1, 2, 0]]
     
     def set_bounds(self, bounds):
         # Use this function for fits that uses curve_fit
@@ -3,7 +3,7 @@
 import numpy as np
 from scipy.optimize import lsq_linear
 from dipy.reconst.base import ReconstModel
-from dipy.reconst.multi_voxel import multi_voxel_fit
+from .multi_voxel import multi_voxel_fit
 from dipy.utils.optpkg import optional_package
 from scipy.signal import unit_impulse
 
@@ -1,9 +1,9 @@
 import numpy as np
 from scipy.optimize import least_squares, differential_evolution
 from dipy.reconst.base import ReconstModel
-from dipy.reconst.multi_voxel import multi_voxel_fit
-from dipy.utils.optpkg import optional_package
-cvxpy, have_cvxpy, _ = optional_package("cvxpy")
+from .multi_voxel import multi_voxel_fit
+from .batch_optimizers import differential_evolution_batch, least_squares_batch, fractions_lsq
+from utilities.ivim.ivim_models import biexp_jacobian
 
 class IvimModelVP(ReconstModel):
 
@@ -140,7 +140,7 @@ class IvimModelVP(ReconstModel):
 
         # Optimizer #3: Nonlinear-Least Squares
         res = least_squares(self.nlls_cost, x_f, bounds=bounds,
-                            xtol=self.xtol, args=(data,))
+                            xtol=self.xtol, args=(data,), jac=self.nlls_cost_jacobian)
         result = res.x
         f_est = result[0]
         D_star_est = result[1]
@@ -160,6 +160,117 @@ class IvimModelVP(ReconstModel):
         #result = np.insert(result, 0, np.mean(S0_est), axis=0)
         return IvimFit(self, result)
 
+    def fit_batch(self, data, popsize=28, rng=None):
+        r""" Fit many voxels at once with a batched version of the MIX pipeline.
+
+        Runs the same three stages as :func: `fit`, but for all voxels
+        simultaneously: the differential evolution evolves one population per
+        voxel and evaluates the variable projection cost of every
+        (voxel, candidate) pair in a single array operation per generation,
+        and the final non-linear least squares is a batched bounded
+        Levenberg-Marquardt. The DE polishing step of SciPy is left out, as
+        the final least squares starts from the DE result anyway.
+
+        Parameters
+        ----------
+        data : array, shape (voxels, b-values)
+            Signal of every voxel.
+        popsize : int, optional
+            Population size multiplier of the differential evolution.
+            default : 28
+        rng : numpy.random.Generator or int, optional
+            Random number generator or seed for the differential evolution.
+
+        Returns
+        -------
+        model_params : array, shape (voxels, 4)
+            S0, f, D* and D of every voxel, as in :func: `fit`.
+        """
+        data = np.atleast_2d(np.asarray(data, dtype=float))
+        data_max = data.max(axis=1, keepdims=True)
+        data_max[data_max == 0] = 1
+        data = data / data_max
+        b = self.bvals
+
+        # Optimizer #1: Differential Evolution, all voxels at once
+        bounds_de = np.array([self.bounds[1], self.bounds[2]])
+        x, _ = differential_evolution_batch(
+            lambda x: self.stoc_search_cost_batch(x, data), bounds_de,
+            data.shape[0], popsize=popsize, maxiter=self.maxiter, rng=rng)
+
+        # Optimizer #2: constrained linear fractions, all voxels at once
+        phi = np.exp(-b[:, np.newaxis] * x[:, np.newaxis, :])
+        f = self._fractions_lsq(phi, data)[:, 0]
+        x_f = np.column_stack((f, x))
+
+        # Optimizer #3: Nonlinear-Least Squares, all voxels at once
+        bounds_lower = (self.bounds[0][0], self.bounds[1][0], self.bounds[2][0])
+        bounds_upper = (self.bounds[0][1], self.bounds[1][1], self.bounds[2][1])
+        result, _ = least_squares_batch(
+            lambda x_f, index: self.nlls_residuals_batch(x_f, data[index]),
+            lambda x_f, index: self.nlls_jacobian_batch(x_f),
+            x_f, (bounds_lower, bounds_upper), xtol=self.xtol)
+        f_est = result[:, 0]
+        D_star_est = result[:, 1]
+        D_est = result[:, 2]
+
+        S0 = data / (f_est[:, np.newaxis] * np.exp(-b * D_star_est[:, np.newaxis]) +
+                     (1 - f_est[:, np.newaxis]) * np.exp(-b * D_est[:, np.newaxis]))
+        S0_est = np.mean(S0 * data_max, axis=1)
+
+        if self.rescale_results_to_mm2_s:
+            return np.column_stack((S0_est, f_est, D_star_est*1e-3, D_est*1e-3))
+        return np.column_stack((S0_est, result))
+
+    def stoc_search_cost_batch(self, x, signals):
+        """
+        Batched version of :func: `stoc_search_cost`.
+        Parameters
+        ----------
+        x : array, shape (voxels, candidates, 2)
+            D* and D of every candidate of every voxel.
+        signals : array, shape (voxels, b-values)
+            The signal values measured for this model.
+        Returns
+        -------
+        cost : array, shape (voxels, candidates)
+        """
+        phi = np.exp(-self.bvals * x[..., np.newaxis])
+        signals = signals[:, np.newaxis, :]
+        fractions = self._projection_fractions(phi, signals)
+        yhat = np.einsum('...kb,...k->...b', phi, fractions)
+        return np.sum((signals - yhat) ** 2, axis=-1)
+
+    def _projection_fractions(self, phi, signals):
+        """
+        Moore-Penrose solution of phi.T f = signal for a batch of 2-column
+        bases, written out in closed form for the 2x2 normal equations.
+        phi has shape (..., 2, b-values) and signals (..., b-values).
+        """
+        a = np.sum(phi[..., 0, :] ** 2, axis=-1)
+        c = np.sum(phi[..., 0, :] * phi[..., 1, :], axis=-1)
+        d = np.sum(phi[..., 1, :] ** 2, axis=-1)
+        y0 = np.sum(phi[..., 0, :] * signals, axis=-1)
+        y1 = np.sum(phi[..., 1, :] * signals, axis=-1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            det = a * d - c ** 2
+            return np.stack(((d * y0 - c * y1) / det, (a * y1 - c * y0) / det), axis=-1)
+
+    def nlls_residuals_batch(self, x_f, signals):
+        """
+        Residuals of the bi-exponential model for a batch of voxels; the sum
+        of their squares is :func: `nlls_cost`.
+        """
+        f, D_star, D = x_f[:, 0:1], x_f[:, 1:2], x_f[:, 2:3]
+        return f * np.exp(-self.bvals * D_star) + (1 - f) * np.exp(-self.bvals * D) - signals
+
+    def nlls_jacobian_batch(self, x_f):
+        """
+        Jacobian of :func: `nlls_residuals_batch` with respect to f, D* and D.
+        """
+        f, D_star, D = x_f[:, 0:1], x_f[:, 1:2], x_f[:, 2:3]
+        return biexp_jacobian(self.bvals, D, f, D_star)[..., [1, 2, 0]]
+
     def stoc_search_cost(self, x, signal):
         """
         Cost function for differential evolution algorithm. Performs a
@@ -221,10 +332,11 @@ class IvimModelVP(ReconstModel):
         """
         Performs the constrained search for the linear parameters `f` after
         the estimation of `x` is done. Estimation of the linear parameters `f`
-        is a constrained linear least-squares optimization problem solved by
-        using a convex optimizer from cvxpy. The IVIM equation contains two
-        parameters that depend on the same volume fraction. Both are estimated
-        as separately in the convex optimizer.
+        is a constrained linear least-squares optimization problem. As the
+        fractions have to sum to one it has a single free variable, and it is
+        solved in closed form by :func: `fractions_lsq`. The IVIM equation
+        contains two parameters that depend on the same volume fraction. Both
+        are returned separately.
         Parameters
         ----------
         phi : array
@@ -241,23 +353,16 @@ class IvimModelVP(ReconstModel):
             minimize(norm((signal)- (phi*f)))
         """
 
-        # Create four scalar optimization variables.
-        f = cvxpy.Variable(2)
         # Constraints have been set similar to the MIX paper's
         # Supplementary Note 2: Synthetic Data Experiments, experiment 2
-        constraints = [cvxpy.sum(f) == 1,
-                       f[0] >= 0.011,
-                       f[1] >= 0.011,
-                       f[0] <= self.bounds[1][0],
-                       f[1] <= 0.89]
-
-        # Form objective.
-        obj = cvxpy.Minimize(cvxpy.sum(cvxpy.square(phi @ f - signal)))
+        return self._fractions_lsq(phi, signal)
 
-        # Form and solve problem.
-        prob = cvxpy.Problem(obj, constraints)
-        prob.solve()  # Returns the optimal value.
-        return np.array(f.value)
+    def _fractions_lsq(self, phi, signal):
+        """
+        Constrained fractions for one or many `phi` matrices of shape
+        (..., b-values, 2); see :func: `cvx_fit`.
+        """
+        return fractions_lsq(phi, signal, lower=(0.011, 0.011), upper=(self.bounds[1][0], 0.89))
 
     def nlls_cost(self, x_f, signal):
         """
@@ -287,6 +392,18 @@ class IvimModelVP(ReconstModel):
         phi = self.phi(x)
         return np.sum((np.dot(phi, f1) - signal) ** 2)
 
+    def nlls_cost_jacobian(self, x_f, signal):
+        """
+        Gradient of :func: `nlls_cost` with respect to f, D* and D, used by
+        the Least Squares function of SciPy in :func: `fit` instead of finite
+        differences.
+        """
+        x, f = self.x_f_to_x_and_f(x_f)
+        f1 = np.array([f, 1 - f])
+        phi = self.phi(x)
+        residuals = np.dot(phi, f1) - signal
+        return 2 * residuals @ biexp_jacobian(self.bvals, x[1], f, x[0])[:, [1, 2, 0]]
+
     def x_f_to_x_and_f(self, x_f):
         """
         Splits the array of parameters in x_f to 'x' and 'f' for performing
@@ -2,9 +2,9 @@
 import numpy as np
 from scipy.optimize import shgo
 from dipy.reconst.base import ReconstModel
-from dipy.reconst.multi_voxel import multi_voxel_fit
-from dipy.utils.optpkg import optional_package
-cvxpy, have_cvxpy, _ = optional_package("cvxpy")
+from .multi_voxel import multi_voxel_fit
+from .batch_optimizers import fractions_lsq, least_squares_batch
+from utilities.ivim.ivim_models import biexp_jacobian
 
 class IvimModelTopoPro(ReconstModel):
 
@@ -69,6 +69,7 @@ class IvimModelTopoPro(ReconstModel):
         self.exp_phi = np.zeros((self.bvals.shape[0], 2))
         self.shgo_iters = shgo_iters
         self.rescale_results_to_mm2_s = rescale_results_to_mm2_s
+        self._basis_cache = {}
         
         # The rescaled units arguement converts the bounds for D* and D from
         # mm2/s to µm2/ms.
@@ -171,6 +172,123 @@ class IvimModelTopoPro(ReconstModel):
             
         return IvimFit(self, result)
     
+    def fit_batch(self, data, grid_size=(64, 64)):
+        r""" Fit many voxels at once with a grid-seeded version of TopoPro.
+
+        The non-linear parameter space of the variable projection is only
+        (D*, D), so instead of a level-1 SHGO per voxel, the separable cost
+        of all voxels is evaluated against a grid of cached exponential bases
+        (see :func: `basis_grid`) in one batched step. The best grid point of
+        every voxel and its constrained fractions (:func: `cvx_fit`) seed a
+        batched bounded least squares on all parameters, which replaces the
+        level-2 SHGO and searches the same box around the seed.
+
+        Parameters
+        ----------
+        data : array, shape (voxels, b-values)
+            Signal of every voxel.
+        grid_size : tuple of int, optional
+            Number of D* and D grid points.
+            default : (64, 64)
+
+        Returns
+        -------
+        model_params : array, shape (voxels, 4)
+            S0, f, D* and D of every voxel, as in :func: `fit`.
+        """
+        data = np.atleast_2d(np.asarray(data, dtype=float))
+        data_max = data.max(axis=1, keepdims=True)
+        data_max[data_max == 0] = 1
+        data = data / data_max
+        b = self.bvals
+
+        # Level 1: separable cost of every voxel on the (D*, D) grid
+        D_star_grid, D_grid, perfusion, diffusion = self.basis_grid(grid_size)
+        a = np.sum(perfusion ** 2, axis=1)[:, np.newaxis]
+        c = perfusion @ diffusion.T
+        d = np.sum(diffusion ** 2, axis=1)[np.newaxis, :]
+        det = a * d - c ** 2
+        valid = det > 1e-12 * a * d
+        det[~valid] = 1
+        y0 = data @ perfusion.T
+        y1 = data @ diffusion.T
+        explained = (d * y0[:, :, np.newaxis] ** 2 - 2 * c * y0[:, :, np.newaxis] * y1[:, np.newaxis, :] +
+                     a * y1[:, np.newaxis, :] ** 2) / det
+        explained[:, ~valid] = -np.inf
+        best = np.argmax(explained.reshape(data.shape[0], -1), axis=1)
+        i, j = np.unravel_index(best, explained.shape[1:])
+        x = np.column_stack((D_star_grid[i], D_grid[j]))
+
+        phi = np.stack((perfusion[i], diffusion[j]), axis=-1)
+        f = self.cvx_fit(data, phi)[:, 0]
+        x_f = np.column_stack((f, x))
+
+        # Level 2: least squares in the same box the level-2 SHGO searches
+        relative = np.array([.99, .7, .7])
+        result, _ = least_squares_batch(
+            lambda x_f, index: self.nlls_residuals_batch(x_f, data[index]),
+            lambda x_f, index: self.nlls_jacobian_batch(x_f),
+            x_f, (x_f * (1 - relative), x_f * (1 + relative)))
+        f_est = result[:, 0]
+        D_star_est = result[:, 1]
+        D_est = result[:, 2]
+
+        S0 = data / (f_est[:, np.newaxis] * np.exp(-b * D_star_est[:, np.newaxis]) +
+                     (1 - f_est[:, np.newaxis]) * np.exp(-b * D_est[:, np.newaxis]))
+        S0_est = np.mean(S0 * data_max, axis=1)
+
+        if self.rescale_results_to_mm2_s:
+            return np.column_stack((S0_est, f_est, D_star_est*1e-3, D_est*1e-3))
+        return np.column_stack((S0_est, result))
+
+    def basis_grid(self, grid_size=(64, 64)):
+        """
+        Grid of D* and D values within the bounds and the corresponding
+        exponential bases exp(-b*D*) and exp(-b*D) for the b-values of the
+        model. The bases only depend on the acquisition, so they are computed
+        once per grid size and cached.
+
+        Parameters
+        ----------
+        grid_size : tuple of int, optional
+            Number of D* and D grid points.
+
+        Returns
+        -------
+        D_star_grid, D_grid : array
+            The grid points; D* is spaced logarithmically if its lower bound
+            is positive.
+        perfusion, diffusion : array, shape (grid points, b-values)
+            The exponential bases.
+        """
+        grid_size = tuple(grid_size)
+        if grid_size not in self._basis_cache:
+            D_star_bounds, D_bounds = self.bounds[1], self.bounds[2]
+            if D_star_bounds[0] > 0:
+                D_star_grid = np.geomspace(D_star_bounds[0], D_star_bounds[1], grid_size[0])
+            else:
+                D_star_grid = np.linspace(D_star_bounds[0], D_star_bounds[1], grid_size[0])
+            D_grid = np.linspace(D_bounds[0], D_bounds[1], grid_size[1])
+            self._basis_cache[grid_size] = (D_star_grid, D_grid,
+                                            np.exp(-np.outer(D_star_grid, self.bvals)),
+                                            np.exp(-np.outer(D_grid, self.bvals)))
+        return self._basis_cache[grid_size]
+
+    def nlls_residuals_batch(self, x_f, signals):
+        """
+        Residuals of the bi-exponential model for a batch of voxels; the sum
+        of their squares is :func: `nlls_cost`.
+        """
+        f, D_star, D = x_f[:, 0:1], x_f[:, 1:2], x_f[:, 2:3]
+        return f * np.exp(-self.bvals * D_star) + (1 - f) * np.exp(-self.bvals * D) - signals
+
+    def nlls_jacobian_batch(self, x_f):
+        """
+        Jacobian of :func: `nlls_residuals_batch` with respect to f, D* and D.
+        """
+        f, D_star, D = x_f[:, 0:1], x_f[:, 1:2], x_f[:, 2:3]
+        return biexp_jacobian(self.bvals, D, f, D_star)[..., [1, 2, 0]]
+
     def rescale_bounds_and_initial_guess(self, rescale_units):
         if rescale_units:
             # Rescale the guess
@@ -259,10 +377,11 @@ class IvimModelTopoPro(ReconstModel):
         """
         Performs the constrained search for the linear parameters `f` after
         the estimation of `x` is done. Estimation of the linear parameters `f`
-        is a constrained linear least-squares optimization problem solved by
-        using a convex optimizer from cvxpy. The IVIM equation contains two
-        parameters that depend on the same volume fraction. Both are estimated
-        as separately in the convex optimizer.
+        is a constrained linear least-squares optimization problem. As the
+        fractions have to sum to one it has a single free variable, and it is
+        solved in closed form by :func: `fractions_lsq`. The IVIM equation
+        contains two parameters that depend on the same volume fraction. Both
+        are returned separately.
 
         Parameters
         ----------
@@ -284,21 +403,7 @@ class IvimModelTopoPro(ReconstModel):
 
             minimize(norm((signal)- (phi*f)))
         """
-        # Create four scalar optimization variables.
-        f = cvxpy.Variable(2)
-        constraints = [cvxpy.sum(f) == 1,
-                       f[0] >= 1e-7,
-                       f[1] >= 1e-7,
-                       f[0] <= 0.9,
-                       f[1] <= 0.9]
-
-        # Form objective.
-        obj = cvxpy.Minimize(cvxpy.sum(cvxpy.square(phi @ f - signal)))
-
-        # Form and solve problem.
-        prob = cvxpy.Problem(obj, constraints)
-        prob.solve()  # Returns the optimal value.
-        return np.array(f.value)
+        return fractions_lsq(phi, signal, lower=(1e-7, 1e-7), upper=(0.9, 0.9))
 
     def nlls_cost(self, x_f, signal):
         """
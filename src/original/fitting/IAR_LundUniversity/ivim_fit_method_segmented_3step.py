@@ -3,7 +3,9 @@
 import numpy as np
 from scipy.optimize import curve_fit
 from dipy.reconst.base import ReconstModel
-from dipy.reconst.multi_voxel import multi_voxel_fit
+from .multi_voxel import multi_voxel_fit
+from utilities.ivim.ivim_models import biexp_jacobian, monoexp_jacobian
+from .batch_optimizers import least_squares_batch, monoexp_fit_batch
 from dipy.utils.optpkg import optional_package
 
 
@@ -62,7 +64,7 @@ class IvimModelSegmented3Step(ReconstModel):
         diff_data = data[diff_bval_indices]
         
         S0_diff_est, D_est = curve_fit(self.diffusion_signal, diff_bvals, diff_data, \
-            bounds=diff_bounds, p0=np.take(self.initial_guess, [0, 3]), maxfev=10000)[0]
+            bounds=diff_bounds, p0=np.take(self.initial_guess, [0, 3]), maxfev=10000, jac=self.monoexp_signal_jacobian)[0]
         
         
         ### Fit the perfusion signal to bvals <= perf_b_threshold_upper
@@ -74,7 +76,7 @@ class IvimModelSegmented3Step(ReconstModel):
         perf_data = data[perf_bval_indices]
         
         S0_perf_est, D_star_est = curve_fit(self.perfusion_signal, perf_bvals, perf_data, \
-            bounds=perf_bounds, p0=np.take(self.initial_guess, [0, 2]), maxfev=10000)[0]
+            bounds=perf_bounds, p0=np.take(self.initial_guess, [0, 2]), maxfev=10000, jac=self.monoexp_signal_jacobian)[0]
         
         # Calculate the estimation of f based on the two S0 estimates
         f_est = S0_perf_est/(S0_perf_est + S0_diff_est)
@@ -87,7 +89,8 @@ class IvimModelSegmented3Step(ReconstModel):
         full_bounds_upper = self.bounds[1][:-1]
         full_bounds = (full_bounds_lower, full_bounds_upper)
         
-        S0_est, f_est, D_star_est = curve_fit(lambda b, S0, f, D_star: self.ivim_signal(b, S0, f, D_star, D_est), self.bvals, data, bounds=full_bounds, p0=full_initial_guess, maxfev=10000)[0]
+        S0_est, f_est, D_star_est = curve_fit(lambda b, S0, f, D_star: self.ivim_signal(b, S0, f, D_star, D_est), self.bvals, data, bounds=full_bounds, p0=full_initial_guess, maxfev=10000, \
+            jac=lambda b, S0, f, D_star: self._ivim_jacobian_fixed_D(b, S0, f, D_star, D_est))[0]
         
         # Set the results and rescale S0
         result = np.array([S0_est, f_est, D_star_est, D_est])
@@ -95,12 +98,67 @@ class IvimModelSegmented3Step(ReconstModel):
 
         return IvimFit(self, result)
 
+    def fit_batch(self, data):
+        """Fit many voxels at once with the 3-step segmented fit.
+
+        Array-native version of :func: `fit`: all three steps are solved for
+        all voxels simultaneously by batched bounded least squares.
+
+        Args:
+            data (array-like): voxels x b-values matrix.
+
+        Returns:
+            np.ndarray: S0, f, D* and D of every voxel, shape (voxels, 4), as
+            in the model_params of :func: `fit`.
+        """
+        data = np.atleast_2d(np.asarray(data, dtype=float))
+        data_max = data.max(axis=1)
+        data = data / np.where(data_max == 0, 1, data_max)[:, np.newaxis]
+
+        diff_bounds = [(0, self.bounds[0][3]), \
+            (self.bounds[1][0], self.bounds[1][3])] # Bounds for S0 and D
+        diff_bval_indices = np.where(self.bvals >= self.diff_b_threshold_lower)[0]
+        S0_diff_est, D_est = monoexp_fit_batch(self.bvals[diff_bval_indices], data[:, diff_bval_indices], \
+            diff_bounds, np.take(self.initial_guess, [0, 3])).T
+
+        perf_bounds = [(self.bounds[0][0], self.bounds[0][2]), \
+            (self.bounds[1][0], self.bounds[1][2])] # Bounds for S0 and D*
+        perf_bval_indices = np.where(self.bvals <= self.perf_b_threshold_upper)[0]
+        S0_perf_est, D_star_est = monoexp_fit_batch(self.bvals[perf_bval_indices], data[:, perf_bval_indices], \
+            perf_bounds, np.take(self.initial_guess, [0, 2])).T
+
+        f_est = S0_perf_est/(S0_perf_est + S0_diff_est)
+        f_intial_guess = np.where(f_est > self.bounds[0][1], np.minimum(f_est, self.bounds[0][1]), np.maximum(f_est, self.bounds[1][1]))
+
+        full_bounds_lower = self.bounds[0][:-1]
+        full_bounds_upper = self.bounds[1][:-1]
+        full_bounds = (full_bounds_lower, full_bounds_upper)
+        full_initial_guess = np.column_stack((np.full_like(f_est, self.initial_guess[0]), f_intial_guess, \
+            np.full_like(f_est, self.initial_guess[2])))
+        result, _ = least_squares_batch(
+            lambda x, index: self.ivim_signal(self.bvals, x[:, 0:1], x[:, 1:2], x[:, 2:3], D_est[index, np.newaxis]) - data[index],
+            lambda x, index: self._ivim_jacobian_fixed_D(self.bvals, x[:, 0:1], x[:, 1:2], x[:, 2:3], D_est[index, np.newaxis]),
+            full_initial_guess, full_bounds)
+        S0_est, f_est, D_star_est = result.T
+
+        result = np.column_stack((S0_est, f_est, D_star_est, D_est))
+        result[:, 0] *= data_max
+        return result
+
+    def _ivim_jacobian_fixed_D(self, b, S0, f, D_star, D):
+        """ Jacobian of :func: `ivim_signal` with respect to S0, f and D*. """
+        return biexp_jacobian(b, D, f, D_star, S0)[..., [3, 1, 2]]
+
     def diffusion_signal(self, b, S0, D):
         return S0*np.exp(-b*D)
     
     def perfusion_signal(self, b, S0, D_star):
         return S0*np.exp(-b*D_star)
     
+    def monoexp_signal_jacobian(self, b, S0, D):
+        """ Jacobian of :func: `diffusion_signal` and :func: `perfusion_signal` with respect to S0 and D. """
+        return monoexp_jacobian(b, D, S0)[..., ::-1]
+    
     def ivim_signal(self, b, S0, f, D_star, D):
         return S0*(f*np.exp(-b*D_star) + (1-f)*np.exp(-b*D))
     
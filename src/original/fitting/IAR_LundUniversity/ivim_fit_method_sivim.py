@@ -3,7 +3,7 @@
 import numpy as np
 from scipy.optimize import curve_fit
 from dipy.reconst.base import ReconstModel
-from dipy.reconst.multi_voxel import multi_voxel_fit
+from .multi_voxel import multi_voxel_fit
 from dipy.utils.optpkg import optional_package
 from scipy.signal import unit_impulse
 
@@ -62,7 +62,7 @@ class IvimModelsIVIM(ReconstModel):
         
         # Perform the fit
         popt, pcov = curve_fit(self.sivim_model, self.bvals, ydata, p0=self.initial_guess,\
-            bounds=self.bounds, maxfev=10000)
+            bounds=self.bounds, maxfev=10000, jac=self.sivim_model_jacobian)
         
         # Set the results and rescale S0
         result = popt
@@ -74,6 +74,12 @@ class IvimModelsIVIM(ReconstModel):
         delta = unit_impulse(b.shape, idx=0)
         res = S0*(f*delta + (1-f)*np.exp(-b*D))
         return res
+
+    def sivim_model_jacobian(self, b, S0, f, D):
+        """ Jacobian of :func: `sivim_model` with respect to S0, f and D. """
+        delta = unit_impulse(b.shape, idx=0)
+        diffusion = np.exp(-b*D)
+        return np.stack((f*delta + (1-f)*diffusion, S0*(delta - diffusion), -b*S0*(1-f)*diffusion), axis=-1)
             
     def set_bounds(self, bounds):
         # Use this function for fits that uses curve_fit
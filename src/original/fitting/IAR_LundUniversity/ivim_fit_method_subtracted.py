@@ -3,7 +3,9 @@
 import numpy as np
 from scipy.optimize import curve_fit
 from dipy.reconst.base import ReconstModel
-from dipy.reconst.multi_voxel import multi_voxel_fit
+from .multi_voxel import multi_voxel_fit
+from utilities.ivim.ivim_models import monoexp_jacobian
+from .batch_optimizers import monoexp_fit_batch
 from dipy.utils.optpkg import optional_package
 
 
@@ -60,7 +62,7 @@ class IvimModelSubtracted(ReconstModel):
         diff_data = data[diff_bval_indices]
         
         S0_diff_est, D_est = curve_fit(self.diffusion_signal, diff_bvals, diff_data, \
-            bounds=diff_bounds, p0=np.take(self.initial_guess, [0, 3]), maxfev=10000)[0]
+            bounds=diff_bounds, p0=np.take(self.initial_guess, [0, 3]), maxfev=10000, jac=self.monoexp_signal_jacobian)[0]
         
         
         ### Fit the perfusion signal to bvals <= perf_b_threshold_upper
@@ -74,7 +76,7 @@ class IvimModelSubtracted(ReconstModel):
         perf_data = data[perf_bval_indices] - diff_data_to_be_removed # Subtract the diffusion signal from the total to get the perfusion signal
         
         S0_perf_est, D_star_est = curve_fit(self.perfusion_signal, perf_bvals, perf_data, \
-            bounds=perf_bounds, p0=np.take(self.initial_guess, [0, 2]), maxfev=10000)[0]
+            bounds=perf_bounds, p0=np.take(self.initial_guess, [0, 2]), maxfev=10000, jac=self.monoexp_signal_jacobian)[0]
         
         # Calculate the estimation of f based on the two S0 estimates
         f_est = S0_perf_est/(S0_perf_est + S0_diff_est)
@@ -85,12 +87,55 @@ class IvimModelSubtracted(ReconstModel):
 
         return IvimFit(self, result)
 
+    def fit_batch(self, data):
+        """Fit many voxels at once with the subtracted method.
+
+        Array-native version of :func: `fit`: both mono-exponential fits are
+        solved for all voxels simultaneously by batched bounded least squares.
+
+        Args:
+            data (array-like): voxels x b-values matrix.
+
+        Returns:
+            np.ndarray: S0, f, D* and D of every voxel, shape (voxels, 4), as
+            in the model_params of :func: `fit`.
+        """
+        data = np.atleast_2d(np.asarray(data, dtype=float))
+        data_max = data.max(axis=1)
+        data = data / np.where(data_max == 0, 1, data_max)[:, np.newaxis]
+
+        diff_bounds = [(0, self.bounds[0][3]), \
+            (self.bounds[1][0], self.bounds[1][3])] # Bounds for S0 and D
+        diff_bval_indices = np.where(self.bvals >= self.diff_b_threshold_lower)[0]
+        S0_diff_est, D_est = monoexp_fit_batch(self.bvals[diff_bval_indices], data[:, diff_bval_indices], \
+            diff_bounds, np.take(self.initial_guess, [0, 3])).T
+
+        perf_bounds = [(0, self.bounds[0][2]), \
+            (self.bounds[1][0], self.bounds[1][2])] # Bounds for S0 and D*
+        perf_bval_indices = np.where(self.bvals <= self.perf_b_threshold_upper)[0]
+        perf_bvals = self.bvals[perf_bval_indices]
+        diff_data_to_be_removed = self.diffusion_signal(perf_bvals, S0_diff_est[:, np.newaxis], D_est[:, np.newaxis])
+        perf_data = data[:, perf_bval_indices] - diff_data_to_be_removed # Subtract the diffusion signal from the total to get the perfusion signal
+        S0_perf_est, D_star_est = monoexp_fit_batch(perf_bvals, perf_data, \
+            perf_bounds, np.take(self.initial_guess, [0, 2])).T
+
+        f_est = S0_perf_est/(S0_perf_est + S0_diff_est)
+        S0_est = S0_perf_est + S0_diff_est
+
+        result = np.column_stack((S0_est, f_est, D_star_est, D_est))
+        result[:, 0] *= data_max
+        return result
+
     def diffusion_signal(self, b, S0, D):
         return S0*np.exp(-b*D)
     
     def perfusion_signal(self, b, S0, D_star):
         return S0*np.exp(-b*D_star)
     
+    def monoexp_signal_jacobian(self, b, S0, D):
+        """ Jacobian of :func: `diffusion_signal` and :func: `perfusion_signal` with respect to S0 and D. """
+        return monoexp_jacobian(b, D, S0)[..., ::-1]
+    
     def set_bounds(self, bounds):
         # Use this function for fits that uses curve_fit
         if bounds is None:
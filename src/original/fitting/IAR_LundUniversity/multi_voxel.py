@@ -0,0 +1,101 @@
+"""
+Parallel, chunked drop-in replacement for DIPY's ``multi_voxel_fit``.
+
+DIPY's decorator turns a single voxel ``fit`` into a multi voxel one by
+looping over the voxels serially and keeping one fit object per voxel. The
+decorator in this module keeps the same calling convention (1D data gives
+the single voxel fit, ND data an ND fit, an optional ``mask``), but splits
+the masked voxels into chunks that are fitted on a joblib pool and written
+into one preallocated ``model_params`` array. The result is returned as the
+fit class of the model itself (e.g. ``IvimFit``), which already supports
+N-dimensional ``model_params``, so its interface is unchanged.
+"""
+
+import functools
+import os
+import tempfile
+import numpy as np
+from joblib import Parallel, delayed
+
+
+def _fit_chunk(model, fit_name, data, indices, model_params, kwargs):
+    """ Fit the voxels of one chunk and write them into model_params. """
+    single_voxel_fit = getattr(type(model), fit_name).single_voxel_fit
+    for index, signal in zip(indices, data):
+        model_params[index] = single_voxel_fit(model, signal, **kwargs).model_params
+
+
+def multi_voxel_fit(single_voxel_fit):
+    """
+    Method decorator to turn a single voxel model fit into a parallel,
+    chunked multi voxel model fit.
+
+    The decorated method accepts the additional keyword arguments
+
+    mask : array-like of bool, optional
+        Voxels to fit, with the spatial shape of the data. Voxels outside the
+        mask get zero parameters, as with DIPY.
+    njobs : int, optional
+        Number of parallel jobs, -1 for all cores. Default : 1 (serial).
+    chunk_size : int, optional
+        Number of voxels per job. Default : the masked voxels are split
+        evenly into 4 chunks per job.
+    backend : str, optional
+        joblib backend, e.g. "loky" (processes) or "threading".
+        Default : "loky".
+    """
+    fit_name = single_voxel_fit.__name__
+
+    @functools.wraps(single_voxel_fit)
+    def new_fit(self, data, mask=None, njobs=1, chunk_size=None, backend="loky", **kwargs):
+        data = np.asarray(data)
+        if data.ndim == 1:
+            return single_voxel_fit(self, data, **kwargs)
+
+        spatial_shape = data.shape[:-1]
+        if mask is None:
+            mask = np.ones(spatial_shape, dtype=bool)
+        else:
+            mask = np.asarray(mask, dtype=bool)
+            if mask.shape != spatial_shape:
+                raise ValueError("mask and data shape do not match")
+        data = data.reshape(-1, data.shape[-1])
+        indices = np.flatnonzero(mask)
+
+        if indices.size == 0:
+            # nothing to fit; use an all-zero voxel only to learn the output layout
+            first = single_voxel_fit(self, np.zeros(data.shape[-1]), **kwargs)
+            model_params = np.zeros((data.shape[0],) + np.shape(first.model_params))
+            return type(first)(self, model_params.reshape(spatial_shape + model_params.shape[1:]))
+
+        # the first voxel is fitted here to learn the fit class and parameter shape
+        first_index, indices = indices[0], indices[1:]
+        first = single_voxel_fit(self, data[first_index], **kwargs)
+        params_shape = np.shape(first.model_params)
+
+        if njobs == 1 or indices.size == 0:
+            model_params = np.zeros((data.shape[0],) + params_shape)
+            _fit_chunk(self, fit_name, data[indices], indices, model_params, kwargs)
+        else:
+            n_workers = os.cpu_count() if njobs < 0 else njobs
+            if chunk_size is None:
+                chunk_size = int(np.ceil(indices.size / (4 * n_workers)))
+            chunks = [indices[start:start + chunk_size] for start in range(0, indices.size, chunk_size)]
+            with tempfile.TemporaryDirectory() as folder:
+                if backend == "threading":
+                    shared_params = np.zeros((data.shape[0],) + params_shape)
+                else:
+                    # preallocated output the worker processes write into
+                    shared_params = np.memmap(os.path.join(folder, "model_params.mmap"), dtype=float,
+                                              shape=(data.shape[0],) + params_shape, mode="w+")
+                Parallel(n_jobs=njobs, backend=backend)(
+                    delayed(_fit_chunk)(self, fit_name, data[chunk], chunk, shared_params, kwargs)
+                    for chunk in chunks)
+                model_params = np.array(shared_params)
+                del shared_params
+
+        model_params[first_index] = first.model_params
+        return type(first)(self, model_params.reshape(spatial_shape + params_shape))
+
+    new_fit.single_voxel_fit = single_voxel_fit
+    return new_fit
@@ -14,7 +14,7 @@ joblib
 # load relevant libraries
 from scipy.optimize import curve_fit, minimize
 import numpy as np
-from scipy import stats
+from scipy import stats, special
 from joblib import Parallel, delayed
 import sys
 if sys.stderr.isatty():
@@ -23,6 +23,7 @@ else:
     def tqdm(iterable, **kwargs):
         return iterable
 import warnings
+from utilities.ivim.ivim_models import biexp_jacobian, triexp_jacobian, monoexp_jacobian, multiexp_jacobian, rescaled
 
 
 def ivimN(bvalues, Dt, Fp, Dp, S0):
@@ -35,6 +36,13 @@ def ivimN_noS0(bvalues, Dt, Fp, Dp):
     return (Fp / 10 * np.exp(-bvalues * Dp / 10) + (1 - Fp / 10) * np.exp(-bvalues * Dt / 1000))
 
 
+# analytic Jacobians of the rescaled models, passed to curve_fit instead of finite differences
+ivimN_jacobian = rescaled(biexp_jacobian, [1000, 10, 10, 1])
+ivimN_noS0_jacobian = ivimN_jacobian
+tri_expN_jacobian = rescaled(multiexp_jacobian, [10, 1000, 10, 100, 10, 10])
+tri_expN_noS0_jacobian = rescaled(triexp_jacobian, [1000, 10, 100, 10, 10])
+
+
 def ivim(bvalues, Dt, Fp, Dp, S0):
     # regular IVIM function
     return (S0 * (Fp * np.exp(-bvalues * Dp) + (1 - Fp) * np.exp(-bvalues * Dt)))
@@ -135,7 +143,7 @@ def fit_segmented(bvalues, dw_data, bounds=([0, 0, 0.005],[0.005, 0.7, 0.2]), cu
         bounds1 = ([bounds[0][0], 0], [bounds[1][0], 10000000000])
         params, _ = curve_fit(lambda b, Dt, int: int * np.exp(-b * Dt ), high_b, high_dw_data,
                               p0=(p0[0], p0[3]-p0[1]),
-                              bounds=bounds1)
+                              bounds=bounds1, jac=monoexp_jacobian)
         Dt, Fp = params[0], 1 - params[1]
         if Fp < bounds[0][1] : Fp = np.float64(bounds[0][1])
         if Fp > bounds[1][1] : Fp = np.float64(bounds[1][1])
@@ -144,7 +152,8 @@ def fit_segmented(bvalues, dw_data, bounds=([0, 0, 0.005],[0.005, 0.7, 0.2]), cu
         dw_data_remaining = dw_data - (1 - Fp) * np.exp(-bvalues * Dt)
         bounds2 = (bounds[0][2], bounds[1][2])
         # fit for D*
-        params, _ = curve_fit(lambda b, Dp: Fp * np.exp(-b * Dp), bvalues, dw_data_remaining, p0=(p0[2]), bounds=bounds2)
+        params, _ = curve_fit(lambda b, Dp: Fp * np.exp(-b * Dp), bvalues, dw_data_remaining, p0=(p0[2]), bounds=bounds2,
+                              jac=lambda b, Dp: monoexp_jacobian(b, Dp, Fp)[:, :1])
         Dp = params[0]
         return Dt, Fp, Dp
     except (RuntimeError, ValueError, FloatingPointError):
@@ -241,14 +250,14 @@ def fit_least_squares(bvalues, dw_data, S0_output=False, fitS0=True,
             bounds2 = ([bounds[0][0] * 1000, bounds[0][1] * 10, bounds[0][2] * 10],
                       [bounds[1][0] * 1000, bounds[1][1] * 10, bounds[1][2] * 10])
             p1=[p0[0]*1000,p0[1]*10,p0[2]*10]
-            params, _ = curve_fit(ivimN_noS0, bvalues, dw_data, p0=p1, bounds=bounds2)
+            params, _ = curve_fit(ivimN_noS0, bvalues, dw_data, p0=p1, bounds=bounds2, jac=ivimN_noS0_jacobian)
             S0 = 1
         else:
             # bounds are rescaled such that each parameter changes at roughly the same rate to help fitting.
             bounds2 = ([bounds[0][0] * 1000, bounds[0][1] * 10, bounds[0][2] * 10, bounds[0][3]],
                       [bounds[1][0] * 1000, bounds[1][1] * 10, bounds[1][2] * 10, bounds[1][3]])
             p1=[p0[0]*1000,p0[1]*10,p0[2]*10,p0[3]]
-            params, _ = curve_fit(ivimN, bvalues, dw_data, p0=p1, bounds=bounds2)
+            params, _ = curve_fit(ivimN, bvalues, dw_data, p0=p1, bounds=bounds2, jac=ivimN_jacobian)
             S0 = params[3]
         # correct for the rescaling of parameters
         Dt, Fp, Dp = params[0] / 1000, params[1] / 10, params[2] / 10
@@ -340,14 +349,14 @@ def fit_least_squares_tri_exp(bvalues, dw_data, S0_output=False, fitS0=True,
             # bounds are rescaled such that each parameter changes at roughly the same rate to help fitting.
             bounds = ([bounds[0][1] * 1000, bounds[0][2] * 10, bounds[0][3] * 100, bounds[0][4] * 10, bounds[0][5] * 10],
                       [bounds[1][1] * 1000, bounds[1][2] * 10, bounds[1][3] * 100, bounds[1][4] * 10, bounds[1][5] * 10])
-            params, _ = curve_fit(tri_expN_noS0, bvalues, dw_data, p0=[1.5, 1, 3, 1, 1.5], bounds=bounds)
+            params, _ = curve_fit(tri_expN_noS0, bvalues, dw_data, p0=[1.5, 1, 3, 1, 1.5], bounds=bounds, jac=tri_expN_noS0_jacobian)
             Fp0 = 1 - params[1] / 10 - params[3] / 10
             Dt, Fp1, Dp1, Fp2, Dp2 = params[0] / 1000, params[1] / 10, params[2] / 100, params[3] / 10, params[4] / 10
         else:
             # bounds are rescaled such that each parameter changes at roughly the same rate to help fitting.
             bounds = ([bounds[0][0] * 10, bounds[0][1] * 1000, bounds[0][2] * 10, bounds[0][3] * 100, bounds[0][4] * 10, bounds[0][5] * 10],
                       [bounds[1][0] * 10, bounds[1][1] * 1000, bounds[1][2] * 10, bounds[1][3] * 100, bounds[1][4] * 10, bounds[1][5] * 10])
-            params, _ = curve_fit(tri_expN, bvalues, dw_data, p0=[8, 1.0, 1, 3, 1, 1.5], bounds=bounds)
+            params, _ = curve_fit(tri_expN, bvalues, dw_data, p0=[8, 1.0, 1, 3, 1, 1.5], bounds=bounds, jac=tri_expN_jacobian)
             Fp0 = params[0]/10
             Dt, Fp1, Dp1, Fp2, Dp2 = params[1] / 1000, params[2] / 10, params[3] / 100, params[4] / 10, params[5] / 10
         # correct for the rescaling of parameters
@@ -439,7 +448,7 @@ def fit_segmented_tri_exp(bvalues, dw_data, bounds=([0, 0, 0, 0.005, 0, 0.06], [
         # fit for S0' and D
         params, _ = curve_fit(lambda b, Dt, int: int * np.exp(-b * Dt / 1000), high_b, high_dw_data,
                               p0=(1, 1),
-                              bounds=bounds1)
+                              bounds=bounds1, jac=rescaled(monoexp_jacobian, [1000, 1]))
         Dt, Fp0 = params[0] / 1000, params[1]
         # remove the diffusion part to only keep the pseudo-diffusion
         dw_data = dw_data - Fp0 * np.exp(-bvalues * Dt)
@@ -451,7 +460,7 @@ def fit_segmented_tri_exp(bvalues, dw_data, bounds=([0, 0, 0, 0.005, 0, 0.06], [
         bounds1 = ([bounds[0][3] * 10., bounds[0][2]], [bounds[1][3] * 10., bounds[1][2]])
         # fit for f0' and Dp1
         params, _ = curve_fit(lambda b, Dt, int: int * np.exp(-b * Dt / 10), high_b2, high_dw_data,
-                              p0=(0.1, min(0.1)), bounds=bounds1)
+                              p0=(0.1, min(0.1)), bounds=bounds1, jac=rescaled(monoexp_jacobian, [10, 1]))
         Dp, Fp = params[0] / 10, params[1]
         # remove the diffusion part to only keep the pseudo-diffusion
         dw_data = dw_data - Fp * np.exp(-bvalues * Dp)
@@ -460,7 +469,8 @@ def fit_segmented_tri_exp(bvalues, dw_data, bounds=([0, 0, 0, 0.005, 0, 0.06], [
         bounds1 = (bounds[0][5], bounds[1][5])
         # fit for D*
         Fp2 = 1 - Fp0 - Fp
-        params, _ = curve_fit(lambda b, Dp: Fp2 * np.exp(-b * Dp), bvalueslow, dw_data, p0=(0.1), bounds=bounds1)
+        params, _ = curve_fit(lambda b, Dp: Fp2 * np.exp(-b * Dp), bvalueslow, dw_data, p0=(0.1), bounds=bounds1,
+                              jac=lambda b, Dp: monoexp_jacobian(b, Dp, Fp2)[:, :1])
         Dp2 = params[0]
         return Fp0, Dt, Fp, Dp, Fp2, Dp2
     except (RuntimeError, ValueError, FloatingPointError, TypeError):
@@ -490,6 +500,7 @@ def empirical_neg_log_prior(Dt0, Fp0, Dp0, S00=None):
     :param Dt0: 1D Array with the initial f estimates
     :param Dt0: 1D Array with the initial D* estimates
     :param Dt0: 1D Array with the initial S0 estimates (optional)
+    :return: an EmpiricalNegLogPrior; calling it with parameters p returns the negative log prior
     """
     # Dp0, Dt0, Fp0 are flattened arrays
     # only take valid voxels along, in which the initial estimates were sensible and successful
@@ -508,33 +519,89 @@ def empirical_neg_log_prior(Dt0, Fp0, Dp0, S00=None):
     Dp_shape, _, Dp_scale = stats.lognorm.fit(Dp0, floc=0)
     Dt_shape, _, Dt_scale = stats.lognorm.fit(Dt0, floc=0)
     Fp_a, Fp_b, _, _ = stats.beta.fit(Fp0, floc=0, fscale=1)
+    S0_beta = None
     if S00 is not None:
         S0_a, S0_b, _, _ = stats.beta.fit(S00, floc=0, fscale=2)
+        S0_beta = (S0_a, S0_b)
 
-    # define the prior
-    def neg_log_prior(p):
-        # depends on whether S0 is fitted or not
+    return EmpiricalNegLogPrior((Dt_shape, Dt_scale), (Fp_a, Fp_b), (Dp_shape, Dp_scale), S0_beta)
+
+
+class EmpiricalNegLogPrior:
+    """
+    Negative log of the empirical prior of the IVIM parameters, as made by empirical_neg_log_prior.
+
+    D and D* have lognormal priors, f a beta prior and S0/2 (optionally) a beta prior. The densities are evaluated
+    in closed form from the fitted distribution parameters, instead of through the frozen scipy distributions, so
+    the prior is cheap to evaluate in an optimiser, works on arrays of parameters and has an analytic gradient.
+
+    The parameters p are given along the first axis: p[0] = D, p[1] = f, p[2] = D* and (optionally) p[3] = S0,
+    each either a scalar or an array (e.g. of several voxels).
+    """
+    eps = 1e-8  # added to the densities, so the prior stays finite where the density is 0
+    penalty = 1e8  # returned for D* < D, to make this very unlikely
+
+    def __init__(self, Dt_lognorm, Fp_beta, Dp_lognorm, S0_beta=None):
+        """
+        :param Dt_lognorm: (shape, scale) of the lognormal prior of D
+        :param Fp_beta: (a, b) of the beta prior of f
+        :param Dp_lognorm: (shape, scale) of the lognormal prior of D*
+        :param S0_beta: (a, b) of the beta prior of S0/2 (optional)
+        """
+        self.Dt_lognorm = Dt_lognorm
+        self.Fp_beta = Fp_beta
+        self.Dp_lognorm = Dp_lognorm
+        self.S0_beta = S0_beta
+
+    @staticmethod
+    def _lognorm(x, shape, scale):
+        # density and derivative of the log density of the lognormal distribution
+        x = np.asarray(x, dtype=float)
+        inside = x > 0
+        x_in = np.where(inside, x, 1)
+        log_x = np.log(x_in / scale)
+        pdf = np.where(inside, np.exp(-log_x ** 2 / (2 * shape ** 2)) / (shape * x_in * np.sqrt(2 * np.pi)), 0)
+        dlog_pdf = np.where(inside, -(1 + log_x / shape ** 2) / x_in, 0)
+        return pdf, dlog_pdf
+
+    @staticmethod
+    def _beta(x, a, b):
+        # density and derivative of the log density of the beta distribution
+        x = np.asarray(x, dtype=float)
+        inside = (x >= 0) & (x <= 1)
+        x_in = np.where(inside, x, 0.5)
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            pdf = np.where(inside, np.exp(special.xlogy(a - 1, x_in) + special.xlog1py(b - 1, -x_in) - special.betaln(a, b)), 0)
+            dlog_pdf = np.where(inside & (x_in > 0) & (x_in < 1), (a - 1) / x_in - (b - 1) / (1 - x_in), 0)
+        return pdf, dlog_pdf
+
+    def _terms(self, p):
+        # densities of the parameters and the derivatives of their log densities
+        terms = [self._lognorm(p[0], *self.Dt_lognorm),
+                 self._beta(p[1], *self.Fp_beta),
+                 self._lognorm(p[2], *self.Dp_lognorm)]
         if len(p) == 4:
-            Dt, Fp, Dp, S0 = p[0], p[1], p[2], p[3]
-        else:
-            Dt, Fp, Dp = p[0], p[1], p[2]
-        # make D*<D very unlikely
-        if (Dp < Dt):
-            return 1e8
-        else:
-            eps = 1e-8
-            Dp_prior = stats.lognorm.pdf(Dp, Dp_shape, scale=Dp_scale)
-            Dt_prior = stats.lognorm.pdf(Dt, Dt_shape, scale=Dt_scale)
-            Fp_prior = stats.beta.pdf(Fp, Fp_a, Fp_b)
-            # determine and return the prior for D, f and D* (and S0)
-            if len(p) == 4:
-                S0_prior = stats.beta.pdf(S0 / 2, S0_a, S0_b)
-                return -np.log(Dp_prior + eps) - np.log(Dt_prior + eps) - np.log(Fp_prior + eps) - np.log(
-                    S0_prior + eps)
-            else:
-                return -np.log(Dp_prior + eps) - np.log(Dt_prior + eps) - np.log(Fp_prior + eps)
+            pdf, dlog_pdf = self._beta(np.asarray(p[3], dtype=float) / 2, *self.S0_beta)
+            terms.append((pdf, dlog_pdf / 2))
+        return terms
+
+    def __call__(self, p):
+        """
+        :param p: parameters D, f, D* and (optionally) S0 along the first axis
+        :return: the negative log prior, a scalar or an array with the shape of p[0]
+        """
+        neg_log_prior = sum(-np.log(pdf + self.eps) for pdf, _ in self._terms(p))
+        neg_log_prior = np.where(np.asarray(p[2]) < np.asarray(p[0]), self.penalty, neg_log_prior)
+        return neg_log_prior[()]
+
+    def gradient(self, p):
+        """
+        :param p: parameters D, f, D* and (optionally) S0 along the first axis
+        :return: the gradient of the negative log prior with respect to p, with the shape of p
+        """
+        swapped = np.asarray(p[2]) < np.asarray(p[0])
+        return np.array([np.where(swapped, 0, -pdf / (pdf + self.eps) * dlog_pdf) for pdf, dlog_pdf in self._terms(p)])
 
-    return neg_log_prior
 
 def neg_log_posterior(p, bvalues, dw_data, neg_log_prior):
     """
@@ -548,6 +615,29 @@ def neg_log_posterior(p, bvalues, dw_data, neg_log_prior):
     return neg_log_likelihood(p, bvalues, dw_data) + neg_log_prior(p)
 
 
+def neg_log_posterior_gradient(p, bvalues, dw_data, neg_log_prior):
+    """
+    This function determines the gradient of neg_log_posterior with respect to the parameters p
+    :param p: 1D Array with the estimates of D, f, D* and (optionally) S0
+    :param bvalues: 1D array with b-values
+    :param dw_data: 1D Array diffusion-weighted data
+    :param neg_log_prior: prior likelihood function with a gradient method (e.g. created with empirical_neg_log_prior)
+    :returns: the gradient of the negative log posterior
+    """
+    Dt, Fp, Dp = p[0], p[1], p[2]
+    S0 = p[3] if len(p) == 4 else 1
+    exp_Dt = np.exp(-bvalues * Dt)
+    exp_Dp = np.exp(-bvalues * Dp)
+    residuals = S0 * (Fp * exp_Dp + (1 - Fp) * exp_Dt) - dw_data
+    # derivatives of the signal with respect to D, f, D* (and S0)
+    jacobian = [-bvalues * S0 * (1 - Fp) * exp_Dt, S0 * (exp_Dp - exp_Dt), -bvalues * S0 * Fp * exp_Dp]
+    if len(p) == 4:
+        jacobian.append(Fp * exp_Dp + (1 - Fp) * exp_Dt)
+    # d/dp of 0.5 * (N + 1) * log(sum(residuals ** 2))
+    gradient = (len(bvalues) + 1) * np.array(jacobian) @ residuals / np.sum(residuals ** 2)
+    return gradient + neg_log_prior.gradient(p)
+
+
 def flat_neg_log_prior(Dt_range, Fp_range, Dp_range, S0_range=None):
     """
     This function determines the negative of the log of the empirical prior probability of the IVIM parameters
@@ -660,10 +750,12 @@ def fit_bayesian(bvalues, dw_data, neg_log_prior, x0=[0.001, 0.2, 0.05, 1], fitS
         # define fit bounds
         bounds = [(bounds[0][0], bounds[1][0]), (bounds[0][1], bounds[1][1]), (bounds[0][2], bounds[1][2]), (bounds[0][3], bounds[1][3])]
         # Find the Maximum a posterior probability (MAP) by minimising the negative log of the posterior
+        # use the analytic gradient if the prior provides one
+        jac = neg_log_posterior_gradient if hasattr(neg_log_prior, "gradient") else None
         if fitS0:
-            params = minimize(neg_log_posterior, x0=x0, args=(bvalues, dw_data, neg_log_prior), bounds=bounds)
+            params = minimize(neg_log_posterior, x0=x0, args=(bvalues, dw_data, neg_log_prior), jac=jac, bounds=bounds)
         else:
-            params = minimize(neg_log_posterior, x0=x0[:3], args=(bvalues, dw_data, neg_log_prior), bounds=bounds[:3])
+            params = minimize(neg_log_posterior, x0=x0[:3], args=(bvalues, dw_data, neg_log_prior), jac=jac, bounds=bounds[:3])
         if not params.success:
             raise RuntimeError(params.message)
         if fitS0:
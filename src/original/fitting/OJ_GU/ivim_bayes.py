@@ -0,0 +1,287 @@
+import numpy as np
+from scipy.special import i0e
+
+def bayes(Y, f, D, Dstar, S0, b, lim, n = 10000, rician = False, prior = None, burns = 1000, thin = 1,
+          meanonly = False, ci = 0.95, voxels_per_run = 1500, rng = None):
+    """
+    Bayesian fitting of the IVIM model with Markov chain Monte Carlo.
+
+    Python port of IVIM_bayes.m. Every voxel runs its own Metropolis-within-Gibbs chain, but the
+    chains of all voxels are advanced simultaneously so that every step is a single array operation.
+
+    Arguments:
+        Y:              v x b matrix with data
+        f:              vector of size v (or scalar) with starting values of f, e.g. from a segmented fit
+        D:              vector of size v (or scalar) with starting values of D [mm2/s]
+        Dstar:          vector of size v (or scalar) with starting values of D* [mm2/s]
+        S0:             vector of size v (or scalar) with starting values of S0
+        b:              vector of size b with b-values [s/mm2]
+        lim:            2 x 4 (2 x 5 if rician) matrix with lower (1st row) and upper (2nd row) limits of
+                        f, D, D*, S0 (and the inverse noise variance if rician)
+        n:              (optional) number of iterations after burn-in
+        rician:         (optional) if True the Rician noise distribution is used, else the Gaussian
+        prior:          (optional) list with the prior of every parameter: 'flat' (uniform), 'reci'
+                        (reciprocal) or 'lognorm' (lognormal, only for D and D*). A lognormal prior can
+                        be given as ('lognorm', mu, s) to use other values than the defaults
+                        (mu = -6 for D and -3.5 for D*, s = 1). Default: flat priors and a reciprocal
+                        prior for the noise variance
+        burns:          (optional) number of burn-in steps
+        thin:           (optional) only every thin-th sample after burn-in is kept
+        meanonly:       (optional) if True only the posterior mean and standard deviation are estimated,
+                        which is substantially more memory efficient
+        ci:             (optional) probability mass of the equal-tailed credible interval
+        voxels_per_run: (optional) number of voxels sampled at once, limits the memory of the chains
+        rng:            (optional) numpy random generator or seed
+
+    Output:
+        out: dict with the keys 'f', 'D', 'Dstar' and 'S0', each a dict with the voxelwise posterior
+             'mean' and 'std' and, unless meanonly, 'median', 'mode', 'ci_low' and 'ci_high'
+    """
+
+    rng = np.random.default_rng(rng)
+    Y = np.atleast_2d(np.asarray(Y, dtype=float))
+    b = np.asarray(b, dtype=float).ravel()
+    if Y.shape[1] != b.size:
+        raise ValueError('Y must have the same number of columns as b')
+    V = Y.shape[0]
+    P = 4 + rician
+
+    lim = np.asarray(lim, dtype=float)
+    if lim.shape != (2, P):
+        raise ValueError(f'lim must be 2x{P}')
+    if prior is None:
+        prior = ['flat', 'flat', 'flat', 'flat', 'reci'][:P]
+    if len(prior) != P:
+        raise ValueError(f'prior must contain {P} entries')
+    prior = [_prior_setup(p, k) for k, p in enumerate(prior)]
+    if thin < 1 or n < thin:
+        raise ValueError('thin must be at least 1 and at most n')
+
+    theta0 = np.zeros((V, P))
+    for k, x in enumerate([f, D, Dstar, S0]):
+        theta0[:, k] = np.broadcast_to(np.asarray(x, dtype=float).ravel(), (V,))
+    if rician:
+        # starting value of the inverse noise variance
+        theta0[:, 4] = b.size / np.sum((Y - _ivim(theta0, b)) ** 2, axis=1)
+
+    names = ['f', 'D', 'Dstar', 'S0']
+    measures = ['mean', 'std'] if meanonly else ['mean', 'std', 'median', 'mode', 'ci_low', 'ci_high']
+    out = {name: {measure: np.zeros(V) for measure in measures} for name in names}
+
+    for start in range(0, V, voxels_per_run):
+        used = slice(start, min(start + voxels_per_run, V))
+        with np.errstate(divide='ignore'): # a perfect fit gives a zero sum of squares
+            summary = _sample(Y[used], theta0[used], b, lim, n, rician, prior, burns, thin, meanonly, ci, rng)
+        for k, name in enumerate(names):
+            for measure in measures:
+                out[name][measure][used] = summary[measure][:, k]
+
+    return out
+
+
+def _sample(Y, theta, b, lim, n, rician, prior, burns, thin, meanonly, ci, rng):
+    """ Run the chains of a block of voxels and summarize the posterior samples. """
+
+    M, P = theta.shape
+    # burn-in parameters
+    burn_update_interval = 100
+    burn_update_fraction = 1 / 2
+    random_block = 100
+
+    w = theta / 10 # step length
+    if rician:
+        w[:, 4] = 0.01
+    N = np.zeros((M, P)) # number of accepted samples
+
+    n_kept = n // thin
+    if meanonly:
+        theta_sum = np.zeros((M, P))
+        theta2_sum = np.zeros((M, P))
+    else:
+        samples = np.zeros((M, P, n_kept))
+
+    # the current state of every chain is cached, so that a proposal for one parameter
+    # only recomputes the part of the signal that depends on it
+    exp_D = np.exp(-theta[:, 1:2] * b)
+    exp_Dstar = np.exp(-theta[:, 2:3] * b)
+    shape = (1 - theta[:, 0:1]) * exp_D + theta[:, 0:1] * exp_Dstar
+    log_lik = _log_likelihood(Y, theta[:, 3:4] * shape, theta, rician)
+
+    for j in range(2, n + burns + 1):
+        i = (j - 2) % random_block
+        if i == 0:
+            # random numbers are drawn for a block of iterations at once
+            steps = rng.standard_normal((random_block, P, M))
+            log_u = np.log(rng.random((random_block, P, M)))
+        # sample each parameter, the others fixed at their current value
+        for k in range(P):
+            x = theta[:, k] + steps[i, k] * w[:, k]
+            # p(theta|lim) and D < D*
+            inside = (x >= lim[0, k]) & (x <= lim[1, k])
+            if k == 1:
+                inside &= x < theta[:, 2]
+            elif k == 2:
+                inside &= theta[:, 1] < x
+            x = np.where(inside, x, theta[:, k]) # rejected below, kept finite here
+
+            f, S0 = theta[:, 0:1], theta[:, 3:4]
+            thetas = theta
+            if k == 0:
+                shape_s = (1 - x[:, np.newaxis]) * exp_D + x[:, np.newaxis] * exp_Dstar
+            elif k == 1:
+                exp_s = np.exp(-x[:, np.newaxis] * b)
+                shape_s = (1 - f) * exp_s + f * exp_Dstar
+            elif k == 2:
+                exp_s = np.exp(-x[:, np.newaxis] * b)
+                shape_s = (1 - f) * exp_D + f * exp_s
+            else:
+                shape_s = shape
+                if k == 4:
+                    thetas = theta.copy()
+                    thetas[:, 4] = x
+            Ss = (x[:, np.newaxis] if k == 3 else S0) * shape_s
+            log_lik_s = _log_likelihood(Y, Ss, thetas, rician)
+
+            log_q = log_lik_s - log_lik
+            if prior[k][0] == 'reci':
+                log_q += np.log(theta[:, k]) - np.log(x)
+            elif prior[k][0] == 'lognorm':
+                log_q += _log_lognorm(x, *prior[k][1:]) - _log_lognorm(theta[:, k], *prior[k][1:])
+
+            sample_ok = inside & (log_u[i, k] < log_q)
+            theta[:, k] = np.where(sample_ok, x, theta[:, k])
+            np.copyto(log_lik, log_lik_s, where=sample_ok)
+            accepted = sample_ok[:, np.newaxis]
+            if k < 4:
+                np.copyto(shape, shape_s, where=accepted)
+            if k == 1:
+                np.copyto(exp_D, exp_s, where=accepted)
+            elif k == 2:
+                np.copyto(exp_Dstar, exp_s, where=accepted)
+            N[:, k] += sample_ok
+
+        # save parameter values after the burn-in phase
+        if j > burns and (j - burns) % thin == 0:
+            index = (j - burns) // thin - 1
+            if index < n_kept:
+                if meanonly:
+                    theta_sum += theta
+                    theta2_sum += theta ** 2
+                else:
+                    samples[:, :, index] = theta
+
+        # adapt step length
+        if j <= burns * burn_update_fraction and j % burn_update_interval == 0:
+            w = w * (burn_update_interval + 1) / (2 * ((burn_update_interval + 1) - N))
+            N = np.zeros((M, P))
+
+    if meanonly:
+        mean = theta_sum / n_kept
+        return {'mean': mean, 'std': np.sqrt(np.maximum(theta2_sum / n_kept - mean ** 2, 0))}
+
+    tail = (1 - ci) / 2
+    return {'mean': np.mean(samples, axis=2),
+            'std': np.std(samples, axis=2),
+            'median': np.median(samples, axis=2),
+            'mode': half_sample_mode(samples),
+            'ci_low': np.quantile(samples, tail, axis=2),
+            'ci_high': np.quantile(samples, 1 - tail, axis=2)}
+
+
+def _ivim(theta, b):
+    """ Bi-exponential signal for the parameters theta = [f, D, D*, S0, ...]. """
+
+    f, D, Dstar, S0 = theta[:, 0:1], theta[:, 1:2], theta[:, 2:3], theta[:, 3:4]
+    return S0 * ((1 - f) * np.exp(-D * b) + f * np.exp(-Dstar * b))
+
+
+def _log_likelihood(Y, S, theta, rician):
+    """
+    Log-likelihood of the data given the signal S, up to a constant.
+
+    For Gaussian noise the noise variance is marginalized, which leaves -b/2 log(sum of squares).
+    For Rician noise the inverse noise variance is the 5th parameter in theta.
+    """
+
+    Nb = Y.shape[1]
+    if rician: # rician noise distribution
+        is2 = theta[:, 4:5]
+        return Nb * np.log(is2[:, 0]) + (-0.5 * is2 * (Y ** 2 + S ** 2) + _log_I0(Y * S * is2)).sum(axis=1)
+    # gaussian noise distribution
+    return -Nb / 2 * np.log(((Y - S) ** 2).sum(axis=1))
+
+
+def _prior_setup(prior, k):
+    """ Return the prior of parameter k as a tuple (name, *parameters). """
+
+    if isinstance(prior, str):
+        prior = (prior,)
+    prior = tuple(prior)
+    if prior[0] == 'lognorm':
+        if k not in (1, 2):
+            raise ValueError('lognorm prior not available') # only for D and D*
+        if len(prior) == 1:
+            prior = ('lognorm', -6, 1) if k == 1 else ('lognorm', -3.5, 1)
+    elif prior[0] not in ('flat', 'reci'):
+        raise ValueError('unknown prior')
+    return prior
+
+
+def lognorm_prior(x, valid_range = (1e-8, 1)):
+    """
+    Return an empirical lognormal prior from parameter estimates, e.g. from a segmented fit.
+
+    Arguments:
+        x:           array with estimates of D or D* in different voxels
+        valid_range: (optional) only the estimates within this range are used
+
+    Output:
+        prior: ('lognorm', mu, s) to be used in the prior argument of bayes
+    """
+
+    x = np.asarray(x, dtype=float).ravel()
+    x = x[np.isfinite(x) & (x > valid_range[0]) & (x < valid_range[1])]
+    if x.size < 2:
+        raise ValueError('at least two valid estimates are needed for an empirical prior')
+    log_x = np.log(x)
+    return ('lognorm', np.mean(log_x), np.std(log_x))
+
+
+def _log_lognorm(x, mu, s):
+    return -np.log(s * np.sqrt(2 * np.pi) * x) - (np.log(x) - mu) ** 2 / (2 * s ** 2)
+
+
+def _log_I0(x):
+    """ Natural log of the 0th order modified Bessel function of the first kind. """
+
+    x = np.abs(x)
+    return np.log(i0e(x)) + x
+
+
+def half_sample_mode(X):
+    """
+    Return the half sample mode along the last axis of X.
+
+    Arguments:
+        X:   array with samples in the last dimension
+
+    Output:
+        hsm: array with the half sample mode of every row of X
+    """
+
+    X = np.sort(X, axis=-1)
+    while X.shape[-1] > 3:
+        # keep the window of half the samples with the smallest range
+        N = int(np.ceil(X.shape[-1] / 2))
+        w = X[..., N - 1:] - X[..., :X.shape[-1] - N + 1]
+        j = np.argmin(w, axis=-1)
+        X = np.take_along_axis(X, j[..., np.newaxis] + np.arange(N), axis=-1)
+
+    if X.shape[-1] == 1:
+        return X[..., 0]
+    if X.shape[-1] == 2:
+        return np.sum(X, axis=-1) / 2
+    lower = X[..., 1] - X[..., 0]
+    upper = X[..., 2] - X[..., 1]
+    return np.where(lower < upper, (X[..., 0] + X[..., 1]) / 2,
+                    np.where(lower == upper, X[..., 1], (X[..., 1] + X[..., 2]) / 2))
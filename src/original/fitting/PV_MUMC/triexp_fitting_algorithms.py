@@ -18,6 +18,7 @@ import numpy as np
 from joblib import Parallel, delayed
 import tqdm
 import warnings
+from utilities.ivim.ivim_models import triexp_jacobian, monoexp_jacobian
 
 #constants
 #relaxation times and acquisition parameters, which are required when accounting for inversion recovery
@@ -30,6 +31,10 @@ isfT1 =  1250 # ms [Wong et al. JMRI (2020)]
 echotime = 84 # ms
 repetitiontime = 6800 # ms
 inversiontime = 2230 # ms
+#relative signal of the tissue, interstitial fluid and blood compartment after inversion recovery
+IR_weights = ((1 - 2*np.exp(-inversiontime/tissueT1) + np.exp(-repetitiontime/tissueT1)) * np.exp(-echotime/tissueT2),
+              (1 - 2*np.exp(-inversiontime/isfT1) + np.exp(-repetitiontime/isfT1)) * np.exp(-echotime/isfT2),
+              (1 - np.exp(-repetitiontime/bloodT1)) * np.exp(-echotime/bloodT2))
 
 
 def tri_expN_noS0_IR(bvalues, Dpar, Fint, Dint, Fmv, Dmv):
@@ -58,6 +63,22 @@ def tri_expN(bvalues, S0, Dpar, Fint, Dint, Fmv, Dmv):
     """ tri-exponential IVIM function"""
     return S0 * (Fmv * np.exp(-bvalues * Dmv) + Fint * np.exp(-bvalues * Dint) + (1 - Fmv - Fint) * np.exp(-bvalues * Dpar))
 
+def tri_expN_noS0_IR_jacobian(bvalues, Dpar, Fint, Dint, Fmv, Dmv):
+    """ analytic Jacobian of tri_expN_noS0_IR"""
+    return triexp_jacobian(bvalues, Dpar, Fint, Dint, Fmv, Dmv, weights=IR_weights)
+
+def tri_expN_IR_jacobian(bvalues, S0, Dpar, Fint, Dint, Fmv, Dmv):
+    """ analytic Jacobian of tri_expN_IR"""
+    return triexp_jacobian(bvalues, Dpar, Fint, Dint, Fmv, Dmv, S0, weights=IR_weights)[:, [5, 0, 1, 2, 3, 4]]
+
+def tri_expN_noS0_jacobian(bvalues, Dpar, Fint, Dint, Fmv, Dmv):
+    """ analytic Jacobian of tri_expN_noS0"""
+    return triexp_jacobian(bvalues, Dpar, Fint, Dint, Fmv, Dmv)
+
+def tri_expN_jacobian(bvalues, S0, Dpar, Fint, Dint, Fmv, Dmv):
+    """ analytic Jacobian of tri_expN"""
+    return triexp_jacobian(bvalues, Dpar, Fint, Dint, Fmv, Dmv, S0)[:, [5, 0, 1, 2, 3, 4]]
+
 def fit_least_squares_tri_exp(bvalues, dw_data, IR=False, S0_output=False, fitS0=False,
                       bounds=([0.9, 0.0001, 0.0, 0.0015, 0.0, 0.004], [1.1, 0.0015, 0.4, 0.004, 0.2, 0.2]), cutoff=200):
     """
@@ -84,20 +105,23 @@ def fit_least_squares_tri_exp(bvalues, dw_data, IR=False, S0_output=False, fitS0
     high_b = bvalues[bvalues >= cutoff]
     high_dw_data = dw_data[bvalues >= cutoff]
     boundspar = ([0, 0], [bounds[1][1], bounds[1][5]])
-    params, _ = curve_fit(monofit, high_b, high_dw_data, p0=[(bounds[1][1]-bounds[0][1])/2, 0.05], bounds=boundspar)
+    def monofit_jacobian(bvalues, Dpar, Fp):
+        return monoexp_jacobian(bvalues, Dpar, 1-Fp) * [1, -1]
+
+    params, _ = curve_fit(monofit, high_b, high_dw_data, p0=[(bounds[1][1]-bounds[0][1])/2, 0.05], bounds=boundspar, jac=monofit_jacobian)
     Dpar1 = params[0]
     if IR:
         if not fitS0:
             bounds = ([bounds[0][1] , bounds[0][2] , bounds[0][3] , bounds[0][4] , bounds[0][5] ],
                         [Dpar1          , bounds[1][2] , bounds[1][3] , bounds[1][4] , bounds[1][5] ])      
-            params, _ = curve_fit(tri_expN_noS0_IR, bvalues, dw_data, p0=[Dpar1, 0.0, (bounds[0][3]+bounds[1][3])/2, 0.05, (bounds[0][5]+bounds[1][5])/2], bounds=bounds)
+            params, _ = curve_fit(tri_expN_noS0_IR, bvalues, dw_data, p0=[Dpar1, 0.0, (bounds[0][3]+bounds[1][3])/2, 0.05, (bounds[0][5]+bounds[1][5])/2], bounds=bounds, jac=tri_expN_noS0_IR_jacobian)
             Dpar, Fint, Dint, Fmv, Dmv = params[0], params[1], params[2], params[3], params[4]
             #when the fraction of a compartment equals zero (or very very small), the corresponding diffusivity is non-existing (=NaN)
             
         else:
             boundsupdated = ([bounds[0][0] , bounds[0][1] , bounds[0][2] , bounds[0][3] , bounds[0][4] , bounds[0][5] ],
                         [bounds[1][0] , Dpar1 , bounds[1][2] , bounds[1][3] , bounds[1][4] , bounds[1][5] ])
-            params, _ = curve_fit(tri_expN_IR, bvalues, dw_data, p0=[1, Dpar1, 0.0, (bounds[0][3]+bounds[1][3])/2, 0.05, (bounds[0][5]+bounds[1][5])/2], bounds=boundsupdated)
+            params, _ = curve_fit(tri_expN_IR, bvalues, dw_data, p0=[1, Dpar1, 0.0, (bounds[0][3]+bounds[1][3])/2, 0.05, (bounds[0][5]+bounds[1][5])/2], bounds=boundsupdated, jac=tri_expN_IR_jacobian)
             S0 = params[0]
             Dpar, Fint, Dint, Fmv, Dmv = params[1] , params[2] , params[3] , params[4] , params[5] 
             #when the fraction of a compartment equals zero (or very very small), the corresponding diffusivity is non-existing (=NaN)
@@ -106,14 +130,14 @@ def fit_least_squares_tri_exp(bvalues, dw_data, IR=False, S0_output=False, fitS0
         if not fitS0:
             bounds = ([bounds[0][1] , bounds[0][2] , bounds[0][3] , bounds[0][4] , bounds[0][5] ],
                         [Dpar1          , bounds[1][2] , bounds[1][3] , bounds[1][4] , bounds[1][5] ])      
-            params, _ = curve_fit(tri_expN_noS0, bvalues, dw_data, p0=[Dpar1, 0.0, (bounds[0][3]+bounds[1][3])/2, 0.05, (bounds[0][5]+bounds[1][5])/2], bounds=bounds)
+            params, _ = curve_fit(tri_expN_noS0, bvalues, dw_data, p0=[Dpar1, 0.0, (bounds[0][3]+bounds[1][3])/2, 0.05, (bounds[0][5]+bounds[1][5])/2], bounds=bounds, jac=tri_expN_noS0_jacobian)
             Dpar, Fint, Dint, Fmv, Dmv = params[0], params[1], params[2], params[3], params[4]
             #when the fraction of a compartment equals zero (or very very small), the corresponding diffusivity is non-existing (=NaN)
 
         else:
             boundsupdated = ([bounds[0][0] , bounds[0][1] , bounds[0][2] , bounds[0][3] , bounds[0][4] , bounds[0][5] ],
                         [bounds[1][0] , Dpar1 , bounds[1][2] , bounds[1][3] , bounds[1][4] , bounds[1][5] ])
-            params, _ = curve_fit(tri_expN, bvalues, dw_data, p0=[1, Dpar1, 0.0, (bounds[0][3]+bounds[1][3])/2, 0.05, (bounds[0][5]+bounds[1][5])/2], bounds=boundsupdated)
+            params, _ = curve_fit(tri_expN, bvalues, dw_data, p0=[1, Dpar1, 0.0, (bounds[0][3]+bounds[1][3])/2, 0.05, (bounds[0][5]+bounds[1][5])/2], bounds=boundsupdated, jac=tri_expN_jacobian)
             S0 = params[0]
             Dpar, Fint, Dint, Fmv, Dmv = params[1] , params[2] , params[3] , params[4] , params[5] 
             #when the fraction of a compartment equals zero (or very very small), the corresponding diffusivity is non-existing (=NaN)
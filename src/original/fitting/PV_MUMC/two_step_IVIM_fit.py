@@ -13,6 +13,7 @@ scipy
 from scipy.optimize import curve_fit
 import numpy as np
 import tqdm
+from utilities.ivim.ivim_models import biexp_jacobian, monoexp_jacobian
 
 
 
@@ -77,12 +78,16 @@ def fit_least_squares(bvalues, dw_data, S0_output=False, fitS0=False,
     high_b = bvalues[bvalues >= cutoff]
     high_dw_data = dw_data[bvalues >= cutoff]
     boundsmonoexp = ([bounds[0][1], bounds[0][2]], [bounds[1][1], bounds[1][2]])
-    params, _ = curve_fit(monofit, high_b, high_dw_data, p0=[(bounds[1][1]+bounds[0][1])/2,(bounds[1][2]+bounds[0][2])/2], bounds=boundsmonoexp)
+    def monofit_jacobian(bvalues, Dpar, Fmv):
+        return monoexp_jacobian(bvalues, Dpar, 1-Fmv) * [1, -1]
+
+    params, _ = curve_fit(monofit, high_b, high_dw_data, p0=[(bounds[1][1]+bounds[0][1])/2,(bounds[1][2]+bounds[0][2])/2], bounds=boundsmonoexp, jac=monofit_jacobian)
     Dpar1 = params[0]
     if not fitS0:
         boundsupdated=([bounds[0][2] , bounds[0][3] ],
                     [bounds[1][2] , bounds[1][3] ])
-        params, _ = curve_fit(lambda b, Fmv, Dmv: two_exp_noS0(b, Dpar1, Fmv, Dmv), bvalues, dw_data, p0=[(bounds[0][2]+bounds[1][2])/2, (bounds[0][3]+bounds[1][3])/2], bounds=boundsupdated)
+        params, _ = curve_fit(lambda b, Fmv, Dmv: two_exp_noS0(b, Dpar1, Fmv, Dmv), bvalues, dw_data, p0=[(bounds[0][2]+bounds[1][2])/2, (bounds[0][3]+bounds[1][3])/2], bounds=boundsupdated,
+                              jac=lambda b, Fmv, Dmv: biexp_jacobian(b, Dpar1, Fmv, Dmv)[:, 1:])
         Fmv, Dmv = params[0], params[1]
         #when the fraction of a compartment equals zero (or very very small), the corresponding diffusivity is non-existing (=NaN)
         #if Fmv < 1e-4:
@@ -91,7 +96,8 @@ def fit_least_squares(bvalues, dw_data, S0_output=False, fitS0=False,
     else:
         boundsupdated = ([bounds[0][0] , bounds[0][2] , bounds[0][3] ],
                     [bounds[1][0] , bounds[1][2] , bounds[1][3] ])
-        params, _ = curve_fit(lambda b, S0, Fmv, Dmv: two_exp(b, S0, Dpar1, Fmv, Dmv), bvalues, dw_data, p0=[1, (bounds[0][2]+bounds[1][2])/2, (bounds[0][3]+bounds[1][3])/2], bounds=boundsupdated)
+        params, _ = curve_fit(lambda b, S0, Fmv, Dmv: two_exp(b, S0, Dpar1, Fmv, Dmv), bvalues, dw_data, p0=[1, (bounds[0][2]+bounds[1][2])/2, (bounds[0][3]+bounds[1][3])/2], bounds=boundsupdated,
+                              jac=lambda b, S0, Fmv, Dmv: biexp_jacobian(b, Dpar1, Fmv, Dmv, S0)[:, [3, 1, 2]])
         S0 = params[0]
         Fmv, Dmv = params[1] , params[2]
         #when the fraction of a compartment equals zero (or very very small), the corresponding diffusivity is non-existing (=NaN)
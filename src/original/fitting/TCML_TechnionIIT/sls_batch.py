@@ -0,0 +1,46 @@
+import numpy as np
+from super_ivim_dc.source.Classsic_ivim_fit import IVIM_fit_sls
+
+
+def fit_sls_refined_batch(signals, bvalues, bounds, min_bval_high, refine, eps=None):
+    """
+    Batched counterpart of the IVIM_fit_sls_lm/trf/BOBYQA pipelines of super_ivim_dc: the SLS fit initializes all
+    voxels at once, after which refine fits every voxel from its own initialization.
+
+    The super_ivim_dc pipelines return neither the voxels the SLS fit failed on nor which voxel a failed refinement
+    belongs to, and once the SLS fit fails on a voxel they start the next voxels from the D, f and S0 of another
+    voxel. Here every voxel keeps its own initialization, so it gets the result of fitting it on its own.
+
+    Args:
+        signals: voxels x b-values matrix
+        bvalues: b-values
+        bounds: ([D, D*, f, S0] lower bounds, [D, D*, f, S0] upper bounds)
+        min_bval_high: threshold b-value of the mono-exponential fit of the SLS fit
+        refine: fit of one voxel, called as refine(bvalues, signal, p0) with a signal of shape (b-values, 1), that
+            returns (D, D*, f, S0, failed) like the fit_least_squares_* functions of super_ivim_dc
+        eps: if set, initial values outside the bounds are moved inside them by this relative margin, as the bounded
+            pipelines do
+
+    Returns:
+        dict: "D", "f" and "Dp" arrays of length voxels; voxels whose SLS fit or refinement failed are 0
+    """
+    signals = np.asarray(signals, dtype=float)
+    D_sls, DStar_sls, f_sls, s0_sls, _, failed_sls = IVIM_fit_sls(signals.T, bvalues, bounds, min_bval_high)
+    lower, upper = np.array(bounds)
+    results = {key: np.zeros(len(signals)) for key in ["D", "f", "Dp"]}
+    # D* is only returned for the voxels the SLS fit succeeded on
+    for DStar, i in zip(DStar_sls, np.delete(np.arange(len(signals)), failed_sls)):
+        p0 = [D_sls[i], DStar, f_sls[i], s0_sls[i]]
+        if eps is not None:
+            for j, value in enumerate(p0):
+                if value < lower[j]:
+                    p0[j] = lower[j] * (1 + eps)
+                elif value > upper[j]:
+                    p0[j] = upper[j] * (1 - eps)
+        try:
+            D, DStar, f, _, failed = refine(bvalues, signals[i, :, np.newaxis], p0)
+        except Exception:
+            continue
+        if not failed:
+            results["D"][i], results["f"][i], results["Dp"][i] = D[0], f[0], DStar[0]
+    return results
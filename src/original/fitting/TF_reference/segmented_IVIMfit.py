@@ -9,6 +9,7 @@ First fit D using a WLLS
 import numpy as np
 import statsmodels.api as sm
 import scipy
+from utilities.ivim.ivim_models import biexp_jacobian, weighted_linreg
 
 def ivim_biexp(bvalues, D, f, Dp, S0=1):
     return (S0 * (f * np.exp(-bvalues * Dp) + (1 - f) * np.exp(-bvalues * D)))
@@ -36,6 +37,7 @@ def segmented_IVIM_fit(bvalues, dw_data, b_cutoff = 200, bounds=([0.0001, 0.0, 0
 
     Dp = scipy.optimize.least_squares(
     fun=lambda Dp: ivim_biexp(bvalues, D, f, Dp[0]) - dw_data,
+    jac=lambda Dp: biexp_jacobian(bvalues, D, f, Dp[0])[:, 2:],
     x0=np.clip(D * 10, bounds[0][2], bounds[1][2]), # Initial guess for D*
     bounds=(bounds[0][2], bounds[1][2]))
 
@@ -76,4 +78,166 @@ def d_fit_iterative_wls(bvalues_D, log_signal, max_iter=50):
 
     ln_b0_intercept, D  = results.params
     b0_intercept = np.exp(ln_b0_intercept)
-    return D, b0_intercept
\ No newline at end of file
+    return D, b0_intercept
+
+def segmented_IVIM_fit_array(bvalues, dw_data, b_cutoff=200, bounds=([0.0001, 0.0, 0.001], [0.004, 0.7, 0.01]), max_iter=50, tol=1e-8):
+    """
+        Vectorized version of segmented_IVIM_fit for many voxels at once.
+        D is fitted with the iterative WLLS of d_fit_iterative_wls_array on all voxels simultaneously,
+        f follows from the b=0 intercept relative to the signal at the lowest b-value, and D* is fitted with a bounded 1-D least-squares solve
+        (d_star_fit_array) that runs on all voxels simultaneously.
+
+    Parameters:
+    bvalues: 1D array with the b-values
+
+    dw_data: 2D array (voxels x b-values) with the signal, normalised to the signal at the lowest b-value
+
+    b_cutoff: the b-value threshold for the D fit
+
+    bounds: fit bounds ([Dmin, fmin, D*min, ...], [Dmax, fmax, D*max, ...])
+
+    max_iter: the maximum number of iterations for the WLS
+
+    tol: the relative change in the WLS parameters below which a voxel is considered converged
+
+    Returns:
+    D, f, Dp: 1D arrays with the fitted parameters
+
+    n_iter: 1D array with the number of WLS iterations performed per voxel
+    """
+    bvalues = np.asarray(bvalues, dtype=float)
+    dw_data = np.atleast_2d(np.asarray(dw_data, dtype=float))
+
+    bvalues_D = bvalues[bvalues >= b_cutoff]
+    dw_data_D = dw_data[:, bvalues >= b_cutoff]
+    dw_data_D = np.clip(dw_data_D, 1e-6, None) # ensure we do not get 0 or negative values that cause nans/infs
+    log_data_D = np.log(dw_data_D)
+
+    D, b0_intercept, n_iter = d_fit_iterative_wls_array(bvalues_D, log_data_D, max_iter=max_iter, tol=tol)
+
+    D = np.clip(D, bounds[0][0], bounds[1][0])
+    S0 = np.mean(dw_data[:, bvalues == np.min(bvalues)], axis=1)
+    f = (S0 - b0_intercept) / S0
+    f = np.clip(f, bounds[0][1], bounds[1][1])
+
+    Dp = d_star_fit_array(bvalues, dw_data, D, f,
+                          x0=np.clip(D * 10, bounds[0][2], bounds[1][2]), # Initial guess for D*
+                          bounds=(bounds[0][2], bounds[1][2]))
+
+    return D, f, Dp, n_iter
+
+
+def d_fit_iterative_wls_array(bvalues_D, log_signal, max_iter=50, tol=1e-8):
+    """
+    Vectorized version of d_fit_iterative_wls. The weighted normal equations are solved in closed form
+    for all voxels simultaneously. Voxels stop iterating once the relative change in both parameters
+    drops below tol, so converged voxels do not pay for the remaining iterations.
+
+    Parameters:
+    log_signal: 2D array (voxels x b-values) with the log() of the signal above the threshold for segmented fitting
+
+    bvalues_D: all bvalues above the threshold for fitting D
+
+    max_iter: the maximum number of iterations for WLS
+
+    tol: the relative change in the parameters below which a voxel is considered converged
+
+    Returns:
+    D, b0_intercept: 1D arrays with the fitted D and the extrapolated signal at b=0
+
+    n_iter: 1D array with the number of WLS iterations performed per voxel
+    """
+    x = -np.asarray(bvalues_D, dtype=float)
+    n_voxels = log_signal.shape[0]
+
+    # First do a LLS to initialize the weights
+    ln_b0_intercept, D = weighted_linreg(x, log_signal, np.ones_like(log_signal))
+    n_iter = np.zeros(n_voxels, dtype=int)
+
+    active = np.isfinite(ln_b0_intercept) & np.isfinite(D)
+    for i in range(max_iter):
+        if not np.any(active):
+            break
+        idx = np.flatnonzero(active)
+        # The weights are based on the predicted signal of the previous iteration
+        weights = np.exp(2 * (ln_b0_intercept[idx, np.newaxis] + D[idx, np.newaxis] * x))
+        new_intercept, new_D = weighted_linreg(x, log_signal[idx], weights)
+
+        converged = ((np.abs(new_intercept - ln_b0_intercept[idx]) <= tol * np.abs(new_intercept)) &
+                     (np.abs(new_D - D[idx]) <= tol * np.abs(new_D)))
+        ln_b0_intercept[idx], D[idx] = new_intercept, new_D
+        n_iter[idx] += 1
+        active[idx[converged | ~np.isfinite(new_D)]] = False
+
+    b0_intercept = np.exp(ln_b0_intercept)
+    return D, b0_intercept, n_iter
+
+
+def d_star_fit_array(bvalues, dw_data, D, f, x0, bounds, max_iter=100, xtol=1e-8):
+    """
+    Bounded 1-D least-squares fit of D* with D and f fixed, for all voxels simultaneously.
+    This is a projected Gauss-Newton iteration with step halving, so every voxel converges to the
+    same local minimum as the per-voxel scipy.optimize.least_squares started from x0.
+
+    Parameters:
+    bvalues: 1D array with the b-values
+
+    dw_data: 2D array (voxels x b-values) with the signal
+
+    D, f: 1D arrays with the fixed D and f
+
+    x0: 1D array with the initial guess for D*
+
+    bounds: (lower, upper) bound for D*
+
+    max_iter: the maximum number of Gauss-Newton iterations
+
+    xtol: the relative step size below which a voxel is considered converged
+
+    Returns:
+    Dp: 1D array with the fitted D*
+    """
+    diffusion = (1 - f)[:, np.newaxis] * np.exp(-np.outer(D, bvalues))
+    target = dw_data - diffusion
+    fb = f[:, np.newaxis] * bvalues
+
+    def cost(Dp, idx):
+        return np.sum((f[idx, np.newaxis] * np.exp(-np.outer(Dp, bvalues)) - target[idx]) ** 2, axis=-1)
+
+    Dp = np.array(x0, dtype=float)
+    all_idx = np.arange(len(Dp))
+    current_cost = cost(Dp, all_idx)
+    active = np.isfinite(current_cost)
+    for i in range(max_iter):
+        if not np.any(active):
+            break
+        idx = np.flatnonzero(active)
+        perfusion = np.exp(-np.outer(Dp[idx], bvalues))
+        residual = f[idx, np.newaxis] * perfusion - target[idx]
+        jacobian = -fb[idx] * perfusion
+        gradient = np.sum(jacobian * residual, axis=-1)
+        hessian = np.sum(jacobian ** 2, axis=-1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            step = np.where(hessian > 0, -gradient / hessian, 0)
+
+        # step halving until the cost does not increase
+        accepted = np.zeros(len(idx), dtype=bool)
+        new_Dp = Dp[idx]
+        new_cost = current_cost[idx]
+        for _ in range(30):
+            trial = np.clip(Dp[idx] + step, bounds[0], bounds[1])
+            trial_cost = cost(trial, idx)
+            better = ~accepted & (trial_cost <= current_cost[idx])
+            new_Dp = np.where(better, trial, new_Dp)
+            new_cost = np.where(better, trial_cost, new_cost)
+            accepted |= better
+            if np.all(accepted):
+                break
+            step = np.where(accepted, step, step / 2)
+
+        converged = ~accepted | (np.abs(new_Dp - Dp[idx]) <= xtol * (xtol + np.abs(new_Dp)))
+        Dp[idx] = new_Dp
+        current_cost[idx] = new_cost
+        active[idx[converged]] = False
+
+    return Dp
@@ -1,5 +1,5 @@
 from src.wrappers.OsipiBase import OsipiBase
-from src.original.fitting.DT_IIITN.wls_ivim_fitting import wls_ivim_fit
+from src.original.fitting.DT_IIITN.wls_ivim_fitting import wls_ivim_fit, wls_ivim_fit_array
 import numpy as np
 
 
@@ -45,9 +45,10 @@ class DT_IIITN_WLS(OsipiBase):
     supported_thresholds = True
     supported_dimensions = 1
     supported_priors = False
+    supported_engine = True
 
     def __init__(self, bvalues=None, thresholds=None,
-                 bounds=None, initial_guess=None, method="WLS"):
+                 bounds=None, initial_guess=None, method="WLS", engine=None):
         """
         Initialize the IVIM fitting algorithm.
 
@@ -59,12 +60,17 @@ class DT_IIITN_WLS(OsipiBase):
             bounds (dict, optional): Not used by this algorithm.
             initial_guess (dict, optional): Not used by this algorithm.
             method (str): Regression method — "WLS" (default) or "RLM".
+            engine (str, optional): Fit the WLS regressions with the compiled
+                kernel of utilities.ivim.kernels ("auto", "numba" or
+                "numpy"). Only for method="WLS".
         """
         super(DT_IIITN_WLS, self).__init__(
             bvalues=bvalues, bounds=bounds,
-            initial_guess=initial_guess, thresholds=thresholds
+            initial_guess=initial_guess, thresholds=thresholds, engine=engine
         )
         self.method = method.upper()
+        if self.engine is not None and self.method != "WLS":
+            raise ValueError("The kernel engine only supports method 'WLS'.")
 
     def ivim_fit(self, signals, **kwargs):
         """Perform the IVIM fit using the selected method (WLS or RLM).
@@ -80,8 +86,13 @@ class DT_IIITN_WLS(OsipiBase):
         if self.thresholds is not None and len(self.thresholds) > 0:
             cutoff = self.thresholds[0]
 
-        D, f, Dp = wls_ivim_fit(self.bvalues, signals, cutoff=cutoff,
-                                method=self.method)
+        if self.engine is not None:
+            D, f, Dp = (float(value[0]) for value in wls_ivim_fit_array(
+                self.bvalues, np.asarray(signals, dtype=float)[np.newaxis, :],
+                cutoff=cutoff, method=self.method, engine=self.engine))
+        else:
+            D, f, Dp = wls_ivim_fit(self.bvalues, signals, cutoff=cutoff,
+                                    method=self.method)
 
         results = {}
         results["D"] = D
@@ -89,3 +100,34 @@ class DT_IIITN_WLS(OsipiBase):
         results["Dp"] = Dp
 
         return results
+
+    def ivim_fit_full_volume(self, signals, **kwargs):
+        """Perform the IVIM fit on a full volume using the vectorized engine.
+
+        All voxels are fitted at once: the WLS normal equations are solved in
+        closed form and the RLM variant uses a batched IRLS with per-voxel
+        convergence.
+
+        Args:
+            signals (array-like): Signal intensities with the b-values in the
+                last dimension.
+
+        Returns:
+            dict: Dictionary with keys "D", "f", "Dp", each an array with the
+            spatial shape of the input.
+        """
+        cutoff = 200
+        if self.thresholds is not None and len(self.thresholds) > 0:
+            cutoff = self.thresholds[0]
+
+        signals = np.asarray(signals)
+        shape = signals.shape[:-1]
+        D, f, Dp = wls_ivim_fit_array(self.bvalues, signals.reshape(-1, signals.shape[-1]),
+                                      cutoff=cutoff, method=self.method, engine=self.engine)
+
+        results = {}
+        results["D"] = D.reshape(shape)
+        results["f"] = f.reshape(shape)
+        results["Dp"] = Dp.reshape(shape)
+
+        return results
@@ -105,11 +105,12 @@ class IAR_LU_biexp(OsipiBase):
         return results
 
 
-    def ivim_fit_full_volume(self, signals, **kwargs):
+    def ivim_fit_full_volume(self, signals, njobs=1, **kwargs):
         """Perform the IVIM fit
 
         Args:
             signals (array-like)
+            njobs (int, optional): number of parallel jobs over chunks of voxels
 
         Returns:
             _type_: _description_
@@ -127,7 +128,7 @@ class IAR_LU_biexp(OsipiBase):
             self.IAR_algorithm = IvimModelBiExp(gtab, bounds=bounds, initial_guess=initial_guess)
         b0_index = np.where(self.bvalues == 0)[0][0]
         mask = signals[...,b0_index]>0
-        fit_results = self.IAR_algorithm.fit(signals, mask=mask)
+        fit_results = self.IAR_algorithm.fit(signals, mask=mask, njobs=njobs)
         
         results = {}
         results["f"] = fit_results.model_params[..., 1]
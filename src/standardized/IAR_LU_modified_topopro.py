@@ -105,4 +105,51 @@ class IAR_LU_modified_topopro(OsipiBase):
         results["D"] = fit_results.model_params[3]
         results = self.D_and_Ds_swap(results)
 
-        return results
\ No newline at end of file
+        return results
+
+    def ivim_fit_batch(self, signals, grid_size=(64, 64), **kwargs):
+        """Perform the IVIM fit on a batch of voxels at once
+
+        Uses the grid-seeded batched engine of the algorithm, which replaces
+        the two SHGO searches per voxel by a lookup on cached exponential
+        bases and a batched least squares refinement.
+
+        Args:
+            signals (array-like): voxels x b-values matrix
+            grid_size (tuple of int, optional): number of D* and D grid points
+
+        Returns:
+            dict: parameter arrays of length voxels
+        """
+        if self.IAR_algorithm is None:
+            bounds = [[self.bounds["f"][0], self.bounds["Dp"][0]*1000, self.bounds["D"][0]*1000], 
+                      [self.bounds["f"][1], self.bounds["Dp"][1]*1000, self.bounds["D"][1]*1000]]
+            bvec = np.zeros((self.bvalues.size, 3))
+            bvec[:,2] = 1
+            gtab = gradient_table(self.bvalues, bvecs=bvec, b0_threshold=0)
+            
+            self.IAR_algorithm = IvimModelTopoPro(gtab, bounds=bounds, rescale_results_to_mm2_s=True)
+
+        model_params = self.IAR_algorithm.fit_batch(signals, grid_size=grid_size)
+
+        results = {}
+        results["f"] = model_params[:, 1]
+        results["Dp"] = model_params[:, 2]
+        results["D"] = model_params[:, 3]
+        results = self.D_and_Ds_swap(results)
+
+        return results
+
+    def ivim_fit_full_volume(self, signals, chunk_size=None, **kwargs):
+        """Perform the IVIM fit on a full volume
+
+        Voxels are fitted in masked, memory-bounded chunks with ivim_fit_batch.
+
+        Args:
+            signals (array-like): volume with the b-values in the last dimension
+            chunk_size (int, optional): number of voxels fitted per chunk
+
+        Returns:
+            dict: parameter maps with the spatial shape of signals
+        """
+        return self.osipi_fit_chunked(signals, chunk_size=chunk_size, **kwargs)
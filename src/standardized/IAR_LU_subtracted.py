@@ -108,4 +108,50 @@ class IAR_LU_subtracted(OsipiBase):
         results["Dp"] = fit_results.model_params[2]
         results["D"] = fit_results.model_params[3]
         
-        return results
\ No newline at end of file
+        return results
+
+    def ivim_fit_batch(self, signals, **kwargs):
+        """Perform the IVIM fit on a batch of voxels at once
+
+        Uses the array-native version of the algorithm, which fits all voxels
+        simultaneously.
+
+        Args:
+            signals (array-like): voxels x b-values matrix
+
+        Returns:
+            dict: parameter arrays of length voxels
+        """
+        if self.IAR_algorithm is None:
+            bounds = [[self.bounds["S0"][0], self.bounds["f"][0], self.bounds["Dp"][0], self.bounds["D"][0]], \
+                      [self.bounds["S0"][1], self.bounds["f"][1], self.bounds["Dp"][1], self.bounds["D"][1]]]
+            initial_guess = [self.initial_guess["S0"], self.initial_guess["f"], self.initial_guess["Dp"], self.initial_guess["D"]]
+
+            bvec = np.zeros((self.bvalues.size, 3))
+            bvec[:,2] = 1
+            gtab = gradient_table(self.bvalues, bvecs=bvec, b0_threshold=0)
+
+            self.IAR_algorithm = IvimModelSubtracted(gtab, bounds=bounds, initial_guess=initial_guess)
+
+        model_params = self.IAR_algorithm.fit_batch(signals)
+
+        results = {}
+        results["f"] = model_params[:, 1]
+        results["Dp"] = model_params[:, 2]
+        results["D"] = model_params[:, 3]
+
+        return results
+
+    def ivim_fit_full_volume(self, signals, chunk_size=None, **kwargs):
+        """Perform the IVIM fit on a full volume
+
+        Voxels are fitted in masked, memory-bounded chunks with ivim_fit_batch.
+
+        Args:
+            signals (array-like): volume with the b-values in the last dimension
+            chunk_size (int, optional): number of voxels fitted per chunk
+
+        Returns:
+            dict: parameter maps with the spatial shape of signals
+        """
+        return self.osipi_fit_chunked(signals, chunk_size=chunk_size, **kwargs)
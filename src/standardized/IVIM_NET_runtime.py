@@ -0,0 +1,78 @@
+from src.wrappers.OsipiBase import OsipiBase
+import numpy as np
+from utilities.ivim.network_runtime import NetworkRunner
+
+
+class IVIM_NET_runtime(OsipiBase):
+    """
+    CPU inference of an IVIM_NEToptim or Super_IVIM_DC network exported with their export method, using ONNX Runtime
+    or TorchScript without importing the training packages
+    """
+
+    # Some basic stuff that identifies the algorithm
+    id_author = "Oliver Gurney Champion, Amsterdam UMC; Moti Freiman and Noam Korngut, TechnionIIT"
+    id_algorithm_type = "Exported deep learnt bi-exponential fit"
+    id_return_parameters = "f, D*, D, S0"
+    id_units = "seconds per milli metre squared or milliseconds per micro metre squared"
+    id_ref = "https://doi.org/10.1002/mrm.28852"
+    # Algorithm requirements
+    required_bvalues = 4
+    required_thresholds = [0,
+                           0]  # Interval from "at least" to "at most", in case submissions allow a custom number of thresholds
+    required_bounds = False
+    required_bounds_optional = False
+    required_initial_guess = False
+    required_initial_guess_optional = False
+    accepted_dimensions = 1
+
+    # Supported inputs in the standardized class
+    supported_bounds = False
+    supported_initial_guess = False
+    supported_thresholds = False
+
+    def __init__(self, bvalues=None, thresholds=None, bounds=None, initial_guess=None, model_path=None, backend="auto", num_threads=None):
+        """
+            Loads an exported network.
+
+            Args:
+                model_path: path of the exported network (as passed to export)
+                backend: "auto" (ONNX Runtime if available, otherwise TorchScript), "onnx" or "torchscript"
+                num_threads: number of CPU threads used for inference
+        """
+        if model_path is None:
+            raise ValueError("model_path of an exported network needs defining at initiation")
+        self.runner = NetworkRunner(model_path, backend=backend, num_threads=num_threads)
+        if bvalues is None:
+            bvalues = self.runner.bvalues
+        elif not np.array_equal(np.asarray(bvalues, dtype=float), self.runner.bvalues):
+            raise ValueError("the b-values differ from the b-values the exported network was trained for")
+        super(IVIM_NET_runtime, self).__init__(bvalues=bvalues, bounds=bounds, initial_guess=initial_guess)
+        self.bvalues = np.array(bvalues)
+        self.deep_learning = True
+        self.use_bounds = {"f": False, "Dp": False, "D": False}
+        self.use_initial_guess = {"f": False, "Dp": False, "D": False}
+
+    def ivim_fit(self, signals, **kwargs):
+        """Perform the IVIM fit
+
+        Args:
+            signals (array-like)
+
+        Returns:
+            results: a dictionary containing "D", "f", and "Dp".
+        """
+        params = self.runner.predict(np.asarray(signals)[np.newaxis, :])
+        return {key: params[key][0] for key in ["D", "f", "Dp"]}
+
+    def ivim_fit_full_volume(self, signals, **kwargs):
+        """Perform the IVIM fit on a full volume in batched network evaluations
+
+        Args:
+            signals (array-like): multi-D array (data x b-values)
+
+        Returns:
+            results: a dictionary containing maps of "D", "f", and "Dp".
+        """
+        signals = np.asarray(signals)
+        params = self.runner.predict(signals.reshape(-1, signals.shape[-1]))
+        return {key: np.reshape(params[key], signals.shape[:-1]) for key in ["D", "f", "Dp"]}
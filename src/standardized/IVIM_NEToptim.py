@@ -1,9 +1,18 @@
 from src.wrappers.OsipiBase import OsipiBase
+import copy
 import numpy as np
 import IVIMNET.deep as deep
 import torch
 import warnings
 from utilities.data_simulation.GenerateData import GenerateData
+from utilities.data_simulation.simulated_dataset import SimulatedIVIMDataset
+from utilities.ivim.network_export import export_network
+from utilities.ivim.network_quantization import quantized_runner
+from utilities.ivim.network_training import learn_IVIM_array, learn_IVIM_streaming, load_checkpoint, finetune_IVIM, volume_hash, network_hash, uses_training_controls
+from utilities.ivim.artifact_store import ArtifactStore, artifact_key
+
+# settings of the fine-tuning with retrain_on_input_data="finetune" (see utilities.ivim.network_training.finetune_IVIM)
+default_finetune_pars = {"voxels": 20000, "max_epochs": 10, "patience": 2, "maxit": 100, "seed": 0, "cache_dir": None}
 
 class IVIM_NEToptim(OsipiBase):
     """
@@ -36,13 +45,29 @@ class IVIM_NEToptim(OsipiBase):
     supported_initial_guess = False
     supported_thresholds = False
 
-    def __init__(self, SNR=None, bvalues=None, thresholds=None, bounds=None, initial_guess=None, fitS0=True, traindata=None, n=5000000):
+    def __init__(self, SNR=None, bvalues=None, thresholds=None, bounds=None, initial_guess=None, fitS0=True, traindata=None, n=5000000, streaming=False, num_workers=0, quantize=None, quantization_tolerances=None, train_pars=None, finetune_pars=None):
         """
             Everything this algorithm requires should be implemented here.
             Number of segmentation thresholds, bounds, etc.
 
             Our OsipiBase object could contain functions that compare the inputs with
             the requirements.
+
+            With streaming=True and no traindata, the network is trained on batches that are simulated on the fly
+            (see SimulatedIVIMDataset) instead of on n pre-simulated voxels, keeping memory at one batch per
+            DataLoader worker; num_workers sets the number of worker processes simulating batches.
+
+            quantize="int8" or "float16" dynamically quantizes the trained network for CPU inference (see
+            quantize_network); quantization_tolerances overrides the accepted deviation from the float network.
+
+            train_pars is a dictionary overriding the training settings of NetArgs, e.g. the budgets max_epochs and
+            max_time (seconds), checkpoint_path to checkpoint and resume the training, and telemetry_path for a
+            JSON lines log of the loss and samples/second per epoch. A checkpoint of a training that stopped early or
+            used up max_epochs is loaded without training. Without these options, training on an array of signals
+            runs deep.learn_IVIM (see train_network).
+
+            finetune_pars is a dictionary overriding default_finetune_pars, the settings of the fine-tuning on the
+            input data with ivim_fit_full_volume(retrain_on_input_data="finetune").
         """
         if bvalues is None:
             raise ValueError("for deep learning models, bvalues need defining at initiaition")
@@ -50,22 +75,38 @@ class IVIM_NEToptim(OsipiBase):
         super(IVIM_NEToptim, self).__init__(bvalues=bvalues, bounds=bounds, initial_guess=initial_guess)
         self.fitS0=fitS0
         self.bvalues=np.array(bvalues)
-        self.initialize(bounds, initial_guess, fitS0, traindata, SNR, n)
+        self.train_pars = train_pars
+        unknown = set(finetune_pars or {}) - set(default_finetune_pars)
+        if unknown:
+            raise ValueError(f"unknown fine-tuning parameters {sorted(unknown)}")
+        self.finetune_pars = {**default_finetune_pars, **(finetune_pars or {})}
+        self.finetuned = {}
+        self.initialize(bounds, initial_guess, fitS0, traindata, SNR, n, streaming, num_workers)
+        self.quantize_network(quantize, quantization_tolerances)
 
-    def initialize(self, bounds, initial_guess, fitS0, traindata, SNR, n):
+    def initialize(self, bounds, initial_guess, fitS0, traindata, SNR, n, streaming=False, num_workers=0):
         self.fitS0=fitS0
         self.deep_learning = True
         self.supervised = False
         # Additional options
         self.stochastic = True
+        self.arg=Arg()
+        for key, value in (getattr(self, "train_pars", None) or {}).items():
+            if not hasattr(self.arg.train_pars, key):
+                raise ValueError(f"unknown training parameter {key}")
+            setattr(self.arg.train_pars, key, value)
+        checkpoint = load_checkpoint(self.arg.train_pars.checkpoint_path, self.bvalues)
+        trained = checkpoint is not None and (checkpoint["finished"] or checkpoint["epoch"] + 1 >= self.arg.train_pars.max_epochs)
 
-        if traindata is None:
+        if traindata is None and not trained:
             warnings.warn('no training data provided (traindata = None). Training data will be simulated')
             if SNR is None:
                 warnings.warn('No SNR indicated. Data simulated with SNR = (5-100)')
                 SNR = (5, 100)
-            self.training_data(self.bvalues,n=n,SNR=SNR)
-        self.arg=Arg()
+            if streaming:
+                self.train_dataset = SimulatedIVIMDataset(self.bvalues, batch_size=self.arg.train_pars.batch_size, steps_per_epoch=self.arg.train_pars.maxit, SNR=SNR)
+            else:
+                self.training_data(self.bvalues,n=n,SNR=SNR)
         warnings.warn('Note that the bounds in the network are soft bounds and implemented by a sigmoid transform. In order for the network to be sensitive over the range, we extend the bounds by 30%', UserWarning, stacklevel=2)
         if bounds is not None:
             self.bounds = bounds
@@ -82,11 +123,20 @@ class IVIM_NEToptim(OsipiBase):
 
         self.use_bounds = {"f": True, "Dp": True, "D": True}
         self.use_initial_guess = {"f": False, "Dp": False, "D": False}
-        if traindata is None:
-            self.net = deep.learn_IVIM(self.train_data['data'], self.bvalues, self.arg)
+        if trained:
+            self.net = deep.Net(torch.FloatTensor(self.bvalues), deep.checkarg(self.arg).net_pars)
+            self.net.load_state_dict(checkpoint["final_model"] if self.arg.train_pars.select_best else checkpoint["net"])
+            self.net.training_log = checkpoint["training_log"]
+        elif traindata is None and streaming:
+            self.net = learn_IVIM_streaming(self.train_dataset, self.bvalues, self.arg, num_workers=num_workers)
+        elif traindata is None:
+            self.net = self.train_network(self.train_data['data'], num_workers=num_workers)
         else:
-            self.net = deep.learn_IVIM(traindata, self.bvalues, self.arg)
-        self.algorithm =lambda data: deep.predict_IVIM(data, self.bvalues, self.net, self.arg)
+            self.net = self.train_network(traindata, num_workers=num_workers)
+        self.training_log = getattr(self.net, "training_log", None)
+        # the network that fine-tuning on input data starts from
+        self.pretrained_net = copy.deepcopy(self.net)
+        self.algorithm =lambda data: self.predict(data)
 
 
     def ivim_fit(self, signals, **kwargs):
@@ -99,7 +149,7 @@ class IVIM_NEToptim(OsipiBase):
             _type_: _description_
         """
 
-        paramsNN = deep.predict_IVIM(signals, self.bvalues, self.net, self.arg)
+        paramsNN = self.predict(signals)
 
         results = {}
         results["D"] = paramsNN[0]
@@ -114,10 +164,15 @@ class IVIM_NEToptim(OsipiBase):
 
         Args:
             signals (array-like)
+            retrain_on_input_data: True continues training the network on all voxels of signals; "finetune"
+                fine-tunes the pretrained network on a subsample of the voxels (see finetune)
 
         Returns:
             _type_: _description_
         """
+        if retrain_on_input_data == "finetune":
+            self.finetune(self.reshape_to_voxelwise(signals)[0])
+            retrain_on_input_data = False
         minimum_bvalue = np.min(self.bvalues) # We normalize the signal to the minimum bvalue. Should be 0 or very close to 0.
         b0_indices = np.where(self.bvalues == minimum_bvalue)[0]
         normalization_factor = np.mean(signals[..., b0_indices],axis=-1)
@@ -125,8 +180,9 @@ class IVIM_NEToptim(OsipiBase):
 
         signals, shape = self.reshape_to_voxelwise(signals)
         if retrain_on_input_data:
-            self.net = deep.learn_IVIM(signals, self.bvalues, self.arg, net=self.net)
-        paramsNN = deep.predict_IVIM(signals, self.bvalues, self.net, self.arg)
+            self.net = self.train_network(signals, net=self.net)
+            self.quantize_network(self.quantize, self.quantization_tolerances)
+        paramsNN = self.predict(signals)
 
         results = {}
         results["D"] = np.reshape(paramsNN[0],shape[:-1])
@@ -135,6 +191,85 @@ class IVIM_NEToptim(OsipiBase):
 
         return results
 
+    def train_network(self, signals, net=None, num_workers=0):
+        """
+        Trains the network on an array of signals. This is deep.learn_IVIM, unless train_pars set a training budget,
+        checkpointing or telemetry; then it is learn_IVIM_array (see utilities.ivim.network_training.train_IVIM).
+        Args:
+            signals: 2D array of signals (voxels x b-values)
+            net: optional network to continue training from
+            num_workers: number of DataLoader worker processes of learn_IVIM_array
+
+        Returns:
+            net: the trained network
+        """
+        if uses_training_controls(self.arg.train_pars):
+            return learn_IVIM_array(signals, self.bvalues, self.arg, net=net, num_workers=num_workers)
+        return deep.learn_IVIM(signals, self.bvalues, self.arg, net=net)
+
+    def finetune(self, signals):
+        """
+        Fine-tunes the pretrained network on a stratified subsample of the foreground voxels of the signals, within
+        the budget of finetune_pars, and uses it for the following fits. The fine-tuned weights are cached per input
+        volume (and on disk in finetune_pars["cache_dir"] if set), so fitting the same volume again does not retrain.
+        Args:
+            signals: 2D array of signals (voxels x b-values)
+        """
+        settings = {key: value for key, value in self.finetune_pars.items() if key != "cache_dir"}
+        params = {"volume": volume_hash(signals), "network": network_hash(self.pretrained_net),
+                  "bvalues": self.bvalues, **settings}
+        key = artifact_key(params)
+        if key not in self.finetuned:
+            def train(path=None):
+                net = finetune_IVIM(self.pretrained_net, signals, self.bvalues, self.arg, **settings)
+                if path is not None:
+                    torch.save(net.state_dict(), path / "net.pt")
+                return net.state_dict()
+
+            if self.finetune_pars["cache_dir"] is None:
+                self.finetuned[key] = train()
+            else:
+                path = ArtifactStore(self.finetune_pars["cache_dir"]).get_or_create(params, train)
+                self.finetuned[key] = torch.load(path / "net.pt", map_location="cpu")
+        self.net = copy.deepcopy(self.pretrained_net)
+        self.net.load_state_dict(self.finetuned[key])
+        self.quantize_network(self.quantize, self.quantization_tolerances)
+
+    def quantize_network(self, mode, tolerances=None):
+        """
+        Switches inference to a dynamically quantized copy of the network, after checking its accuracy against the
+        float network on the generic_DL.json cases; the float network is kept if the check fails
+        Args:
+            mode: "int8", "float16" or None for float inference
+            tolerances: largest accepted deviation per parameter, see utilities.ivim.network_quantization
+        """
+        self.quantize = mode
+        self.quantization_tolerances = tolerances
+        self.runner = None
+        if mode is not None:
+            self.runner, self.quantization_error = quantized_runner(self.net, self.bvalues, self.arg.net_pars, "ivimnet", mode, tolerances)
+
+    def predict(self, signals):
+        """
+        Predicts D, f, Dp and S0 with the (quantized) network, as deep.predict_IVIM does
+        """
+        if self.runner is None:
+            return deep.predict_IVIM(signals, self.bvalues, self.net, self.arg)
+        params = self.runner.predict(np.atleast_2d(signals))
+        return [np.reshape(params[key], np.shape(signals)[:-1]) for key in ["D", "f", "Dp", "S0"]]
+
+    def export(self, path, formats=("torchscript", "onnx")):
+        """
+        Exports the trained network for CPU inference with the IVIM_NET_runtime algorithm
+        Args:
+            path: output path without extension
+            formats: any of "torchscript" and "onnx"
+
+        Returns:
+            path: path of the metadata file of the exported network
+        """
+        return export_network(self.net, self.bvalues, self.arg.net_pars, path, preprocessing="ivimnet", formats=formats)
+
     def reshape_to_voxelwise(self, data):
         """
         reshapes multi-D input (spatial dims, bvvalue) data to 2D voxel-wise array
@@ -149,10 +284,11 @@ class IVIM_NEToptim(OsipiBase):
 
 
     def training_data(self, bvalues, data=None, SNR=(5,100), n=5000000,Drange=(0.0003,0.0035),frange=(0,1),Dprange=(0.005,0.12),rician_noise=False):
-        rng = np.random.RandomState(42)
         if data is None:
-            gen = GenerateData(rng=rng)
-            data, D, f, Dp = gen.simulate_training_data(bvalues, SNR=SNR, n=n,Drange=Drange,frange=frange,Dprange=Dprange,rician_noise=rician_noise)
+            # simulated in float32 chunks, so memory stays close to the size of the training data
+            data = np.empty((n, len(bvalues)), dtype=np.float32)
+            chunks = GenerateData().simulate_training_chunks(bvalues, n=n, seed=42, SNR=SNR, Drange=Drange, frange=frange, Dprange=Dprange, rician_noise=rician_noise, dtype=np.float32, out=data)
+            D, f, Dp = [np.concatenate(values) for values in zip(*[params for _, *params in chunks])]
             if self.supervised:
                 self.train_data = {'data':data,'D':D,'f':f,'Dp':Dp}
             else:
@@ -174,6 +310,12 @@ class NetArgs:
         self.use_cuda = torch.cuda.is_available()
         self.device = torch.device("cuda:0" if self.use_cuda else "cpu")
         self.select_best = False
+        # training budgets, checkpointing and telemetry (see utilities.ivim.network_training.train_IVIM)
+        self.max_epochs = 1000  # maximum number of epochs
+        self.max_time = None  # wall-clock budget of the training in seconds; None for no limit
+        self.checkpoint_path = None  # file to checkpoint the training to and resume it from
+        self.checkpoint_every = 1  # number of epochs between checkpoints
+        self.telemetry_path = None  # JSON lines file receiving the loss and samples/second of every epoch
         # the optimized network settings
 
 class NetPars:
@@ -0,0 +1,94 @@
+from src.wrappers.OsipiBase import OsipiBase
+import numpy as np
+import torch
+from utilities.ivim.distillation import distill, normalise
+
+
+class IVIM_distilled(OsipiBase):
+    """
+    Small network trained to reproduce the estimates of another (slow) standardized algorithm on simulated data,
+    such that fitting a volume costs a single batched forward pass
+    """
+
+    # Some basic stuff that identifies the algorithm
+    id_author = "Distilled from the teacher algorithm"
+    id_algorithm_type = "Deep learnt surrogate of a bi-exponential fit"
+    id_return_parameters = "f, D*, D"
+    id_units = "seconds per milli metre squared or milliseconds per micro metre squared"
+    id_ref = "https://doi.org/10.48550/arXiv.1503.02531"
+    # Algorithm requirements
+    required_bvalues = 4
+    required_thresholds = [0,
+                           0]  # Interval from "at least" to "at most", in case submissions allow a custom number of thresholds
+    required_bounds = False
+    required_bounds_optional = False
+    required_initial_guess = False
+    required_initial_guess_optional = False
+    accepted_dimensions = 1
+
+    # Supported inputs in the standardized class
+    supported_bounds = False
+    supported_initial_guess = False
+    supported_thresholds = False
+
+    def __init__(self, bvalues=None, thresholds=None, bounds=None, initial_guess=None, teacher="OGC_AmsterdamUMC_biexp_segmented", teacher_kwargs=None, n=10000, SNR=(5, 100), njobs=1, width=64, depth=3, seed=0, cache_dir=None):
+        """
+            Trains the surrogate of the teacher for these b-values, or loads it when it was trained before.
+
+            Args:
+                teacher: name of the standardized algorithm to reproduce
+                teacher_kwargs: keyword arguments of the teacher, such as its bounds and initial guesses
+                n: number of simulated training signals fitted by the teacher
+                SNR: SNR (or range of SNRs) of the training signals
+                njobs: number of processes running the teacher; -1 uses all CPUs
+                width, depth: size of the surrogate network
+                seed: seed of the simulation and training
+                cache_dir: directory where trained surrogates are kept; defaults to the artifact store of the trained
+                    networks (see utilities.ivim.artifact_store.default_artifact_dir)
+        """
+        if bvalues is None:
+            raise ValueError("for deep learning models, bvalues need defining at initiaition")
+        super(IVIM_distilled, self).__init__(bvalues=bvalues, bounds=bounds, initial_guess=initial_guess)
+        self.bvalues = np.array(bvalues)
+        self.teacher = teacher
+        self.net, self.surrogate_metadata = distill(teacher, self.bvalues, n=n, SNR=SNR, njobs=njobs, teacher_kwargs=teacher_kwargs,
+                                                    width=width, depth=depth, seed=seed, cache_dir=cache_dir)
+        self.deep_learning = True
+        self.use_bounds = {"f": False, "Dp": False, "D": False}
+        self.use_initial_guess = {"f": False, "Dp": False, "D": False}
+
+    def predict(self, signals):
+        """
+        Estimates D, f and Dp of normalised signals in one forward pass; voxels with non-finite signals are 0
+        """
+        signals = np.atleast_2d(signals)
+        valid = np.isfinite(signals).all(axis=1)
+        params = np.zeros((len(signals), 3))
+        with torch.no_grad():
+            params[valid] = self.net(torch.from_numpy(signals[valid].astype(np.float32))).numpy()
+        return params
+
+    def ivim_fit(self, signals, **kwargs):
+        """Perform the IVIM fit
+
+        Args:
+            signals (array-like)
+
+        Returns:
+            results: a dictionary containing "D", "f", and "Dp".
+        """
+        D, f, Dp = self.predict(normalise(np.asarray(signals, dtype=float), self.bvalues))[0]
+        return {"D": D, "f": f, "Dp": Dp}
+
+    def ivim_fit_full_volume(self, signals, **kwargs):
+        """Perform the IVIM fit on a full volume in one batched forward pass
+
+        Args:
+            signals (array-like): multi-D array (data x b-values)
+
+        Returns:
+            results: a dictionary containing maps of "D", "f", and "Dp".
+        """
+        signals = normalise(np.asarray(signals, dtype=float), self.bvalues)
+        params = self.predict(signals.reshape(-1, signals.shape[-1]))
+        return {key: np.reshape(params[:, i], signals.shape[:-1]) for i, key in enumerate(["D", "f", "Dp"])}
@@ -1,5 +1,6 @@
 from src.wrappers.OsipiBase import OsipiBase
 from src.original.fitting.OGC_AmsterdamUMC.LSQ_fitting import fit_least_squares, fit_least_squares_array
+from utilities.ivim import kernels
 import numpy as np
 
 class OGC_AmsterdamUMC_biexp(OsipiBase):
@@ -34,8 +35,9 @@ class OGC_AmsterdamUMC_biexp(OsipiBase):
     supported_thresholds = False
     supported_dimensions = 1
     supported_priors = False
+    supported_engine = True
 
-    def __init__(self, bvalues=None, thresholds=None, bounds=None, initial_guess=None, fitS0=True):
+    def __init__(self, bvalues=None, thresholds=None, bounds=None, initial_guess=None, fitS0=True, engine=None):
         """
             Everything this algorithm requires should be implemented here.
             Number of segmentation thresholds, bounds, etc.
@@ -44,7 +46,7 @@ class OGC_AmsterdamUMC_biexp(OsipiBase):
             the requirements.
         """
         #super(OGC_AmsterdamUMC_biexp, self).__init__(bvalues, bounds, initial_guess, fitS0)
-        super(OGC_AmsterdamUMC_biexp, self).__init__(bvalues=bvalues, bounds=bounds, initial_guess=initial_guess)
+        super(OGC_AmsterdamUMC_biexp, self).__init__(bvalues=bvalues, bounds=bounds, initial_guess=initial_guess, engine=engine)
         self.OGC_algorithm = fit_least_squares
         self.OGC_algorithm_array = fit_least_squares_array
         self.fitS0=fitS0
@@ -60,6 +62,10 @@ class OGC_AmsterdamUMC_biexp(OsipiBase):
         Returns:
             _type_: _description_
         """
+        if self.engine is not None:
+            fit_results = self.ivim_fit_batch(np.asarray(signals, dtype=float)[np.newaxis, :])
+            return {key: float(value[0]) for key, value in fit_results.items()}
+
         bounds = ([self.bounds["D"][0], self.bounds["f"][0], self.bounds["Dp"][0], self.bounds["S0"][0]],
                   [self.bounds["D"][1], self.bounds["f"][1], self.bounds["Dp"][1], self.bounds["S0"][1]])
 
@@ -72,4 +78,59 @@ class OGC_AmsterdamUMC_biexp(OsipiBase):
         results["f"] = fit_results[1]
         results["Dp"] = fit_results[2]
 
-        return results
\ No newline at end of file
+        return results
+
+    def ivim_fit_batch(self, signals, **kwargs):
+        """Perform the IVIM fit on a batch of voxels at once
+
+        With an engine selected, all voxels are fitted by the Levenberg-Marquardt kernel of utilities.ivim.kernels.
+
+        Args:
+            signals (array-like): voxels x b-values matrix
+
+        Returns:
+            dict: parameter arrays of length voxels
+        """
+        bounds = ([self.bounds["D"][0], self.bounds["f"][0], self.bounds["Dp"][0], self.bounds["S0"][0]],
+                  [self.bounds["D"][1], self.bounds["f"][1], self.bounds["Dp"][1], self.bounds["S0"][1]])
+
+        initial_guess = [self.initial_guess["D"], self.initial_guess["f"], self.initial_guess["Dp"], self.initial_guess["S0"]]
+
+        signals = np.asarray(signals, dtype=float)
+        if self.engine is not None:
+            # least squares fit in the compiled kernel; D and D* are reordered as in the original code
+            params = kernels.fit_biexp(self.bvalues, signals, initial_guess, bounds, fit_S0=self.fitS0, engine=self.engine)
+            swap = params[:, 2] < params[:, 0]
+            fit_results = [np.where(swap, params[:, 2], params[:, 0]),
+                           np.where(swap, 1 - params[:, 1], params[:, 1]),
+                           np.where(swap, params[:, 0], params[:, 2])]
+        elif np.any(self.bvalues == 0):
+            # parallelism is handled per chunk by osipi_fit_chunked
+            fit_results = self.OGC_algorithm_array(self.bvalues, signals, S0_output=False, fitS0=self.fitS0, njobs=1,
+                                                   bounds=bounds, p0=initial_guess)
+        else:
+            # the array fit normalizes by the b=0 signal, so fit the voxels one by one
+            fit_results = np.transpose([self.OGC_algorithm(self.bvalues, signal, p0=initial_guess, bounds=bounds, fitS0=self.fitS0)
+                                        for signal in signals])
+
+        results = {}
+        results["D"] = np.asarray(fit_results[0], dtype=float)
+        results["f"] = np.asarray(fit_results[1], dtype=float)
+        results["Dp"] = np.asarray(fit_results[2], dtype=float)
+
+        return results
+
+    def ivim_fit_full_volume(self, signals, njobs=1, chunk_size=None, **kwargs):
+        """Perform the IVIM fit on a full volume
+
+        Voxels are fitted in masked, memory-bounded chunks with ivim_fit_batch.
+
+        Args:
+            signals (array-like): volume with the b-values in the last dimension
+            njobs (int, optional): number of chunks fitted in parallel, -1 for all cores
+            chunk_size (int, optional): number of voxels fitted per chunk
+
+        Returns:
+            dict: parameter maps with the spatial shape of signals
+        """
+        return self.osipi_fit_chunked(signals, chunk_size=chunk_size, njobs=njobs, **kwargs)
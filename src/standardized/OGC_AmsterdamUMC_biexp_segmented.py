@@ -1,5 +1,6 @@
 from src.wrappers.OsipiBase import OsipiBase
 from src.original.fitting.OGC_AmsterdamUMC.LSQ_fitting import fit_segmented, fit_segmented_array
+from utilities.ivim import kernels
 import warnings
 import numpy as np
 
@@ -34,8 +35,9 @@ class OGC_AmsterdamUMC_biexp_segmented(OsipiBase):
     supported_thresholds = True
     supported_dimensions = 1
     supported_priors = False
+    supported_engine = True
 
-    def __init__(self, bvalues=None, thresholds=150, bounds=None, initial_guess=None):
+    def __init__(self, bvalues=None, thresholds=150, bounds=None, initial_guess=None, engine=None):
         """
             Everything this algorithm requires should be implemented here.
             Number of segmentation thresholds, bounds, etc.
@@ -43,7 +45,7 @@ class OGC_AmsterdamUMC_biexp_segmented(OsipiBase):
             Our OsipiBase object could contain functions that compare the inputs with
             the requirements.
         """
-        super(OGC_AmsterdamUMC_biexp_segmented, self).__init__(bvalues, thresholds, bounds, initial_guess)
+        super(OGC_AmsterdamUMC_biexp_segmented, self).__init__(bvalues, thresholds, bounds, initial_guess, engine=engine)
         self.OGC_algorithm = fit_segmented
         self.OGC_algorithm_array = fit_segmented_array
         self.initialize(thresholds)
@@ -67,6 +69,10 @@ class OGC_AmsterdamUMC_biexp_segmented(OsipiBase):
         Returns:
             _type_: _description_
         """
+        if self.engine is not None:
+            fit_results = self.ivim_fit_batch(np.asarray(signals, dtype=float)[np.newaxis, :])
+            return {key: float(value[0]) for key, value in fit_results.items()}
+
         bounds = ([self.bounds["D"][0], self.bounds["f"][0], self.bounds["Dp"][0], self.bounds["S0"][0]],
                   [self.bounds["D"][1], self.bounds["f"][1], self.bounds["Dp"][1], self.bounds["S0"][1]])
 
@@ -79,4 +85,49 @@ class OGC_AmsterdamUMC_biexp_segmented(OsipiBase):
         results["f"] = fit_results[1]
         results["Dp"] = fit_results[2]
 
-        return results
\ No newline at end of file
+        return results
+
+    def ivim_fit_batch(self, signals, **kwargs):
+        """Perform the IVIM fit on a batch of voxels at once
+
+        With an engine selected, all voxels are fitted by the segmented kernel of utilities.ivim.kernels.
+
+        Args:
+            signals (array-like): voxels x b-values matrix, normalized to b=0
+
+        Returns:
+            dict: parameter arrays of length voxels
+        """
+        bounds = ([self.bounds["D"][0], self.bounds["f"][0], self.bounds["Dp"][0], self.bounds["S0"][0]],
+                  [self.bounds["D"][1], self.bounds["f"][1], self.bounds["Dp"][1], self.bounds["S0"][1]])
+
+        initial_guess = [self.initial_guess["D"], self.initial_guess["f"], self.initial_guess["Dp"], self.initial_guess["S0"]]
+
+        signals = np.asarray(signals, dtype=float)
+        if self.engine is not None:
+            fit_results = kernels.fit_segmented(self.bvalues, signals, self.thresholds, bounds, initial_guess, engine=self.engine).T
+        else:
+            fit_results = np.transpose([self.OGC_algorithm(self.bvalues, signal, bounds=bounds, cutoff=self.thresholds, p0=initial_guess)
+                                        for signal in signals])
+
+        results = {}
+        results["D"] = np.asarray(fit_results[0], dtype=float)
+        results["f"] = np.asarray(fit_results[1], dtype=float)
+        results["Dp"] = np.asarray(fit_results[2], dtype=float)
+
+        return results
+
+    def ivim_fit_full_volume(self, signals, njobs=1, chunk_size=None, **kwargs):
+        """Perform the IVIM fit on a full volume
+
+        Voxels are fitted in masked, memory-bounded chunks with ivim_fit_batch.
+
+        Args:
+            signals (array-like): volume with the b-values in the last dimension
+            njobs (int, optional): number of chunks fitted in parallel, -1 for all cores
+            chunk_size (int, optional): number of voxels fitted per chunk
+
+        Returns:
+            dict: parameter maps with the spatial shape of signals
+        """
+        return self.osipi_fit_chunked(signals, chunk_size=chunk_size, njobs=njobs, **kwargs)
@@ -0,0 +1,176 @@
+import numpy as np
+from src.wrappers.OsipiBase import OsipiBase
+from src.original.fitting.OJ_GU.ivim_seg import seg
+from src.original.fitting.OJ_GU.ivim_bayes import bayes, lognorm_prior
+
+class OJ_GU_bayes(OsipiBase):
+    """
+    Bayesian bi-exponential fitting algorithm by Oscar Jalnefjord, University of Gothenburg
+    """
+
+    # I'm thinking that we define default attributes for each submission like this
+    # And in __init__, we can call the OsipiBase control functions to check whether
+    # the user inputs fulfil the requirements
+
+    # Some basic stuff that identifies the algorithm
+    id_author = "Oscar Jalnefjord, GU"
+    id_algorithm_type = "Bayesian bi-exponential fit (MCMC)"
+    id_return_parameters = "f, D*, D, S0"
+    id_units = "mm2/s"
+    id_ref = "https://doi.org/10.1002/mrm.26783"
+
+    # Algorithm requirements
+    required_bvalues = 4
+    required_thresholds = [0,1] # Interval from "at least" to "at most", in case submissions allow a custom number of thresholds
+    required_bounds = False
+    required_bounds_optional = True # Bounds may not be required but are optional
+    required_initial_guess = False
+    required_initial_guess_optional = True
+
+    # Supported inputs in the standardized class
+    supported_bounds = True
+    supported_initial_guess = True
+    supported_thresholds = True
+    supported_dimensions = 1
+    supported_priors = True
+
+    def __init__(self, bvalues=None, thresholds=None, bounds=None, initial_guess=None, prior_in=None, n=2000, burns=1000,
+                 thin=1, central_tendency="mode", uncertainty=False, credible_interval=0.95, rician=False, rng=None):
+        """
+            Everything this algorithm requires should be implemented here.
+            Number of segmentation thresholds, bounds, etc.
+
+            Our OsipiBase object could contain functions that compare the inputs with
+            the requirements.
+
+            Args:
+                thresholds (array-like, optional): b-value threshold of the segmented fit that gives the
+                    starting values of the chains
+                prior_in (array, optional): 2D array of D, f, D* values (e.g. from a least squares fit of
+                    the volume) from which empirical lognormal priors for D and D* are formed.
+                    Default: flat priors within the bounds
+                n (int, optional): number of iterations after burn-in
+                burns (int, optional): number of burn-in iterations
+                thin (int, optional): only every thin-th sample after burn-in is kept
+                central_tendency (str, optional): "mode", "median" or "mean" of the posterior, used as the
+                    estimate of f, D and D*
+                uncertainty (bool, optional): also return the posterior standard deviation and credible
+                    interval of every parameter, as "<parameter>_std", "<parameter>_ci_low" and
+                    "<parameter>_ci_high"
+                credible_interval (float, optional): probability mass of the credible interval
+                rician (bool, optional): use the Rician instead of the Gaussian noise distribution
+                rng (numpy.random.Generator or int, optional): random number generator or seed
+        """
+        super(OJ_GU_bayes, self).__init__(bvalues=bvalues, thresholds=thresholds, bounds=bounds, initial_guess=initial_guess)
+        self.use_bounds = {"f" : True, "D" : True, "Dp" : True, "S0" : True}
+        self.use_initial_guess = {"f" : True, "D" : True, "Dp" : True, "S0" : True}
+
+        if central_tendency not in ("mode", "median", "mean"):
+            raise ValueError('central_tendency must be "mode", "median" or "mean"')
+        self.n = n
+        self.burns = burns
+        self.thin = thin
+        self.central_tendency = central_tendency
+        self.uncertainty = uncertainty
+        self.credible_interval = credible_interval
+        self.rician = rician
+        self.rng = np.random.default_rng(rng)
+
+        self.prior = None
+        if prior_in is not None:
+            self.prior = ['flat', lognorm_prior(prior_in[0]), lognorm_prior(prior_in[2]), 'flat'] + ['reci'] * rician
+
+        self.result_keys = ["f", "Dp", "D"]
+        if uncertainty:
+            self.result_keys = self.result_keys + [key + suffix for key in ["f", "Dp", "D"] for suffix in ["_std", "_ci_low", "_ci_high"]]
+
+    def starting_values(self, signals, lim):
+        """Segmented fit of every voxel, replaced by the initial guess where it is outside the bounds
+
+        Args:
+            signals (array-like): voxels x b-values matrix
+            lim (array-like): 2 x 4 matrix with the lower and upper limits of f, D, D* and S0
+
+        Returns:
+            list: arrays of f, D, D* and S0
+        """
+        if self.thresholds is None:
+            bthr = 200
+        else:
+            bthr = np.atleast_1d(self.thresholds)[0]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            fit_results = seg(np.maximum(signals, 0.00001), self.bvalues, bthr)
+        guess = [self.initial_guess["f"], self.initial_guess["D"], self.initial_guess["Dp"], self.initial_guess["S0"]]
+
+        start = []
+        for k, key in enumerate(["f", "D", "Dstar", "S0"]):
+            x = np.atleast_1d(np.asarray(fit_results[key], dtype=float))
+            # the chains only move from strictly positive starting values inside the bounds
+            valid = np.isfinite(x) & (x > max(lim[0][k], 0)) & (x < lim[1][k])
+            start.append(np.where(valid, x, guess[k]))
+        swapped = start[1] >= start[2]
+        start[1] = np.where(swapped, guess[1], start[1])
+        start[2] = np.where(swapped, guess[2], start[2])
+        return start
+
+    def ivim_fit(self, signals, **kwargs):
+        """Perform the IVIM fit
+
+        Args:
+            signals (array-like)
+
+        Returns:
+            _type_: _description_
+        """
+        fit_results = self.ivim_fit_batch(np.asarray(signals, dtype=float)[np.newaxis, :], **kwargs)
+        return {key: float(value[0]) for key, value in fit_results.items()}
+
+    def ivim_fit_batch(self, signals, rng=None, **kwargs):
+        """Perform the IVIM fit on a batch of voxels at once
+
+        The Markov chains of all voxels are run simultaneously.
+
+        Args:
+            signals (array-like): voxels x b-values matrix
+            rng (numpy.random.Generator or int, optional): overrides the random number generator of the object
+
+        Returns:
+            dict: parameter arrays of length voxels
+        """
+        signals = np.asarray(signals, dtype=float)
+        lim = np.array([[self.bounds["f"][0], self.bounds["D"][0], self.bounds["Dp"][0], self.bounds["S0"][0]],
+                        [self.bounds["f"][1], self.bounds["D"][1], self.bounds["Dp"][1], self.bounds["S0"][1]]])
+        start = self.starting_values(signals, lim)
+        if self.rician:
+            lim = np.column_stack((lim, [0, np.inf])) # inverse noise variance
+
+        out = bayes(signals, *start, self.bvalues, lim, n=self.n, rician=self.rician, prior=self.prior, burns=self.burns,
+                    thin=self.thin, meanonly=(self.central_tendency == "mean" and not self.uncertainty),
+                    ci=self.credible_interval, rng=self.rng if rng is None else rng)
+
+        results = {}
+        results["f"] = out["f"][self.central_tendency]
+        results["Dp"] = out["Dstar"][self.central_tendency]
+        results["D"] = out["D"][self.central_tendency]
+        if self.uncertainty:
+            for key, name in [("f", "f"), ("Dp", "Dstar"), ("D", "D")]:
+                results[key + "_std"] = out[name]["std"]
+                results[key + "_ci_low"] = out[name]["ci_low"]
+                results[key + "_ci_high"] = out[name]["ci_high"]
+
+        return results
+
+    def ivim_fit_full_volume(self, signals, njobs=1, chunk_size=None, **kwargs):
+        """Perform the IVIM fit on a full volume
+
+        Voxels are fitted in masked chunks with ivim_fit_batch.
+
+        Args:
+            signals (array-like): volume with the b-values in the last dimension
+            njobs (int, optional): number of chunks fitted in parallel, -1 for all cores
+            chunk_size (int, optional): number of voxels fitted per chunk
+
+        Returns:
+            dict: parameter maps with the spatial shape of signals
+        """
+        return self.osipi_fit_chunked(signals, chunk_size=chunk_size, njobs=njobs, **kwargs)
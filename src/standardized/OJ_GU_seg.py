@@ -71,4 +71,42 @@ class OJ_GU_seg(OsipiBase):
         results["Dp"] = fit_results['Dstar']
         results["D"] = fit_results['D']
         
-        return results
\ No newline at end of file
+        return results
+
+    def ivim_fit_batch(self, signals, **kwargs):
+        """Perform the IVIM fit on a batch of voxels at once
+
+        Args:
+            signals (array-like): voxels x b-values matrix
+
+        Returns:
+            dict: parameter arrays of length voxels
+        """
+
+        if self.thresholds is None:
+            bthr = 200
+        else:
+            bthr = self.thresholds[0]
+        signals = np.maximum(np.asarray(signals, dtype=float), 0.00001)
+        fit_results = seg(signals, self.bvalues, bthr)
+
+        results = {}
+        results["f"] = np.atleast_1d(fit_results['f'])
+        results["Dp"] = np.atleast_1d(fit_results['Dstar'])
+        results["D"] = np.atleast_1d(fit_results['D'])
+
+        return results
+
+    def ivim_fit_full_volume(self, signals, chunk_size=None, **kwargs):
+        """Perform the IVIM fit on a full volume
+
+        Voxels are fitted in masked, memory-bounded chunks with ivim_fit_batch.
+
+        Args:
+            signals (array-like): volume with the b-values in the last dimension
+            chunk_size (int, optional): number of voxels fitted per chunk
+
+        Returns:
+            dict: parameter maps with the spatial shape of signals
+        """
+        return self.osipi_fit_chunked(signals, chunk_size=chunk_size, **kwargs)
@@ -72,3 +72,40 @@ class PvH_KB_NKI_IVIMfit(OsipiBase):
         results["Dp"] = fit_results[2][0,0,0]/1000
 
         return results
+
+    def ivim_fit_batch(self, signals, **kwargs):
+        """Perform the IVIM fit on a batch of voxels at once
+
+        The NKI code is vectorized over the image dimensions, so the voxels are
+        passed as a single (voxels, 1, 1, b-values) image.
+
+        Args:
+            signals (array-like): voxels x b-values matrix
+
+        Returns:
+            dict: parameter arrays of length voxels
+        """
+        signals = np.maximum(np.asarray(signals, dtype=float), 0.00001)
+        signals = np.reshape(signals, (signals.shape[0], 1, 1, signals.shape[-1]))
+        fit_results = self.NKI_algorithm(signals, self.bvalues.tolist())
+
+        results = {}
+        results["D"] = fit_results[0][:,0,0]/1000
+        results["f"] = fit_results[1][:,0,0]
+        results["Dp"] = fit_results[2][:,0,0]/1000
+
+        return results
+
+    def ivim_fit_full_volume(self, signals, chunk_size=None, **kwargs):
+        """Perform the IVIM fit on a full volume
+
+        Voxels are fitted in masked, memory-bounded chunks with ivim_fit_batch.
+
+        Args:
+            signals (array-like): volume with the b-values in the last dimension
+            chunk_size (int, optional): number of voxels fitted per chunk
+
+        Returns:
+            dict: parameter maps with the spatial shape of signals
+        """
+        return self.osipi_fit_chunked(signals, chunk_size=chunk_size, **kwargs)
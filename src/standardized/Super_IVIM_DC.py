@@ -1,9 +1,14 @@
 from src.wrappers.OsipiBase import OsipiBase
 import numpy as np
-import os
+import importlib.metadata
+import torch
 from super_ivim_dc.train import train
-from pathlib import Path
 from super_ivim_dc.infer import infer_from_signal
+from super_ivim_dc.IVIMNET import deep
+from super_ivim_dc.source.hyperparams import hyperparams
+from utilities.ivim.network_export import export_network
+from utilities.ivim.network_quantization import quantized_runner
+from utilities.ivim.artifact_store import ArtifactStore, default_artifact_dir
 import warnings
 
 
@@ -39,22 +44,30 @@ class Super_IVIM_DC(OsipiBase):
     supported_initial_guess = True
     supported_thresholds = False
 
-    def __init__(self, bvalues=None, thresholds=None, bounds=None, initial_guess=None, fitS0=True, SNR = None):
+    def __init__(self, bvalues=None, thresholds=None, bounds=None, initial_guess=None, fitS0=True, SNR = None, quantize=None, quantization_tolerances=None, artifact_dir=None):
         """
             Everything this algorithm requires should be implemented here.
             Number of segmentation thresholds, bounds, etc.
 
             Our OsipiBase object could contain functions that compare the inputs with
             the requirements.
+
+            quantize="int8" or "float16" dynamically quantizes the trained network for CPU inference (see
+            quantize_network); quantization_tolerances overrides the accepted deviation from the float network.
+
+            Trained networks are kept in an artifact store in artifact_dir (default: see default_artifact_dir),
+            keyed by the b-values, SNR and training hyperparameters. A network that was trained before is reused, and
+            concurrent workers with the same settings train it only once.
         """
         if bvalues is None:
             raise ValueError("for deep learning models, bvalues need defining at initiaition")
         super(Super_IVIM_DC, self).__init__(bvalues=bvalues, bounds=bounds, initial_guess=initial_guess)
         self.fitS0=fitS0
         self.bvalues=np.array(bvalues)
-        self.initialize(bounds, initial_guess, fitS0, SNR)
+        self.initialize(bounds, initial_guess, fitS0, SNR, artifact_dir=artifact_dir)
+        self.quantize_network(quantize, quantization_tolerances)
 
-    def initialize(self, bounds, initial_guess, fitS0, SNR, working_dir=os.getcwd(),ivimnet_filename='ivimnet',super_ivim_dc_filename='super_ivim_dc'):
+    def initialize(self, bounds, initial_guess, fitS0, SNR, artifact_dir=None,ivimnet_filename='ivimnet',super_ivim_dc_filename='super_ivim_dc'):
         if SNR is None:
             warnings.warn('No SNR indicated. Data simulated with SNR = 100')
             SNR=100
@@ -67,25 +80,40 @@ class Super_IVIM_DC(OsipiBase):
         # Additional options
         self.stochastic = True
 
-        modeldir = Path(working_dir)  # Ensure it's a Path object
-        modeldir = modeldir / "models"
-        modeldir.mkdir(parents=True, exist_ok=True)
-        working_dir: str = str(modeldir)
+        if artifact_dir is None:
+            artifact_dir = default_artifact_dir()
         super_ivim_dc_filename: str = super_ivim_dc_filename  # do not include .pt
         ivimnet_filename: str = ivimnet_filename  # do not include .pt
         self.super_ivim_dc_filename=super_ivim_dc_filename
         self.ivimnet_filename=ivimnet_filename
-        self.working_dir=working_dir
-        train(
-            SNR=SNR,
-            bvalues=self.bvalues,
-            super_ivim_dc=True,
-            work_dir=self.working_dir,
-            super_ivim_dc_filename=self.super_ivim_dc_filename,
-            ivimnet_filename=ivimnet_filename,
-            verbose=False,
-            ivimnet=False
-        )
+        self.artifact_store = ArtifactStore(artifact_dir)
+
+        # everything super_ivim_dc.train trains the network with; train sets SNR and b-values in the same way
+        arg = deep.checkarg(hyperparams('sim'))
+        arg.sim.SNR = [SNR]
+        arg.sim.bvalues = self.bvalues
+        self.artifact_params = {
+            "algorithm": "Super_IVIM_DC",
+            "super_ivim_dc": importlib.metadata.version("super-ivim-dc"),
+            "filename": self.super_ivim_dc_filename,
+            "net_pars": vars(arg.net_pars),
+            "train_pars": {key: value for key, value in vars(arg.train_pars).items() if key not in ("device", "use_cuda")},
+            "sim": vars(arg.sim),
+        }
+
+        def train_network(work_dir):
+            train(
+                SNR=SNR,
+                bvalues=self.bvalues,
+                super_ivim_dc=True,
+                work_dir=str(work_dir),
+                super_ivim_dc_filename=self.super_ivim_dc_filename,
+                ivimnet_filename=ivimnet_filename,
+                verbose=False,
+                ivimnet=False
+            )
+
+        self.working_dir = str(self.artifact_store.get_or_create(self.artifact_params, train_network))
 
 
     def ivim_fit(self, signals, **kwargs):
@@ -98,6 +126,9 @@ class Super_IVIM_DC(OsipiBase):
             results: a dictionary containing "d", "f", and "Dp".
         """
 
+        if self.runner is not None:
+            params = self.runner.predict(np.atleast_2d(signals))
+            return {key: np.reshape(params[key], np.shape(signals)[:-1]) for key in ["D", "f", "Dp"]}
         Dp, Dt, f, S0_superivimdc = infer_from_signal(
             signal=signals,
             bvalues=self.bvalues,
@@ -124,6 +155,9 @@ class Super_IVIM_DC(OsipiBase):
 
         nanmask = np.any(np.isnan(signals),axis=-1)
         signals,shape = self.reshape_to_voxelwise(signals)
+        if self.runner is not None:
+            params = self.runner.predict(signals)
+            return {key: np.reshape(params[key], shape[:-1]) for key in ["D", "f", "Dp"]}
         Dp, Dt, f, S0_superivimdc = infer_from_signal(
             signal=signals,
             bvalues=self.bvalues,
@@ -141,6 +175,46 @@ class Super_IVIM_DC(OsipiBase):
         return results
 
 
+    def export(self, path, formats=("torchscript", "onnx")):
+        """
+        Exports the trained SUPER-IVIM-DC network for CPU inference with the IVIM_NET_runtime algorithm
+        Args:
+            path: output path without extension
+            formats: any of "torchscript" and "onnx"
+
+        Returns:
+            path: path of the metadata file of the exported network
+        """
+        net, arg = self.load_network()
+        return export_network(net, self.bvalues, arg.net_pars, path, preprocessing="super_ivim_dc", formats=formats)
+
+    def quantize_network(self, mode, tolerances=None):
+        """
+        Switches inference to a dynamically quantized copy of the network, after checking its accuracy against the
+        float network on the generic_DL.json cases; the float network is kept if the check fails
+        Args:
+            mode: "int8", "float16" or None for float inference with infer_from_signal
+            tolerances: largest accepted deviation per parameter, see utilities.ivim.network_quantization
+        """
+        self.quantize = mode
+        self.runner = None
+        if mode is not None:
+            net, arg = self.load_network()
+            self.runner, self.quantization_error = quantized_runner(net, self.bvalues, arg.net_pars, "super_ivim_dc", mode, tolerances)
+
+    def load_network(self):
+        """
+        Loads the trained SUPER-IVIM-DC network as super_ivim_dc.IVIMNET.inference.supervised_IVIM does
+
+        Returns:
+            net: the trained network
+            arg: the hyperparameters of the network
+        """
+        arg = deep.checkarg(hyperparams())
+        net = deep.Net(torch.FloatTensor(self.bvalues), arg.net_pars)
+        net.load_state_dict(torch.load(f"{self.working_dir}/{self.super_ivim_dc_filename}.pt", map_location="cpu"))
+        return net.eval(), arg
+
     def reshape_to_voxelwise(self, data):
         """
         reshapes multi-D input (spatial dims, bvvalue) data to 2D voxel-wise array
@@ -91,4 +91,45 @@ class TCML_TechnionIIT_SLS(OsipiBase):
             results["f"] = 0
             results["Dp"] = 0
 
-        return results
\ No newline at end of file
+        return results
+
+    def ivim_fit_batch(self, signals, **kwargs):
+        """Perform the IVIM fit on a batch of voxels at once
+
+        Args:
+            signals (array-like): voxels x b-values matrix
+
+        Returns:
+            dict: parameter arrays of length voxels
+        """
+
+        bounds = ([self.bounds["D"][0], self.bounds["Dp"][0], self.bounds["f"][0], self.bounds["S0"][0]],
+                       [self.bounds["D"][1], self.bounds["Dp"][1], self.bounds["f"][1], self.bounds["S0"][1]])
+        signals = np.maximum(np.asarray(signals, dtype=float), 0)
+
+        fit_results = self.fit_least_squares(signals.T, self.bvalues, bounds, min_bval_high=self.thresholds)
+
+        # D and f are returned for every voxel, D* only for the voxels its fit succeeded on;
+        # the voxels it failed on are left at 0
+        fitted = np.delete(np.arange(len(signals)), fit_results[-1])
+        results = {key: np.zeros(len(signals)) for key in ["D", "f", "Dp"]}
+        results["D"][fitted] = fit_results[0][fitted]
+        results["f"][fitted] = fit_results[2][fitted]
+        results["Dp"][fitted] = fit_results[1]
+
+        return results
+
+    def ivim_fit_full_volume(self, signals, njobs=1, chunk_size=None, **kwargs):
+        """Perform the IVIM fit on a full volume
+
+        Voxels are fitted in masked, memory-bounded chunks with ivim_fit_batch.
+
+        Args:
+            signals (array-like): volume with the b-values in the last dimension
+            njobs (int, optional): number of chunks fitted in parallel, -1 for all cores
+            chunk_size (int, optional): number of voxels fitted per chunk
+
+        Returns:
+            dict: parameter maps with the spatial shape of signals
+        """
+        return self.osipi_fit_chunked(signals, chunk_size=chunk_size, njobs=njobs, **kwargs)
@@ -93,4 +93,46 @@ class TCML_TechnionIIT_lsqBOBYQA(OsipiBase):
 
         results = self.D_and_Ds_swap(results)
 
-        return results
\ No newline at end of file
+        return results
+
+    def ivim_fit_batch(self, signals, **kwargs):
+        """Perform the IVIM fit on a batch of voxels at once
+
+        Args:
+            signals (array-like): voxels x b-values matrix
+
+        Returns:
+            dict: parameter arrays of length voxels
+        """
+
+        bounds = ([self.bounds["D"][0], self.bounds["Dp"][0], self.bounds["f"][0], self.bounds["S0"][0]],
+                       [self.bounds["D"][1], self.bounds["Dp"][1], self.bounds["f"][1], self.bounds["S0"][1]])
+        initial_guess = [self.initial_guess["D"], self.initial_guess["Dp"], self.initial_guess["f"], self.initial_guess["S0"]]
+        signals = np.asarray(signals, dtype=float)
+        fit_results = self.fit_least_squares(self.bvalues, signals.T, bounds, initial_guess.copy())
+
+        # voxels the fit failed on are dropped from the outputs and left at 0
+        fitted = np.delete(np.arange(len(signals)), fit_results[-1])
+        results = {key: np.zeros(len(signals)) for key in ["D", "f", "Dp"]}
+        results["D"][fitted] = fit_results[0]
+        results["f"][fitted] = fit_results[2]
+        results["Dp"][fitted] = fit_results[1]
+
+        results = self.D_and_Ds_swap(results)
+
+        return results
+
+    def ivim_fit_full_volume(self, signals, njobs=1, chunk_size=None, **kwargs):
+        """Perform the IVIM fit on a full volume
+
+        Voxels are fitted in masked, memory-bounded chunks with ivim_fit_batch.
+
+        Args:
+            signals (array-like): volume with the b-values in the last dimension
+            njobs (int, optional): number of chunks fitted in parallel, -1 for all cores
+            chunk_size (int, optional): number of voxels fitted per chunk
+
+        Returns:
+            dict: parameter maps with the spatial shape of signals
+        """
+        return self.osipi_fit_chunked(signals, chunk_size=chunk_size, njobs=njobs, **kwargs)
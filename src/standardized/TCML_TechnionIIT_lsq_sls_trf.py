@@ -1,5 +1,6 @@
 from src.wrappers.OsipiBase import OsipiBase
-from super_ivim_dc.source.Classsic_ivim_fit import IVIM_fit_sls_trf
+from super_ivim_dc.source.Classsic_ivim_fit import IVIM_fit_sls_trf, fit_least_squares_trf
+from src.original.fitting.TCML_TechnionIIT.sls_batch import fit_sls_refined_batch
 import warnings
 import numpy as np
 
@@ -92,4 +93,34 @@ class TCML_TechnionIIT_lsq_sls_trf(OsipiBase):
             results["f"] = 0
             results["Dp"] = 0
 
-        return results
\ No newline at end of file
+        return results
+
+    def ivim_fit_batch(self, signals, **kwargs):
+        """Perform the IVIM fit on a batch of voxels at once
+
+        Args:
+            signals (array-like): voxels x b-values matrix
+
+        Returns:
+            dict: parameter arrays of length voxels
+        """
+        signals = np.maximum(np.asarray(signals, dtype=float), 0)
+        bounds = ([self.bounds["D"][0], self.bounds["Dp"][0], self.bounds["f"][0], self.bounds["S0"][0]],
+                       [self.bounds["D"][1], self.bounds["Dp"][1], self.bounds["f"][1], self.bounds["S0"][1]])
+        return fit_sls_refined_batch(signals, self.bvalues, bounds, self.thresholds,
+                                     lambda bvalues, signal, p0: fit_least_squares_trf(bvalues, signal, bounds, p0), eps=1e-5)
+
+    def ivim_fit_full_volume(self, signals, njobs=1, chunk_size=None, **kwargs):
+        """Perform the IVIM fit on a full volume
+
+        Voxels are fitted in masked, memory-bounded chunks with ivim_fit_batch.
+
+        Args:
+            signals (array-like): volume with the b-values in the last dimension
+            njobs (int, optional): number of chunks fitted in parallel, -1 for all cores
+            chunk_size (int, optional): number of voxels fitted per chunk
+
+        Returns:
+            dict: parameter maps with the spatial shape of signals
+        """
+        return self.osipi_fit_chunked(signals, chunk_size=chunk_size, njobs=njobs, **kwargs)
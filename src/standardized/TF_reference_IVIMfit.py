@@ -1,5 +1,5 @@
 from src.wrappers.OsipiBase import OsipiBase
-from src.original.fitting.TF_reference.segmented_IVIMfit import segmented_IVIM_fit
+from src.original.fitting.TF_reference.segmented_IVIMfit import segmented_IVIM_fit, segmented_IVIM_fit_array
 import warnings
 import numpy as np
 
@@ -44,6 +44,7 @@ class TF_reference_IVIMfit(OsipiBase):
         """
         super(TF_reference_IVIMfit, self).__init__(bvalues=bvalues, thresholds=thresholds,bounds=bounds,initial_guess=initial_guess)
         self.TF_reference_algorithm = segmented_IVIM_fit
+        self.TF_reference_algorithm_array = segmented_IVIM_fit_array
         self.initialize(bounds, thresholds)
         self.use_initial_guess = {"f" : False, "D" : False, "Dp" : False, "S0" : False}
 
@@ -81,4 +82,40 @@ class TF_reference_IVIMfit(OsipiBase):
         results["f"] = fit_results[1]
         results["Dp"] = fit_results[2]
 
-        return results
\ No newline at end of file
+        return results
+
+    def ivim_fit_full_volume(self, signals, **kwargs):
+        """Perform the IVIM fit on all voxels at once
+
+        Args:
+            signals (array-like): data with the b-values in the last dimension
+
+        Returns:
+            dict: parameter maps with the spatial shape of the input
+        """
+        bounds = ([self.bounds["D"][0], self.bounds["f"][0], self.bounds["Dp"][0], self.bounds["S0"][0]],
+                  [self.bounds["D"][1], self.bounds["f"][1], self.bounds["Dp"][1], self.bounds["S0"][1]])
+
+        shape = np.shape(signals)
+        signals = np.reshape(signals, (-1, shape[-1]))
+
+        # normalize the signal to the lowest b-value and only fit valid voxels
+        b0_indices = np.where(self.bvalues == np.min(self.bvalues))[0]
+        with np.errstate(invalid='ignore'):
+            normalization_factor = np.mean(signals[:, b0_indices], axis=-1)
+            valid_mask = np.all(np.isfinite(signals), axis=-1) & (normalization_factor > 0)
+        signals = signals[valid_mask] / normalization_factor[valid_mask, np.newaxis]
+
+        negative = np.any(signals < 0, axis=-1)
+        if np.any(negative):
+            signals[negative] = np.clip(signals[negative], 0.01, None)
+            warnings.warn('Negative values in signal: values clipped to 0.01', UserWarning, stacklevel=2)
+
+        D, f, Dp, _ = self.TF_reference_algorithm_array(self.bvalues, signals, b_cutoff=self.thresholds, bounds=bounds)
+
+        results = {}
+        for key, values in zip(["D", "f", "Dp"], [D, f, Dp]):
+            results[key] = np.zeros(shape[:-1])
+            results[key][valid_mask.reshape(shape[:-1])] = values
+
+        return results
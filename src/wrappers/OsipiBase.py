@@ -1,7 +1,9 @@
 import numpy as np
 import importlib
+import inspect
 from scipy.stats import norm
 import pathlib
+import os
 import sys
 import warnings
 from tqdm import tqdm
@@ -56,6 +58,13 @@ class OsipiBase:
         ones. User-provided bounds/initial_guess always take priority.
         See :mod:`src.wrappers.ivim_body_part_defaults` for available
         body parts and their literature-sourced parameter values.
+    engine : str, optional
+        Fitting engine for algorithms that have a compiled kernel in
+        :mod:`utilities.ivim.kernels`: "numba" (compiled, voxels looped in
+        parallel), "numpy" (vectorized NumPy) or "auto" (Numba if installed,
+        otherwise NumPy). Default None runs the algorithm's own
+        implementation. Algorithms without a kernel (``supported_engine``
+        is False) raise a ValueError.
     **kwargs
         Additional keyword arguments forwarded to the selected algorithm’s
         initializer if ``algorithm`` is provided.
@@ -68,6 +77,8 @@ class OsipiBase:
         Flags controlling whether bounds and initial guesses are applied.
     deep_learning, supervised, stochastic : bool
         Indicators for the algorithm type; subclasses may set these.
+    engine : str or None
+        Selected kernel engine, see the ``engine`` parameter.
     result_keys : list of str, optional
         Names of the output parameters (e.g., ["f", "Dp", "D"]).
     required_bvalues, required_thresholds, required_bounds,
@@ -85,6 +96,9 @@ class OsipiBase:
         automatic signal normalization.
     osipi_fit_full_volume(data, **kwargs)
         Full-volume fitting for algorithms that support it.
+    osipi_fit_chunked(data, chunk_size=None, **kwargs)
+        Masked, memory-bounded chunked fitting for algorithms that provide a
+        batched :meth:`ivim_fit_batch` kernel.
     osipi_print_requirements()
         Display algorithm requirements such as needed b-values or bounds.
     osipi_accepted_dimensions(), osipi_accepts_dimension(dim)
@@ -114,8 +128,11 @@ class OsipiBase:
     results = base.osipi_fit(dwi_data, njobs=4)
     f_map = results["f"]
     """
+
+    # Algorithms with a kernel in utilities.ivim.kernels set this to True and accept engine=
+    supported_engine = False
     
-    def __init__(self, bvalues=None, thresholds=None, bounds=None, initial_guess=None, algorithm=None, force_default_settings=True, body_part=None, **kwargs):
+    def __init__(self, bvalues=None, thresholds=None, bounds=None, initial_guess=None, algorithm=None, force_default_settings=True, body_part=None, engine=None, **kwargs):
         from src.wrappers.ivim_body_part_defaults import get_body_part_defaults
 
         # If initial_guess is a string, treat it as a body part name
@@ -134,6 +151,9 @@ class OsipiBase:
         self.supervised = False
         self.stochastic = False
         self.body_part = body_part  # Store for reference
+        if engine not in (None, "auto", "numba", "numpy"):
+            raise ValueError(f"Unknown engine '{engine}'. Use 'auto', 'numba' or 'numpy'.")
+        self.engine = engine
         
         if force_default_settings:
             if body_part is not None:
@@ -169,6 +189,8 @@ class OsipiBase:
         # If the user inputs an algorithm to OsipiBase, it is intereprete as initiating
         # an algorithm object with that name.
         if algorithm:
+            if engine is not None:
+                kwargs["engine"] = engine
             self.osipi_initiate_algorithm(algorithm, bvalues=self.bvalues, thresholds=self.thresholds, bounds=self.bounds, initial_guess=self.initial_guess, **kwargs)
             
     def osipi_initiate_algorithm(self, algorithm, **kwargs):
@@ -231,6 +253,9 @@ class OsipiBase:
                 f"Available names: {[n for n in dir(module) if not n.startswith('_')]}"
             ) from exc
 
+        if kwargs.get("engine") is not None and not algorithm_class.supported_engine:
+            raise ValueError(f"Algorithm '{algorithm}' has no kernel in utilities.ivim.kernels, so it does not support an engine.")
+
         # Change the class from OsipiBase to the specified algorithm
         self.__class__ = algorithm_class
         self.__init__(**kwargs)
@@ -431,6 +456,102 @@ class OsipiBase:
             return False
 
 
+    def osipi_fit_chunked(self, data, chunk_size=None, max_chunk_memory=2**28, normalize=True, njobs=1, **kwargs):
+        """
+        Fit a volume by handing blocks of voxels to the algorithm's batched kernel.
+
+        Voxels with non-finite signal or a non-positive signal at the minimum
+        b-value are masked out; the remaining voxels are flattened into a
+        (voxels x b-values) matrix and passed to ``self.ivim_fit_batch`` in
+        chunks, so peak memory is bounded by the chunk size rather than by the
+        size of the volume.
+
+        Parameters
+        ----------
+        data : np.ndarray
+            Multi-dimensional array with the b-values in the last dimension.
+        chunk_size : int, optional
+            Number of voxels per call to ``ivim_fit_batch``. If None, it is
+            derived from ``max_chunk_memory``.
+        max_chunk_memory : int, optional, default=2**28
+            Approximate memory budget in bytes for a single chunk, including
+            the temporaries of the fitting kernel. Only used if `chunk_size`
+            is None.
+        normalize : bool, optional, default=True
+            Normalize each voxel to the mean signal at the minimum b-value, as
+            is done in `osipi_fit`.
+        njobs : int, optional, default=1
+            Number of chunks fitted in parallel with joblib; -1 uses all cores.
+        **kwargs : dict, optional
+            Additional keyword arguments passed to `ivim_fit_batch`.
+
+        Returns
+        -------
+        results : dict of np.ndarray
+            Parameter maps with the spatial shape of `data`. Masked voxels are
+            set to 0, as in `osipi_fit`.
+
+        Notes
+        -----
+        If ``ivim_fit_batch`` takes an ``rng`` argument, every chunk gets its
+        own generator, spawned from ``kwargs["rng"]`` or else ``self.rng``.
+        For a given chunk size the result therefore does not depend on
+        `njobs`.
+        """
+        data = np.asarray(data)
+        if hasattr(self, "result_keys"):
+            result_keys = self.result_keys
+        else:
+            result_keys = ["f", "Dp", "D"]
+        spatial_shape = data.shape[:-1]
+        data = data.reshape(-1, data.shape[-1])
+
+        minimum_bvalue = np.min(self.bvalues)
+        b0_indices = np.where(self.bvalues == minimum_bvalue)[0]
+        with np.errstate(invalid='ignore'):
+            normalization_factor = np.mean(data[:, b0_indices], axis=-1)
+            valid_mask = np.all(np.isfinite(data), axis=-1) & (normalization_factor > 0)
+        valid_indices = np.flatnonzero(valid_mask)
+
+        if chunk_size is None:
+            # the kernels create roughly a dozen temporaries of the chunk's size
+            chunk_size = max_chunk_memory // (16 * data.shape[-1] * 8)
+            if njobs != 1:
+                # give every job a few chunks to balance the load
+                n_workers = os.cpu_count() if njobs < 0 else njobs
+                chunk_size = min(chunk_size, int(np.ceil(len(valid_indices) / (4 * n_workers))))
+        chunk_size = max(int(chunk_size), 1)
+
+        def chunk_data(indices):
+            chunk = np.array(data[indices], dtype=float)
+            if normalize:
+                chunk /= normalization_factor[indices, np.newaxis]
+            return chunk
+
+        chunks = [valid_indices[start:start + chunk_size] for start in range(0, len(valid_indices), chunk_size)]
+        chunk_kwargs = [kwargs] * len(chunks)
+        if "rng" in inspect.signature(self.ivim_fit_batch).parameters:
+            # parallel jobs would otherwise each draw from a copy of the same generator
+            rng = kwargs.get("rng", getattr(self, "rng", None))
+            if isinstance(rng, np.random.Generator):
+                rng = rng.integers(2**63)
+            chunk_kwargs = [{**kwargs, "rng": np.random.default_rng(seed)}
+                            for seed in np.random.SeedSequence(rng).spawn(len(chunks))]
+        if njobs == 1:
+            fits = (self.ivim_fit_batch(chunk_data(indices), **chunk_kw) for indices, chunk_kw in zip(chunks, chunk_kwargs))
+        else:
+            fits = Parallel(n_jobs=njobs)(delayed(self.ivim_fit_batch)(chunk_data(indices), **chunk_kw)
+                                          for indices, chunk_kw in zip(chunks, chunk_kwargs))
+
+        results = {key: np.zeros(len(data)) for key in result_keys}
+        for indices, fit in zip(chunks, fits):
+            for key in fit:
+                if key not in results:
+                    results[key] = np.zeros(len(data))
+                results[key][indices] = fit[key]
+
+        return {key: value.reshape(spatial_shape) for key, value in results.items()}
+
     def osipi_print_requirements(self):
         """
         Prints the requirements of the algorithm.
@@ -577,6 +698,14 @@ class OsipiBase:
 
     
     def D_and_Ds_swap(self,results):
+        if np.ndim(results['D']) > 0:
+            # batched results: swap voxel by voxel
+            swap = (results['D'] > results['Dp']) & (results['Dp'] < 0.05)
+            D = np.where(swap, results['Dp'], results['D'])
+            results['Dp'] = np.where(swap, results['D'], results['Dp'])
+            results['D'] = D
+            results['f'] = np.where(swap, 1 - results['f'], results['f'])
+            return results
         if results['D']>results['Dp'] and results['Dp'] < 0.05:
             D=results['Dp']
             results['Dp']=results['D']
@@ -0,0 +1,78 @@
+import numpy as np
+import numpy.testing as npt
+import pytest
+from scipy.io import savemat
+
+from utilities.data_simulation import Download_data
+from utilities.data_simulation.Download_data import (REQUIRED_FILES, download_data, file_checksum, load_mat_variable,
+                                                    read_manifest, write_manifest)
+from phantoms.MR_XCAT_qMRI.sim_ivim_sig import phantom
+
+#run using python -m pytest from the root folder
+
+
+@pytest.fixture
+def data_folder(tmp_path):
+    rng = np.random.default_rng(0)
+    for name in REQUIRED_FILES:
+        path = tmp_path / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        if name.endswith('.mat'):
+            savemat(path, {'IMG': rng.integers(0, 74, (8, 8, 160)).astype(np.uint8)})
+        else:
+            path.write_bytes(b'nifti')
+    return tmp_path
+
+
+def test_offline_cache(data_folder):
+    assert download_data(cache_dir=data_folder, offline=True) == data_folder
+    assert set(REQUIRED_FILES) <= set(read_manifest(data_folder))
+    assert download_data(cache_dir=data_folder, offline=True, verify=True) == data_folder
+    (data_folder / REQUIRED_FILES[-1]).write_bytes(b'truncated')
+    with pytest.raises(FileNotFoundError):
+        download_data(cache_dir=data_folder, offline=True)
+
+
+def test_published_checksums(data_folder, monkeypatch):
+    path = data_folder / REQUIRED_FILES[-1]
+    published = {REQUIRED_FILES[-1]: {'size': path.stat().st_size, 'sha256': file_checksum(path)}}
+    monkeypatch.setattr(Download_data, 'CHECKSUMS', published)
+    assert download_data(cache_dir=data_folder, offline=True, verify=True) == data_folder
+    # a corrupt file of the right size that made it into the manifest is only caught by the published checksum
+    path.write_bytes(b'NIFTI')
+    write_manifest(data_folder)
+    assert download_data(cache_dir=data_folder, offline=True) == data_folder
+    with pytest.raises(FileNotFoundError):
+        download_data(cache_dir=data_folder, offline=True, verify=True)
+
+
+def test_corrupt_download(data_folder, monkeypatch):
+    path = data_folder / REQUIRED_FILES[-1]
+    published = {REQUIRED_FILES[-1]: {'size': path.stat().st_size, 'sha256': file_checksum(path)}}
+    monkeypatch.setattr(Download_data, 'CHECKSUMS', published)
+    # a download that unpacks a corrupt file
+    monkeypatch.setattr(Download_data.subprocess, 'check_call', lambda *args, **kwargs: None)
+    monkeypatch.setattr(Download_data, 'unzip_file', lambda *args: path.write_bytes(b'NIFTI'))
+    with pytest.raises(OSError, match=REQUIRED_FILES[-1]):
+        download_data(force=True, cache_dir=data_folder, offline=False)
+
+
+def test_mat_variable_cache(data_folder):
+    download_data(cache_dir=data_folder, offline=True)
+    path = data_folder / REQUIRED_FILES[0]
+    first = load_mat_variable(path, 'IMG', data_folder)
+    assert isinstance(first, np.memmap) and first.shape == (8, 8, 160)
+    # the decoded volume is found by the content hash in the manifest, without reading the .mat file
+    path.unlink()
+    npt.assert_array_equal(load_mat_variable(path, 'IMG', data_folder), first)
+
+
+def test_phantom_from_cache(data_folder, monkeypatch):
+    monkeypatch.setenv('OSIPI_IVIM_DATA', str(data_folder))
+    monkeypatch.setenv('OSIPI_IVIM_OFFLINE', '1')
+    bvals = np.array([0, 10, 100, 800])
+    first = phantom(bvals, 0.01, motion=True)
+    again = phantom(bvals, 0.01, motion=True)
+    assert first[0].shape == (4, 4, 38, 4)
+    for a, b in zip(first[:5], again[:5]):
+        npt.assert_array_equal(a, b)
@@ -69,3 +69,52 @@ def test_linear(D, bvals, offset):
     real_mask = np.isfinite(gd_log_exponential)
     
     npt.assert_allclose(gd_log_exponential[real_mask], gd_signal[real_mask])
+
+
+def test_training_chunks_reproducible(tmp_path):
+    bvals = np.array([0, 10, 50, 100, 200, 400, 800])
+    gd = GenerateData()
+    chunks = list(gd.simulate_training_chunks(bvals, n=2500, chunk_size=1000, seed=7, SNR=(5, 100), rician_noise=True))
+    assert [len(chunk[0]) for chunk in chunks] == [1000, 1000, 500]
+    data = np.concatenate([chunk[0] for chunk in chunks])
+    npt.assert_allclose(data[:, 0], 1)
+    # every chunk can be simulated on its own, e.g. in another process
+    last = gd.simulate_training_chunk(bvals, 2, 1000, 2500, seed=7, SNR=(5, 100), rician_noise=True)
+    npt.assert_array_equal(last[0], chunks[2][0])
+    npt.assert_array_equal(last[3], chunks[2][3])
+    # written into a memmapped float32 array
+    out = np.lib.format.open_memmap(tmp_path / "data.npy", mode="w+", dtype=np.float32, shape=(2500, len(bvals)))
+    for _ in gd.simulate_training_chunks(bvals, n=2500, chunk_size=1000, seed=7, SNR=(5, 100), rician_noise=True, dtype=np.float32, out=out):
+        pass
+    out.flush()
+    npt.assert_allclose(np.load(tmp_path / "data.npy"), data, rtol=1e-6)
+
+
+def test_ivim_signal_maps():
+    rng = np.random.default_rng(3)
+    bvals = np.array([0, 10, 50, 200, 800])
+    D, Dp, f = rng.uniform(0, 3e-3, (4, 5)), rng.uniform(0.01, 0.1, (4, 5)), rng.uniform(0, 0.5, (4, 5))
+    gd = GenerateData()
+    signal = gd.ivim_signal(D, Dp, f, 100, bvals)
+    assert signal.shape == (4, 5, len(bvals))
+    npt.assert_allclose(signal[2, 3], gd.ivim_signal(D[2, 3], Dp[2, 3], f[2, 3], 100, bvals))
+    out = np.empty((4, 5, len(bvals)), dtype=np.float32)
+    assert gd.ivim_signal(D, Dp, f, 100, bvals, out=out, dtype='float32') is out
+    npt.assert_allclose(out, signal, rtol=1e-6)
+    noisy = GenerateData(rng=rng).ivim_signal(D, Dp, f, 100, bvals, snr=100, rician_noise=True)
+    assert noisy.shape == signal.shape and np.all(noisy >= 0)
+    # three compartments with a map of S0
+    signal = gd.multiexponential_signal([1e-3, 1e-2, 1e-1], [0.7, 0.2, 0.1], np.full((2, 3), 50.), bvals)
+    npt.assert_allclose(signal[1, 2], 50 * (0.7 * np.exp(-1e-3 * bvals) + 0.2 * np.exp(-1e-2 * bvals) + 0.1 * np.exp(-1e-1 * bvals)))
+
+
+def test_ivim_signal_torch():
+    torch = pytest.importorskip("torch")
+    bvals = np.array([0, 10, 50, 200, 800])
+    f = np.linspace(0, 0.4, 6).reshape(2, 3)
+    expected = GenerateData().ivim_signal(1e-3, 0.05, f, 1, bvals)
+    gd = GenerateData(operator=torch, rng=torch.Generator().manual_seed(0))
+    signal = gd.ivim_signal(1e-3, 0.05, torch.from_numpy(f), 1, bvals)
+    npt.assert_allclose(signal.numpy(), expected)
+    noisy = gd.ivim_signal(1e-3, 0.05, torch.from_numpy(f), 1, bvals, snr=50, rician_noise=True, dtype='float32')
+    assert noisy.dtype == torch.float32 and noisy.shape == (2, 3, len(bvals))
@@ -0,0 +1,99 @@
+import numpy as np
+import numpy.testing as npt
+import pytest
+
+from phantoms.MR_XCAT_qMRI.sim_ivim_sig import XCAT_to_MR_IVIM, contrast_curve_calc, motion_schedule
+
+#run using python -m pytest from the root folder
+
+bvalues = np.array([0, 5, 10, 20, 50, 100, 200, 400, 600, 800], dtype=float)
+n_tissues = 74
+
+
+def label_volume(dtype):
+    # a small XCAT-like label volume with every tissue, background and labels that match no tissue
+    rng = np.random.default_rng(0)
+    labels = rng.integers(0, n_tissues, (9, 7, 5)).astype(dtype)
+    labels[0, 0, :] = [255, 74, 0, 73, 1] if dtype == np.uint8 else [999, -1, 74, 0, 73]
+    if np.issubdtype(dtype, np.floating):
+        labels[1, 0, :] = [2.5, -0.5, 73.9, np.nan, 1]
+    return labels
+
+
+def masked_XCAT_to_MR_IVIM(XCAT, T1T2, seed):
+    # the per-tissue masked assignment XCAT_to_MR_IVIM used before the look-up table; the signal and parameters of
+    # every tissue are taken from a volume with one voxel per tissue, drawing the random parameters in the same order
+    D, f, Ds = contrast_curve_calc()
+    np.random.seed(seed)
+    MR_tissue, D_tissue, f_tissue, Dp_tissue, _ = XCAT_to_MR_IVIM(np.arange(n_tissues), 3000, 40, bvalues, D, f, Ds,
+                                                                   T1T2=T1T2)
+    MR = np.zeros(XCAT.shape + (len(bvalues),))
+    Dim, fim, Dpim = np.zeros(XCAT.shape), np.zeros(XCAT.shape), np.zeros(XCAT.shape)
+    for iTissue in range(1, n_tissues):
+        MR = MR + np.tile(np.expand_dims(XCAT == iTissue, 3), len(bvalues)) * MR_tissue[iTissue]
+        Dim = Dim + (XCAT == iTissue) * D_tissue[iTissue]
+        fim = fim + (XCAT == iTissue) * f_tissue[iTissue]
+        Dpim = Dpim + (XCAT == iTissue) * Dp_tissue[iTissue]
+    return MR, Dim, fim, Dpim
+
+
+@pytest.mark.parametrize("label_dtype", [np.uint8, np.int16, np.float64])
+@pytest.mark.parametrize("T1T2", [True, False])
+def test_lookup_table_matches_masked_assignment(label_dtype, T1T2):
+    XCAT = label_volume(label_dtype)
+    expected = masked_XCAT_to_MR_IVIM(XCAT, T1T2, seed=42)
+    D, f, Ds = contrast_curve_calc()
+    np.random.seed(42)
+    MR, Dim, fim, Dpim, _ = XCAT_to_MR_IVIM(XCAT, 3000, 40, bvalues, D, f, Ds, T1T2=T1T2)
+    assert MR.shape == XCAT.shape + (len(bvalues),) and MR.dtype == np.float64
+    for result, reference in zip((MR, Dim, fim, Dpim), expected):
+        npt.assert_array_equal(result, reference)
+    # labels that match no tissue are background
+    assert not np.any(MR[0, 0, :3]) and not np.any(Dim[0, 0, :3])
+
+
+@pytest.mark.parametrize("T1T2", [True, False])
+def test_lookup_table_dtype_and_out(T1T2):
+    XCAT = label_volume(np.float64)
+    expected = masked_XCAT_to_MR_IVIM(XCAT, T1T2, seed=42)
+    D, f, Ds = contrast_curve_calc()
+    out = np.full(XCAT.shape + (len(bvalues),), np.nan, dtype=np.float32)
+    np.random.seed(42)
+    MR, Dim, fim, Dpim, _ = XCAT_to_MR_IVIM(XCAT, 3000, 40, bvalues, D, f, Ds, T1T2=T1T2, dtype=np.float32, out=out)
+    assert MR is out
+    for result, reference in zip((MR, Dim, fim, Dpim), expected):
+        assert result.dtype == np.float32
+        npt.assert_array_equal(result, reference.astype(np.float32))
+
+
+def counter_motion_schedule(n_slices, n_bvalues, slices_per_resp_phase, interleaved, n_states):
+    # the loop counters phantom() advanced the respiratory state with before motion_schedule
+    schedule = np.full((n_slices, n_bvalues), -1)
+    state = 0
+    state2 = 0
+    for b in range(n_bvalues):
+        if not interleaved:
+            order = range(n_slices)
+        else:
+            order = list(range(0, n_slices, 2)) + list(range(1, n_slices, 2))
+        for a in order:
+            schedule[a, b] = state
+            if state2 == slices_per_resp_phase:
+                state2 = 0
+                state = state + 1
+                if state == n_states:
+                    state = 0
+            else:
+                state2 = state2 + 1
+    return schedule
+
+
+@pytest.mark.parametrize("interleaved", [False, True])
+@pytest.mark.parametrize("n_slices", [38, 7, 1])
+@pytest.mark.parametrize("slices_per_resp_phase", [0, 1, 3, 5, 40])
+def test_motion_schedule_matches_counters(interleaved, n_slices, slices_per_resp_phase):
+    for n_bvalues, n_states in [(13, 20), (4, 3)]:
+        schedule = motion_schedule(n_slices, n_bvalues, slices_per_resp_phase, interleaved, n_states)
+        expected = counter_motion_schedule(n_slices, n_bvalues, slices_per_resp_phase, interleaved, n_states)
+        npt.assert_array_equal(schedule, expected)
+        assert schedule.min() >= 0 and schedule.max() < n_states
@@ -0,0 +1,71 @@
+import json
+import multiprocessing
+import os
+import time
+import numpy as np
+import pytest
+from utilities.ivim.artifact_store import ArtifactStore, artifact_key, default_artifact_dir
+#run using python -m pytest from the root folder
+
+
+def params(SNR=100):
+    return {"bvalues": np.array([0, 10, 50, 200, 800]), "SNR": SNR, "lr": 1e-4}
+
+
+def test_key_depends_on_parameters():
+    assert artifact_key(params()) == artifact_key({**params(), "bvalues": [0, 10, 50, 200, 800]})
+    assert artifact_key(params()) != artifact_key(params(SNR=20))
+
+
+def create_model(path, calls):
+    # one file per call, such that calls from every process are counted
+    (calls / str(os.getpid())).write_text("called")
+    time.sleep(0.5)
+    (path / "model.pt").write_text("weights")
+
+
+def get_or_create_model(root, calls, barrier):
+    barrier.wait()
+    return str(ArtifactStore(root).get_or_create(params(), lambda path: create_model(path, calls)))
+
+
+def test_concurrent_workers_create_once(tmp_path):
+    store = ArtifactStore(tmp_path / "store")
+    calls = tmp_path / "calls"
+    calls.mkdir()
+    workers = 4
+    context = multiprocessing.get_context("spawn")
+    with context.Manager() as manager, context.Pool(workers) as pool:
+        # start the workers together, such that they race for the lock
+        barrier = manager.Barrier(workers)
+        paths = pool.starmap(get_or_create_model, [(store.root, calls, barrier)] * workers)
+    assert len(list(calls.iterdir())) == 1
+    assert set(paths) == {str(store.path(params()))}
+    assert (store.path(params()) / "model.pt").read_text() == "weights"
+    with open(store.path(params()) / "artifact.json") as f:
+        assert json.load(f)["bvalues"] == [0, 10, 50, 200, 800]
+    # only the finished artifact and its lock file are left
+    name = store.path(params()).name
+    assert sorted(p.name for p in store.root.iterdir()) == sorted([name, f".{name}.lock"])
+
+
+def test_failed_creation_leaves_no_artifact(tmp_path):
+    store = ArtifactStore(tmp_path)
+
+    def create(path):
+        (path / "model.pt").write_text("partial")
+        raise RuntimeError("training failed")
+
+    with pytest.raises(RuntimeError):
+        store.get_or_create(params(), create)
+    assert not store.exists(params()) and not store.path(params()).exists()
+    assert store.get_or_create(params(), lambda path: None) == store.path(params())
+
+
+def test_default_artifact_dir(tmp_path, monkeypatch):
+    monkeypatch.delenv("OSIPI_IVIM_ARTIFACTS", raising=False)
+    monkeypatch.chdir(tmp_path)
+    # independent of the working directory
+    assert default_artifact_dir().is_absolute() and tmp_path not in default_artifact_dir().parents
+    monkeypatch.setenv("OSIPI_IVIM_ARTIFACTS", str(tmp_path / "store"))
+    assert default_artifact_dir() == tmp_path / "store"
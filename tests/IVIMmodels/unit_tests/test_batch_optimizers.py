@@ -0,0 +1,71 @@
+import numpy as np
+import pytest
+from src.original.fitting.IAR_LundUniversity.batch_optimizers import fractions_lsq
+#run using python -m pytest from the root folder
+
+bvalues = np.array([0, 5, 10, 20, 50, 100, 200, 400, 600, 800], dtype=float) / 1000
+
+# bounds of the volume fractions used by IAR_LU_modified_mix and IAR_LU_modified_topopro
+constraint_sets = [
+    ((0.011, 0.011), (0.7, 0.89)),
+    ((1e-7, 1e-7), (0.9, 0.9)),
+]
+
+
+def fraction_problems(n=40, seed=0):
+    rng = np.random.default_rng(seed)
+    Dp = rng.uniform(5, 100, n)
+    D = rng.uniform(0.5, 3, n)
+    phi = np.stack((np.exp(-np.outer(Dp, bvalues)), np.exp(-np.outer(D, bvalues))), axis=-1)
+    # perfusion fractions inside and on both sides of the bounds, so every active set occurs
+    f = rng.uniform(-0.2, 1.2, n)
+    signal = f[:, np.newaxis] * phi[..., 0] + (1 - f[:, np.newaxis]) * phi[..., 1]
+    signal += rng.normal(0, 0.02, signal.shape)
+    return phi, signal
+
+
+def cost(phi, signal, f):
+    # sum of squared residuals for perfusion fraction(s) f and diffusion fraction 1 - f
+    f = np.asarray(f)[..., np.newaxis]
+    return np.sum((f * phi[:, 0] + (1 - f) * phi[:, 1] - signal) ** 2, axis=-1)
+
+
+@pytest.mark.parametrize("lower, upper", constraint_sets)
+def test_fractions_lsq_matches_grid_search(lower, upper):
+    phi, signal = fraction_problems()
+    fractions = fractions_lsq(phi, signal, lower, upper)
+    f_min, f_max = max(lower[0], 1 - upper[1]), min(upper[0], 1 - lower[1])
+    grid = np.linspace(f_min, f_max, 20001)
+    np.testing.assert_allclose(np.sum(fractions, axis=-1), 1)
+    for i in range(len(signal)):
+        assert np.all(fractions[i] >= np.array(lower) - 1e-12) and np.all(fractions[i] <= np.array(upper) + 1e-12)
+        grid_cost = cost(phi[i], signal[i], grid)
+        assert cost(phi[i], signal[i], fractions[i, 0]) <= np.min(grid_cost) + 1e-12
+        assert abs(fractions[i, 0] - grid[np.argmin(grid_cost)]) <= grid[1] - grid[0]
+
+
+@pytest.mark.parametrize("lower, upper", constraint_sets)
+def test_fractions_lsq_matches_cvxpy(lower, upper):
+    cvxpy = pytest.importorskip("cvxpy")
+    phi, signal = fraction_problems(n=10, seed=1)
+    fractions = fractions_lsq(phi, signal, lower, upper)
+    for i in range(len(signal)):
+        # the convex problem the IAR models solved before the closed form
+        f = cvxpy.Variable(2)
+        constraints = [cvxpy.sum(f) == 1, f[0] >= lower[0], f[1] >= lower[1], f[0] <= upper[0], f[1] <= upper[1]]
+        cvxpy.Problem(cvxpy.Minimize(cvxpy.sum(cvxpy.square(phi[i] @ f - signal[i]))), constraints).solve()
+        np.testing.assert_allclose(fractions[i], f.value, atol=1e-5)
+
+
+def test_fractions_lsq_infeasible_bounds():
+    phi, signal = fraction_problems(n=3)
+    # f[0] <= 0.05 and f[1] <= 0.89 cannot sum to 1
+    lower, upper = (0.011, 0.011), (0.05, 0.89)
+    with pytest.raises(ValueError):
+        fractions_lsq(phi, signal, lower, upper)
+    cvxpy = pytest.importorskip("cvxpy")
+    f = cvxpy.Variable(2)
+    constraints = [cvxpy.sum(f) == 1, f[0] >= lower[0], f[1] >= lower[1], f[0] <= upper[0], f[1] <= upper[1]]
+    problem = cvxpy.Problem(cvxpy.Minimize(cvxpy.sum(cvxpy.square(phi[0] @ f - signal[0]))), constraints)
+    problem.solve()
+    assert problem.status == cvxpy.INFEASIBLE
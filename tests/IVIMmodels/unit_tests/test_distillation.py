@@ -0,0 +1,25 @@
+import numpy as np
+import torch
+from src.wrappers.OsipiBase import OsipiBase
+from utilities.data_simulation.GenerateData import GenerateData
+#run using python -m pytest from the root folder
+
+bvals = np.array([0, 5, 10, 20, 30, 50, 75, 100, 150, 250, 400, 600, 800])
+
+
+def test_surrogate_reproduces_teacher(tmp_path):
+    settings = dict(bvalues=bvals, algorithm="IVIM_distilled", teacher="OGC_AmsterdamUMC_biexp_segmented", n=3000, njobs=1, cache_dir=tmp_path)
+    surrogate = OsipiBase(**settings)
+    teacher = OsipiBase(bvalues=bvals, algorithm="OGC_AmsterdamUMC_biexp_segmented")
+    data = GenerateData(rng=np.random.default_rng(5)).simulate_training_data(bvals, SNR=100, n=200)[0]
+    expected = teacher.osipi_fit(data)
+    fit = surrogate.osipi_fit_full_volume(data.reshape(10, 20, len(bvals)))
+    assert fit["D"].shape == (10, 20)
+    assert np.median(np.abs(fit["D"].ravel() - expected["D"])) < 2e-4
+    assert np.median(np.abs(fit["f"].ravel() - expected["f"])) < 0.05
+    # voxelwise and full volume fits agree
+    np.testing.assert_allclose(surrogate.osipi_fit(data[:5])["D"], fit["D"][0, :5], rtol=1e-6)
+    # the trained surrogate is loaded from the cache
+    cached = OsipiBase(**settings)
+    for key, value in surrogate.net.state_dict().items():
+        assert torch.equal(cached.net.state_dict()[key], value)
@@ -0,0 +1,90 @@
+import numpy as np
+import pytest
+from scipy import stats
+from scipy.optimize import approx_fprime
+from src.original.fitting.OGC_AmsterdamUMC.LSQ_fitting import (empirical_neg_log_prior, ivim, neg_log_posterior,
+                                                               neg_log_posterior_gradient)
+#run using python -m pytest from the root folder
+
+bvalues = np.array([0, 5, 10, 20, 50, 100, 200, 400, 600, 800], dtype=float)
+
+
+def initial_estimates(n=500, seed=0):
+    rng = np.random.default_rng(seed)
+    Dt0 = rng.lognormal(np.log(1.2e-3), 0.3, n)
+    Fp0 = rng.beta(2, 12, n)
+    Dp0 = rng.lognormal(np.log(3e-2), 0.5, n)
+    S00 = rng.beta(40, 40, n) * 2
+    return Dt0, Fp0, Dp0, S00
+
+
+def scipy_neg_log_prior(prior, p):
+    # the closure over the frozen scipy distributions that empirical_neg_log_prior used to return
+    if p[2] < p[0]:
+        return 1e8
+    eps = 1e-8
+    neg_log_prior = (-np.log(stats.lognorm.pdf(p[2], prior.Dp_lognorm[0], scale=prior.Dp_lognorm[1]) + eps)
+                     - np.log(stats.lognorm.pdf(p[0], prior.Dt_lognorm[0], scale=prior.Dt_lognorm[1]) + eps)
+                     - np.log(stats.beta.pdf(p[1], *prior.Fp_beta) + eps))
+    if len(p) == 4:
+        neg_log_prior -= np.log(stats.beta.pdf(p[3] / 2, *prior.S0_beta) + eps)
+    return neg_log_prior
+
+
+# D, f, D* (and S0): typical values, values in the tails, f and S0 on and outside the edges of their support, and D* < D
+points = [
+    [1.2e-3, 0.15, 3e-2],
+    [3e-4, 0.02, 0.2],
+    [2.5e-3, 0.6, 5e-3],
+    [1.2e-3, 0.0, 3e-2],
+    [1.2e-3, 1.0, 3e-2],
+    [1.2e-3, -0.1, 3e-2],
+    [-1e-4, 0.15, 3e-2],
+    [2e-3, 0.15, 1e-3],
+]
+
+
+@pytest.mark.parametrize("fit_S0", [False, True])
+def test_prior_matches_scipy(fit_S0):
+    Dt0, Fp0, Dp0, S00 = initial_estimates()
+    prior = empirical_neg_log_prior(Dt0, Fp0, Dp0, S00 if fit_S0 else None)
+    p = np.array(points)
+    if fit_S0:
+        p = np.column_stack((p, np.linspace(0.5, 2.5, len(p))))
+    reference = np.array([scipy_neg_log_prior(prior, point) for point in p])
+    # scalar parameters
+    for point, expected in zip(p, reference):
+        np.testing.assert_allclose(prior(point), expected, rtol=1e-10)
+        assert np.ndim(prior(point)) == 0
+    # arrays of parameters, along the first axis
+    np.testing.assert_allclose(prior(p.T), reference, rtol=1e-10)
+    np.testing.assert_allclose(prior(p.T.reshape(p.shape[1], 2, -1)), reference.reshape(2, -1), rtol=1e-10)
+
+
+@pytest.mark.parametrize("fit_S0", [False, True])
+def test_prior_gradient_matches_finite_differences(fit_S0):
+    Dt0, Fp0, Dp0, S00 = initial_estimates()
+    prior = empirical_neg_log_prior(Dt0, Fp0, Dp0, S00 if fit_S0 else None)
+    for point in points[:3]:
+        p = np.array(point + [1.05] if fit_S0 else point)
+        step = 1e-7 * np.abs(p)
+        np.testing.assert_allclose(prior.gradient(p), approx_fprime(p, prior, step), rtol=1e-4)
+    # a gradient per voxel for arrays of parameters
+    p = np.array(points[:3]).T
+    if fit_S0:
+        p = np.vstack((p, [1.05, 0.9, 1.2]))
+    gradient = prior.gradient(p)
+    for i in range(p.shape[1]):
+        np.testing.assert_allclose(gradient[:, i], prior.gradient(p[:, i]), rtol=1e-12)
+
+
+@pytest.mark.parametrize("fit_S0", [False, True])
+def test_posterior_gradient_matches_finite_differences(fit_S0):
+    Dt0, Fp0, Dp0, S00 = initial_estimates()
+    prior = empirical_neg_log_prior(Dt0, Fp0, Dp0, S00 if fit_S0 else None)
+    rng = np.random.default_rng(1)
+    dw_data = ivim(bvalues, 1.1e-3, 0.12, 2.5e-2, 1.0) + rng.normal(0, 0.01, len(bvalues))
+    p = np.array([1.3e-3, 0.1, 3e-2, 1.02] if fit_S0 else [1.3e-3, 0.1, 3e-2])
+    step = 1e-7 * np.abs(p)
+    expected = approx_fprime(p, neg_log_posterior, step, bvalues, dw_data, prior)
+    np.testing.assert_allclose(neg_log_posterior_gradient(p, bvalues, dw_data, prior), expected, rtol=1e-4)
@@ -0,0 +1,195 @@
+import json
+import pathlib
+import numpy as np
+import pytest
+from src.wrappers.OsipiBase import OsipiBase
+#run using python -m pytest from the root folder
+
+# Algorithms whose ivim_fit_full_volume uses a dedicated batched engine; the
+# batched result should reproduce the voxel-wise osipi_fit result.
+full_volume_algorithms = [
+    ("DT_IIITN_WLS", {"method": "WLS"}, {"f": 1e-6, "D": 1e-8, "Dp": 1e-4}),
+    ("DT_IIITN_WLS", {"method": "RLM"}, {"f": 1e-6, "D": 1e-8, "Dp": 1e-4}),
+    ("TF_reference_IVIMfit", {}, {"f": 1e-6, "D": 1e-8, "Dp": 1e-3}),
+    ("PvH_KB_NKI_IVIMfit", {}, {"f": 1e-6, "D": 1e-8, "Dp": 1e-4}),
+    ("OJ_GU_seg", {}, {"f": 1e-6, "D": 1e-8, "Dp": 1e-4}),
+    ("IAR_LU_segmented_2step", {}, {"f": 1e-4, "D": 1e-7, "Dp": 1e-4}),
+    ("IAR_LU_segmented_3step", {}, {"f": 1e-4, "D": 1e-7, "Dp": 1e-4}),
+    ("IAR_LU_subtracted", {}, {"f": 1e-4, "D": 1e-7, "Dp": 1e-4}),
+    ("OGC_AmsterdamUMC_biexp", {}, {"f": 1e-6, "D": 1e-8, "Dp": 1e-4}),
+    ("TCML_TechnionIIT_lsqlm", {}, {"f": 1e-6, "D": 1e-8, "Dp": 1e-4}),
+    ("TCML_TechnionIIT_lsqtrf", {}, {"f": 1e-6, "D": 1e-8, "Dp": 1e-4}),
+    ("TCML_TechnionIIT_lsqBOBYQA", {}, {"f": 1e-6, "D": 1e-8, "Dp": 1e-4}),
+    ("TCML_TechnionIIT_SLS", {}, {"f": 1e-6, "D": 1e-8, "Dp": 1e-4}),
+    ("TCML_TechnionIIT_lsq_sls_lm", {}, {"f": 1e-6, "D": 1e-8, "Dp": 1e-4}),
+    ("TCML_TechnionIIT_lsq_sls_trf", {}, {"f": 1e-6, "D": 1e-8, "Dp": 1e-4}),
+    ("TCML_TechnionIIT_lsq_sls_BOBYQA", {}, {"f": 1e-6, "D": 1e-8, "Dp": 1e-4}),
+]
+
+# Stochastic algorithms with a batched engine; their voxel-wise result is not
+# reproducible, so the batched fit is checked against the noise-free truth.
+stochastic_full_volume_algorithms = [
+    ("IAR_LU_modified_mix", {}, {"f": 1e-2, "D": 2e-5, "Dp": 2e-3}),
+    ("IAR_LU_modified_topopro", {}, {"f": 1e-2, "D": 2e-5, "Dp": 2e-3}),
+    ("OJ_GU_bayes", {}, {"f": 1e-2, "D": 2e-5, "Dp": 2e-3}),
+]
+
+
+def generic_signals(filename="generic.json"):
+    data_path = pathlib.Path(__file__).resolve().parent / filename
+    with data_path.open() as f:
+        all_data = json.load(f)
+    bvals = np.array(all_data.pop('config')['bvalues'])
+    signals = np.array([data["data"] for data in all_data.values()])
+    signals = signals / signals[:, [0]]
+    return bvals, signals
+
+
+def generic_truth(filename="generic.json"):
+    data_path = pathlib.Path(__file__).resolve().parent / filename
+    with data_path.open() as f:
+        all_data = json.load(f)
+    all_data.pop('config')
+    return {key: np.array([data[key] for data in all_data.values()]) for key in ["f", "D", "Dp"]}
+
+
+@pytest.mark.parametrize("algorithm, kwargs, atol", full_volume_algorithms)
+def test_full_volume_matches_voxelwise(algorithm, kwargs, atol):
+    bvals, signals = generic_signals()
+    # lay the voxels out as a small 3D volume
+    volume = signals[:12].reshape(2, 3, 2, -1)
+    fit = OsipiBase(algorithm=algorithm, bvalues=bvals, **kwargs)
+    voxelwise = fit.osipi_fit(volume.copy())
+    full_volume = fit.osipi_fit_full_volume(volume.copy())
+    assert full_volume is not False, f"Full volume fitting failed for {algorithm}"
+    for key in ["f", "D", "Dp"]:
+        assert np.shape(full_volume[key]) == volume.shape[:-1]
+        np.testing.assert_allclose(full_volume[key], voxelwise[key], rtol=1e-3, atol=atol[key], err_msg=f"{algorithm} {key}")
+
+
+@pytest.mark.parametrize("algorithm, kwargs, atol", full_volume_algorithms)
+def test_full_volume_invalid_voxels(algorithm, kwargs, atol):
+    bvals, signals = generic_signals()
+    volume = signals[:6].copy()
+    volume[1, :] = np.nan
+    volume[4, :] = 0
+    fit = OsipiBase(algorithm=algorithm, bvalues=bvals, **kwargs)
+    full_volume = fit.osipi_fit_full_volume(volume)
+    assert full_volume is not False, f"Full volume fitting failed for {algorithm}"
+    for key in ["f", "D", "Dp"]:
+        assert np.all(np.isfinite(full_volume[key][[0, 2, 3, 5]]))
+
+
+@pytest.mark.parametrize("algorithm, kwargs, atol", stochastic_full_volume_algorithms)
+def test_full_volume_stochastic(algorithm, kwargs, atol):
+    bvals, signals = generic_signals()
+    truth = generic_truth()
+    fit = OsipiBase(algorithm=algorithm, bvalues=bvals, **kwargs)
+    full_volume = fit.osipi_fit_full_volume(signals.copy(), rng=0)
+    assert full_volume is not False, f"Full volume fitting failed for {algorithm}"
+    for key in ["f", "D", "Dp"]:
+        np.testing.assert_allclose(full_volume[key], truth[key], rtol=0, atol=atol[key], err_msg=f"{algorithm} {key}")
+
+    # masked voxels are left at zero
+    volume = signals[:6].copy()
+    volume[1, :] = np.nan
+    full_volume = fit.osipi_fit_full_volume(volume, rng=0)
+    for key in ["f", "D", "Dp"]:
+        assert full_volume[key][1] == 0
+        assert np.all(np.isfinite(full_volume[key]))
+
+
+@pytest.mark.parametrize("chunk_size", [1, 5, None])
+def test_fit_chunked_chunk_size(chunk_size):
+    bvals, signals = generic_signals()
+    fit = OsipiBase(algorithm="OJ_GU_seg", bvalues=bvals)
+    reference = fit.osipi_fit_chunked(signals, chunk_size=len(signals))
+    chunked = fit.osipi_fit_chunked(signals, chunk_size=chunk_size)
+    for key in ["f", "D", "Dp"]:
+        np.testing.assert_allclose(chunked[key], reference[key], rtol=1e-10, atol=1e-12)
+
+
+@pytest.mark.parametrize("algorithm", ["IAR_LU_biexp", "OJ_GU_seg", "OGC_AmsterdamUMC_biexp", "TCML_TechnionIIT_lsq_sls_trf"])
+def test_full_volume_parallel(algorithm):
+    bvals, signals = generic_signals()
+    volume = signals[:12].reshape(2, 3, 2, -1)
+    fit = OsipiBase(algorithm=algorithm, bvalues=bvals)
+    serial = fit.osipi_fit_full_volume(volume.copy())
+    parallel = fit.osipi_fit_full_volume(volume.copy(), njobs=2)
+    assert parallel is not False, f"Parallel full volume fitting failed for {algorithm}"
+    for key in ["f", "D", "Dp"]:
+        np.testing.assert_allclose(parallel[key], serial[key], rtol=1e-10, atol=1e-12)
+
+
+def test_bayes_uncertainty_maps():
+    bvals, signals = generic_signals()
+    volume = signals[:6].reshape(2, 3, -1)
+    fit = OsipiBase(algorithm="OJ_GU_bayes", bvalues=bvals, uncertainty=True, central_tendency="median", rng=0)
+    full_volume = fit.osipi_fit_full_volume(volume.copy())
+    for key in ["f", "D", "Dp"]:
+        for suffix in ["_std", "_ci_low", "_ci_high"]:
+            assert np.shape(full_volume[key + suffix]) == volume.shape[:-1]
+        assert np.all(full_volume[key + "_ci_low"] <= full_volume[key])
+        assert np.all(full_volume[key] <= full_volume[key + "_ci_high"])
+        assert np.all(full_volume[key + "_std"] > 0)
+
+
+@pytest.mark.parametrize("algorithm", ["TCML_TechnionIIT_lsq_sls_lm", "TCML_TechnionIIT_lsq_sls_trf", "TCML_TechnionIIT_lsq_sls_BOBYQA"])
+def test_sls_batch_keeps_voxels_aligned(algorithm):
+    bvals, signals = generic_signals()
+    batch = signals[:6].copy()
+    # the SLS initialization fails on this voxel
+    batch[1, :] = 0
+    fit = OsipiBase(algorithm=algorithm, bvalues=bvals)
+    voxelwise = [fit.ivim_fit(signal.copy()) for signal in batch]
+    # the batch does not fall back to fitting the voxels one by one
+    fit.ivim_fit = None
+    batched = fit.ivim_fit_batch(batch.copy())
+    for i, voxel in enumerate(voxelwise):
+        for key in ["f", "D", "Dp"]:
+            np.testing.assert_allclose(batched[key][i], voxel[key], rtol=1e-6, atol=1e-10, err_msg=f"{algorithm} {key} voxel {i}")
+
+
+@pytest.mark.parametrize("algorithm", ["IAR_LU_modified_mix", "IAR_LU_modified_topopro"])
+def test_batch_zero_voxel(algorithm):
+    bvals, signals = generic_signals()
+    batch = signals[:4].copy()
+    batch[2, :] = 0
+    fit = OsipiBase(algorithm=algorithm, bvalues=bvals)
+    # the batch is passed straight to the model, without the masking of osipi_fit_chunked
+    results = fit.ivim_fit_batch(batch)
+    for key in ["f", "D", "Dp"]:
+        assert np.all(np.isfinite(results[key])), f"{algorithm} {key}"
+
+
+def test_full_volume_without_b0():
+    bvals, signals = generic_signals()
+    keep = bvals > 0
+    reference = OsipiBase(algorithm="TF_reference_IVIMfit", bvalues=bvals).osipi_fit_full_volume(signals[:6].copy())
+    # the signal is normalised to the lowest b-value instead
+    fit = OsipiBase(algorithm="TF_reference_IVIMfit", bvalues=bvals[keep]).osipi_fit_full_volume(signals[:6, keep].copy())
+    for key in ["f", "D", "Dp"]:
+        assert np.all(np.isfinite(fit[key])) and np.all(fit[key] > 0), key
+    # D is fitted on the log signal, so it does not depend on the normalisation
+    np.testing.assert_allclose(fit["D"], reference["D"], rtol=1e-6)
+
+
+@pytest.mark.parametrize("algorithm, kwargs, fit_kwargs", [
+    ("OJ_GU_bayes", {"rng": 0}, {}),
+    ("IAR_LU_modified_mix", {}, {"rng": 0}),
+])
+def test_stochastic_chunks_do_not_depend_on_njobs(algorithm, kwargs, fit_kwargs):
+    bvals, signals = generic_signals()
+    volume = signals[:8].reshape(2, 4, -1)
+    fits = [OsipiBase(algorithm=algorithm, bvalues=bvals, **kwargs).osipi_fit_full_volume(volume.copy(), njobs=njobs, chunk_size=2, **fit_kwargs)
+            for njobs in [1, 2]]
+    for key in ["f", "D", "Dp"]:
+        np.testing.assert_array_equal(fits[1][key], fits[0][key], err_msg=f"{algorithm} {key}")
+
+
+def test_stochastic_chunks_draw_independent_streams():
+    bvals, signals = generic_signals()
+    # the same voxel in every chunk
+    volume = np.repeat(signals[:1], 4, axis=0)
+    fit = OsipiBase(algorithm="OJ_GU_bayes", bvalues=bvals, rng=0).osipi_fit_full_volume(volume, njobs=2, chunk_size=1)
+    assert len(np.unique(fit["f"])) == 4
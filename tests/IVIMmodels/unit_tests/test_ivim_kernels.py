@@ -0,0 +1,123 @@
+import os
+import pathlib
+import subprocess
+import sys
+import numpy as np
+import pytest
+from src.wrappers.OsipiBase import OsipiBase
+from utilities.ivim import kernels
+from utilities.ivim.ivim_models import biexp
+from tests.IVIMmodels.unit_tests.test_ivim_fit_full_volume import generic_signals
+#run using python -m pytest from the root folder
+
+bounds = ([0, 0, 0.005, 0.7], [0.005, 1.0, 0.2, 1.3])
+p0 = [0.001, 0.1, 0.01, 1]
+
+kernel_fits = [
+    ("biexp", lambda b, s, engine: kernels.fit_biexp(b, s, p0, bounds, engine=engine)),
+    ("biexp_noS0", lambda b, s, engine: kernels.fit_biexp(b, s, p0, bounds, fit_S0=False, engine=engine)),
+    ("segmented", lambda b, s, engine: kernels.fit_segmented(b, s, 200, bounds, p0, engine=engine)),
+    ("monoexp_wls", lambda b, s, engine: kernels.fit_monoexp_wls(b, s, engine=engine)),
+]
+
+
+def test_biexp_kernel_recovers_parameters():
+    bvals = np.array([0, 5, 10, 20, 30, 50, 75, 100, 150, 250, 400, 600, 800], dtype=float)
+    truth = np.array([[0.001, 0.1, 0.02, 1.0], [0.0015, 0.3, 0.05, 0.9], [0.0005, 0.05, 0.1, 1.1]])
+    signals = biexp(bvals, truth[:, 0:1], truth[:, 1:2], truth[:, 2:3], truth[:, 3:4])
+    params = kernels.fit_biexp(bvals, signals, p0, bounds, engine="numpy")
+    np.testing.assert_allclose(params, truth, rtol=1e-5)
+
+
+@pytest.mark.skipif(not kernels.NUMBA_AVAILABLE, reason="numba is not installed")
+@pytest.mark.parametrize("name, fit", kernel_fits)
+def test_numba_and_numpy_engines_agree(name, fit):
+    bvals, signals = generic_signals()
+    compiled = fit(bvals, signals, "numba")
+    vectorized = fit(bvals, signals, "numpy")
+    np.testing.assert_allclose(compiled, vectorized, rtol=1e-6, atol=1e-12, err_msg=name)
+
+
+def test_numba_engine_falls_back_to_numpy(monkeypatch):
+    monkeypatch.setattr(kernels, "NUMBA_AVAILABLE", False)
+    with pytest.warns(UserWarning, match="numba"):
+        assert kernels.resolve_engine("numba") == "numpy"
+    assert kernels.resolve_engine("auto") == "numpy"
+    with pytest.raises(ValueError):
+        kernels.resolve_engine("fortran")
+
+
+@pytest.mark.parametrize("algorithm", ["OGC_AmsterdamUMC_biexp", "OGC_AmsterdamUMC_biexp_segmented", "DT_IIITN_WLS"])
+def test_engine_matches_reference_implementation(algorithm):
+    bvals, signals = generic_signals()
+    reference = OsipiBase(algorithm=algorithm, bvalues=bvals).osipi_fit(signals.copy())
+    fit = OsipiBase(algorithm=algorithm, bvalues=bvals, engine="numpy")
+    assert fit.engine == "numpy"
+    voxelwise = fit.osipi_fit(signals.copy())
+    full_volume = fit.osipi_fit_full_volume(signals.copy())
+    for key, atol in [("f", 1e-3), ("D", 1e-6), ("Dp", 1e-3)]:
+        np.testing.assert_allclose(voxelwise[key], reference[key], rtol=1e-3, atol=atol, err_msg=f"{algorithm} {key}")
+        np.testing.assert_allclose(full_volume[key], voxelwise[key], rtol=1e-10, atol=1e-12, err_msg=f"{algorithm} {key}")
+
+
+def test_unknown_engine_raises():
+    with pytest.raises(ValueError):
+        OsipiBase(algorithm="OGC_AmsterdamUMC_biexp", bvalues=[0, 10, 50, 100, 200, 500, 800], engine="fortran")
+
+
+def test_engine_is_rejected_without_kernel():
+    bvals = [0, 10, 50, 100, 200, 500, 800]
+    with pytest.raises(ValueError, match="engine"):
+        OsipiBase(algorithm="TF_reference_IVIMfit", bvalues=bvals, engine="numpy")
+    with pytest.raises(ValueError, match="WLS"):
+        OsipiBase(algorithm="DT_IIITN_WLS", bvalues=bvals, method="RLM", engine="numpy")
+    assert OsipiBase(algorithm="TF_reference_IVIMfit", bvalues=bvals).engine is None
+
+
+def run_script(lines):
+    # in a fresh interpreter, as the threading layer is fixed once a parallel kernel has run
+    env = {key: value for key, value in os.environ.items() if key != "NUMBA_THREADING_LAYER"}
+    subprocess.run([sys.executable, "-c", "\n".join(lines)], check=True, timeout=120, env=env,
+                   cwd=pathlib.Path(__file__).parents[3])
+
+
+@pytest.mark.skipif(not kernels.NUMBA_AVAILABLE, reason="numba is not installed")
+def test_import_keeps_threading_layer():
+    run_script([
+        "import numba",
+        "from utilities.ivim import kernels",
+        "assert numba.config.THREADING_LAYER == 'default', numba.config.THREADING_LAYER",
+    ])
+
+
+@pytest.mark.skipif(not kernels.NUMBA_AVAILABLE, reason="numba is not installed")
+def test_configure_threading():
+    run_script([
+        "import warnings",
+        "import numba",
+        "import numpy as np",
+        "from utilities.ivim import kernels",
+        "kernels.configure_threading()",
+        "kernels.fit_monoexp_wls(np.array([0., 200, 500]), np.ones((8, 3)), engine='numba')",
+        "assert numba.threading_layer() == 'workqueue', numba.threading_layer()",
+        "with warnings.catch_warnings(record=True) as caught:",
+        "    warnings.simplefilter('always')",
+        "    kernels.configure_threading('omp')",
+        "assert len(caught) == 1",
+    ])
+
+
+@pytest.mark.skipif(not kernels.NUMBA_AVAILABLE or os.name == "nt", reason="needs numba and fork")
+def test_parallel_kernels_and_forked_workers_exit():
+    # with the default TBB layer, parallel kernels followed by forked DataLoader workers deadlock at interpreter exit
+    run_script([
+        "import numpy as np",
+        "from utilities.ivim import kernels",
+        "from utilities.data_simulation.simulated_dataset import SimulatedIVIMDataset",
+        "from tests.IVIMmodels.unit_tests.test_ivim_fit_full_volume import generic_signals",
+        "kernels.configure_threading()",
+        "bvals, signals = generic_signals()",
+        "kernels.fit_biexp(bvals, signals, [0.001, 0.1, 0.01, 1], ([0, 0, 0.005, 0.7], [0.005, 1.0, 0.2, 1.3]), engine='numba')",
+        "dataset = SimulatedIVIMDataset(bvals, batch_size=4, steps_per_epoch=4)",
+        "assert len(list(dataset.loader(num_workers=2, multiprocessing_context='fork'))) == 4",
+    ])
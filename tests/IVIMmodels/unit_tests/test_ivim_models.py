@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+from scipy.optimize import approx_fprime
+from utilities.ivim import ivim_models
+#run using python -m pytest from the root folder
+
+bvalues = np.array([0, 5, 10, 20, 50, 100, 200, 400, 600, 800], dtype=float)
+
+# model, Jacobian and parameters at which the analytic Jacobian is compared to finite differences
+models = [
+    ("monoexp", ivim_models.monoexp, ivim_models.monoexp_jacobian, [0.0012, 1.1]),
+    ("monoexp_noS0", ivim_models.monoexp, ivim_models.monoexp_jacobian, [0.0012]),
+    ("biexp", ivim_models.biexp, ivim_models.biexp_jacobian, [0.0012, 0.15, 0.03, 1.1]),
+    ("biexp_noS0", ivim_models.biexp, ivim_models.biexp_jacobian, [0.0012, 0.15, 0.03]),
+    ("triexp", ivim_models.triexp, ivim_models.triexp_jacobian, [0.0012, 0.1, 0.005, 0.05, 0.08, 1.1]),
+    ("triexp_noS0", ivim_models.triexp, ivim_models.triexp_jacobian, [0.0012, 0.1, 0.005, 0.05, 0.08]),
+    ("triexp_weighted",
+     lambda b, *p: ivim_models.triexp(b, *p, weights=(0.3, 0.8, 0.5)),
+     lambda b, *p: ivim_models.triexp_jacobian(b, *p, weights=(0.3, 0.8, 0.5)),
+     [0.0012, 0.1, 0.005, 0.05, 0.08, 1.1]),
+    ("multiexp",
+     lambda b, a0, d0, a1, d1: a0 * np.exp(-b * d0) + a1 * np.exp(-b * d1),
+     ivim_models.multiexp_jacobian, [0.85, 0.0012, 0.15, 0.03]),
+    ("biexp_rescaled",
+     lambda b, Dt, Fp, Dp, S0: ivim_models.biexp(b, Dt / 1000, Fp / 10, Dp / 10, S0),
+     ivim_models.rescaled(ivim_models.biexp_jacobian, [1000, 10, 10, 1]), [1.2, 1.5, 0.3, 1.1]),
+]
+
+
+@pytest.mark.parametrize("name, model, jacobian, params", models)
+def test_jacobian_matches_finite_differences(name, model, jacobian, params):
+    params = np.array(params, dtype=float)
+    jac = jacobian(bvalues, *params)
+    assert jac.shape == (len(bvalues), len(params))
+    for i in range(len(bvalues)):
+        # relative step per parameter, as the parameters differ by orders of magnitude
+        numerical = approx_fprime(params, lambda p: model(bvalues, *p)[i], 1e-7 * np.abs(params))
+        np.testing.assert_allclose(jac[i], numerical, rtol=1e-4, atol=1e-7, err_msg=f"{name} b={bvalues[i]}")
+
+
+def test_jacobian_broadcasts_over_voxels():
+    D = np.array([[0.001], [0.002]])
+    f = np.array([[0.1], [0.3]])
+    jac = ivim_models.biexp_jacobian(bvalues, D, f, 0.05, 1.0)
+    assert jac.shape == (2, len(bvalues), 4)
+    np.testing.assert_allclose(jac[1], ivim_models.biexp_jacobian(bvalues, 0.002, 0.3, 0.05, 1.0))
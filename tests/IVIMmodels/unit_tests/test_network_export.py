@@ -0,0 +1,60 @@
+import importlib.util
+import numpy as np
+import pytest
+import torch
+import IVIMNET.deep as deep
+from super_ivim_dc.IVIMNET import deep as super_deep
+from super_ivim_dc.source.hyperparams import hyperparams
+from super_ivim_dc.infer import infer_from_signal
+from src.standardized.IVIM_NEToptim import Arg
+from src.wrappers.OsipiBase import OsipiBase
+from utilities.ivim.network_export import export_network
+from tests.IVIMmodels.unit_tests.test_ivim_fit_full_volume import generic_signals
+#run using python -m pytest from the root folder
+
+requires_onnx = pytest.mark.skipif(importlib.util.find_spec("onnx") is None or importlib.util.find_spec("onnxruntime") is None,
+                                   reason="onnx and onnxruntime are not installed")
+
+
+def ivimnet(bvals):
+    torch.manual_seed(0)
+    arg = deep.checkarg(Arg())
+    return deep.Net(torch.FloatTensor(bvals), arg.net_pars).eval(), arg
+
+
+@pytest.mark.parametrize("backend", ["torchscript", pytest.param("onnx", marks=requires_onnx)])
+def test_exported_ivimnet_matches_predict_IVIM(tmp_path, backend):
+    bvals, signals = generic_signals("generic_DL.json")
+    net, arg = ivimnet(bvals)
+    reference = deep.predict_IVIM(signals.copy(), bvals, net, arg)
+    export_network(net, bvals, arg.net_pars, tmp_path / "ivimnet", formats=(backend,))
+    fit = OsipiBase(algorithm="IVIM_NET_runtime", bvalues=bvals, model_path=tmp_path / "ivimnet", backend=backend)
+    volume = fit.osipi_fit_full_volume(signals.reshape(2, -1, len(bvals)))
+    for key, index in [("D", 0), ("f", 1), ("Dp", 2)]:
+        np.testing.assert_allclose(volume[key].ravel(), reference[index], rtol=1e-5, atol=1e-7, err_msg=key)
+    voxel = fit.osipi_fit(signals[0])
+    np.testing.assert_allclose(voxel["f"], reference[1][0], rtol=1e-5, atol=1e-7)
+
+
+def test_exported_super_ivim_dc_matches_infer_from_signal(tmp_path):
+    bvals, signals = generic_signals("generic_DL.json")
+    torch.manual_seed(0)
+    arg = super_deep.checkarg(hyperparams())
+    net = super_deep.Net(torch.FloatTensor(bvals), arg.net_pars)
+    torch.save(net.state_dict(), tmp_path / "super_ivim_dc.pt")
+    Dp, Dt, f, _ = infer_from_signal(signal=signals.copy(), bvalues=bvals, model_path=tmp_path / "super_ivim_dc.pt")
+    export_network(net, bvals, arg.net_pars, tmp_path / "exported", preprocessing="super_ivim_dc", formats=("torchscript",))
+    fit = OsipiBase(algorithm="IVIM_NET_runtime", model_path=tmp_path / "exported.json")
+    volume = fit.osipi_fit_full_volume(signals)
+    valid = np.isfinite(volume["D"])
+    assert np.sum(valid) == len(Dt)
+    for key, reference in [("D", Dt), ("f", f), ("Dp", Dp)]:
+        np.testing.assert_allclose(volume[key][valid], reference, rtol=1e-5, atol=1e-7, err_msg=key)
+
+
+def test_runtime_rejects_other_bvalues(tmp_path):
+    bvals, _ = generic_signals("generic_DL.json")
+    net, arg = ivimnet(bvals)
+    export_network(net, bvals, arg.net_pars, tmp_path / "ivimnet", formats=("torchscript",))
+    with pytest.raises(ValueError):
+        OsipiBase(algorithm="IVIM_NET_runtime", bvalues=bvals[:-1], model_path=tmp_path / "ivimnet")
@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+import torch
+import IVIMNET.deep as deep
+from src.standardized.IVIM_NEToptim import Arg
+from utilities.ivim import network_quantization
+from tests.IVIMmodels.unit_tests.test_ivim_fit_full_volume import generic_signals
+#run using python -m pytest from the root folder
+
+
+def ivimnet(bvals):
+    torch.manual_seed(0)
+    arg = deep.checkarg(Arg())
+    return deep.Net(torch.FloatTensor(bvals), arg.net_pars).eval(), arg
+
+
+@pytest.mark.parametrize("mode", network_quantization.QUANTIZATION_MODES)
+def test_quantized_network_stays_within_tolerance(mode):
+    bvals, signals = generic_signals("generic_DL.json")
+    net, arg = ivimnet(bvals)
+    runner, errors = network_quantization.quantized_runner(net, bvals, arg.net_pars, "ivimnet", mode)
+    linear_layers = [module for module in runner._module.modules() if isinstance(module, torch.ao.nn.quantized.dynamic.Linear)]
+    assert len(linear_layers) > 0
+    for key, tolerance in network_quantization.default_tolerances.items():
+        assert errors[key] <= tolerance
+    reference = deep.predict_IVIM(signals.copy(), bvals, net, arg)
+    quantized = runner.predict(signals)
+    np.testing.assert_allclose(quantized["f"], reference[1], atol=network_quantization.default_tolerances["f"])
+    # the float network is left untouched
+    assert isinstance(net.encoder0[0], torch.nn.Linear)
+
+
+def test_quantization_falls_back_to_float_network():
+    bvals, _ = generic_signals("generic_DL.json")
+    net, arg = ivimnet(bvals)
+    with pytest.warns(UserWarning, match="float network"):
+        runner, errors = network_quantization.quantized_runner(net, bvals, arg.net_pars, "ivimnet", "int8", tolerances={"f": -1})
+    assert not any(isinstance(module, torch.ao.nn.quantized.dynamic.Linear) for module in runner._module.modules())
+
+
+def test_reference_signals_and_modes():
+    bvals = np.array([0, 10, 50, 100, 200, 500, 800])
+    signals = network_quantization.reference_signals(bvals)
+    assert signals.shape[1] == len(bvals)
+    np.testing.assert_allclose(signals[:, 0], 1)
+    with pytest.raises(ValueError):
+        network_quantization.quantize_network(torch.nn.Linear(2, 2), "int4")
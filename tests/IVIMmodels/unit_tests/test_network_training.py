@@ -0,0 +1,111 @@
+import json
+import numpy as np
+import pytest
+from src.standardized.IVIM_NEToptim import Arg
+from utilities.data_simulation.GenerateData import GenerateData
+from utilities.ivim.network_training import learn_IVIM_array, load_checkpoint, stratified_subsample
+#run using python -m pytest from the root folder
+
+bvals = np.array([0, 5, 10, 20, 30, 50, 75, 100, 150, 250, 400, 600, 800], dtype=float)
+
+
+def training_arg(**train_pars):
+    arg = Arg()
+    arg.train_pars.lr = 1e-3
+    arg.train_pars.maxit = 10
+    for key, value in train_pars.items():
+        setattr(arg.train_pars, key, value)
+    return arg
+
+
+@pytest.fixture(scope="module")
+def train_data():
+    return GenerateData(rng=np.random.default_rng(0)).simulate_training_data(bvals, SNR=(20, 100), n=3000)[0]
+
+
+def test_epoch_budget_and_telemetry(tmp_path, train_data):
+    arg = training_arg(max_epochs=3, telemetry_path=tmp_path / "telemetry.jsonl")
+    net = learn_IVIM_array(train_data, bvals, arg)
+    assert [record["epoch"] for record in net.training_log] == [0, 1, 2]
+    with open(tmp_path / "telemetry.jsonl") as f:
+        records = [json.loads(line) for line in f]
+    assert records == net.training_log
+    assert all(record["samples"] == 10 * arg.train_pars.batch_size for record in records)
+    assert all(record["samples_per_second"] > 0 for record in records)
+
+
+def test_time_budget_stops_training(train_data):
+    with pytest.warns(UserWarning, match="time budget"):
+        net = learn_IVIM_array(train_data, bvals, training_arg(max_time=0))
+    assert len(net.training_log) == 1
+
+
+def test_resume_from_checkpoint(tmp_path, train_data):
+    checkpoint = tmp_path / "checkpoint.pt"
+    interrupted = learn_IVIM_array(train_data, bvals, training_arg(max_epochs=2, checkpoint_path=checkpoint))
+    assert load_checkpoint(checkpoint, bvals)["epoch"] == 1
+    resumed = learn_IVIM_array(train_data, bvals, training_arg(max_epochs=4, checkpoint_path=checkpoint))
+    assert [record["epoch"] for record in resumed.training_log] == [0, 1, 2, 3]
+    assert resumed.training_log[:2] == interrupted.training_log
+    assert load_checkpoint(checkpoint, bvals)["epoch"] == 3
+    with pytest.raises(ValueError):
+        load_checkpoint(checkpoint, bvals[:-1])
+
+
+def test_stratified_subsample_skips_background():
+    rng = np.random.default_rng(1)
+    tissue = GenerateData(rng=rng).simulate_training_data(bvals, SNR=50, n=4000)[0] * rng.uniform(100, 1000, (4000, 1))
+    background = np.abs(rng.normal(0, 2, (6000, len(bvals))))
+    signals = np.concatenate([tissue, background])
+    indices = stratified_subsample(signals, bvals, 500)
+    assert np.all(indices < 4000)
+    assert abs(len(indices) - 500) <= 25
+    # the subsample covers the range of b=0 intensities
+    assert signals[indices, 0].min() < np.percentile(tissue[:, 0], 10) and signals[indices, 0].max() > np.percentile(tissue[:, 0], 90)
+
+
+def test_finetune_is_cached_per_volume(tmp_path, train_data, monkeypatch):
+    import src.standardized.IVIM_NEToptim as ivim_netoptim
+    calls = []
+
+    original = ivim_netoptim.finetune_IVIM
+
+    def finetune_IVIM(*args, **kwargs):
+        calls.append(1)
+        return original(*args, **kwargs)
+
+    monkeypatch.setattr(ivim_netoptim, "finetune_IVIM", finetune_IVIM)
+    finetune_pars = {"voxels": 1000, "max_epochs": 2, "maxit": 5, "cache_dir": tmp_path}
+    fit = ivim_netoptim.IVIM_NEToptim(bvalues=bvals, traindata=train_data, train_pars={"max_epochs": 1, "maxit": 10},
+                                      finetune_pars=finetune_pars)
+    volume = train_data[:2000].reshape(20, 100, len(bvals))
+    first = fit.osipi_fit_full_volume(volume, retrain_on_input_data="finetune")
+    again = fit.osipi_fit_full_volume(volume, retrain_on_input_data="finetune")
+    assert len(calls) == 1
+    np.testing.assert_array_equal(first["D"], again["D"])
+    # without the in-memory cache, the fine-tuned network is loaded from the cache directory
+    fit.finetuned.clear()
+    fit.osipi_fit_full_volume(volume, retrain_on_input_data="finetune")
+    assert len(calls) == 1
+    fit.osipi_fit_full_volume(volume[:10], retrain_on_input_data="finetune")
+    assert len(calls) == 2
+
+
+@pytest.mark.parametrize("train_pars, trainer", [(None, "learn_IVIM"), ({"max_epochs": 5}, "learn_IVIM_array"),
+                                                 ({"telemetry_path": "telemetry.jsonl"}, "learn_IVIM_array")])
+def test_training_and_retraining_share_the_trainer(train_data, monkeypatch, train_pars, trainer):
+    import src.standardized.IVIM_NEToptim as ivim_netoptim
+    calls = []
+
+    def recorder(name):
+        def train(X_train, bvalues, arg, net=None, **kwargs):
+            calls.append(name)
+            return ivim_netoptim.deep.Net(ivim_netoptim.torch.FloatTensor(bvalues), arg.net_pars) if net is None else net
+        return train
+
+    # deep.learn_IVIM, the trainer of IVIMNET, stays the default without budgets, checkpoints or telemetry
+    monkeypatch.setattr(ivim_netoptim.deep, "learn_IVIM", recorder("learn_IVIM"))
+    monkeypatch.setattr(ivim_netoptim, "learn_IVIM_array", recorder("learn_IVIM_array"))
+    fit = ivim_netoptim.IVIM_NEToptim(bvalues=bvals, traindata=train_data, train_pars=train_pars)
+    fit.osipi_fit_full_volume(train_data[:100].reshape(10, 10, len(bvals)), retrain_on_input_data=True)
+    assert calls == [trainer, trainer]
@@ -0,0 +1,56 @@
+import numpy as np
+import torch
+from utilities.data_simulation.simulated_dataset import SimulatedIVIMDataset
+from src.standardized.IVIM_NEToptim import Arg
+from utilities.ivim.network_training import learn_IVIM_streaming
+#run using python -m pytest from the root folder
+
+bvals = np.array([0, 5, 10, 20, 30, 50, 75, 100, 150, 250, 400, 600, 800], dtype=float)
+
+
+def test_batches_have_fixed_size_and_count():
+    dataset = SimulatedIVIMDataset(bvals, batch_size=16, steps_per_epoch=7)
+    batches = list(dataset.loader())
+    assert len(batches) == len(dataset) == 7
+    for batch in batches:
+        assert batch.shape == (16, len(bvals))
+        assert batch.dtype == torch.float32
+        np.testing.assert_allclose(batch[:, 0], 1, rtol=1e-6)
+
+
+def test_streams_are_reproducible_per_epoch():
+    dataset = SimulatedIVIMDataset(bvals, batch_size=8, steps_per_epoch=3, rician_noise=True)
+    first = list(dataset.loader())
+    again = list(dataset.loader())
+    dataset.set_epoch(1)
+    next_epoch = list(dataset.loader())
+    for a, b, c in zip(first, again, next_epoch):
+        assert torch.equal(a, b)
+        assert not torch.equal(a, c)
+    validation = dataset.validation_data(8)
+    assert not any(np.array_equal(validation, batch.numpy()) for batch in first)
+
+
+def test_workers_split_steps_and_draw_independent_streams():
+    dataset = SimulatedIVIMDataset(bvals, batch_size=4, steps_per_epoch=5)
+    loader = dataset.loader(num_workers=2)
+    # workers are spawned, as forking next to a running thread pool can deadlock
+    assert loader.multiprocessing_context.get_start_method() == "spawn"
+    batches = list(loader)
+    assert len(batches) == 5
+    assert len({batch.numpy().tobytes() for batch in batches}) == 5
+    assert all(torch.equal(a, b) for a, b in zip(batches, dataset.loader(num_workers=2)))
+
+
+def test_streaming_training_reduces_loss():
+    arg = Arg()
+    arg.train_pars.lr = 1e-3
+    arg.train_pars.patience = 2
+    dataset = SimulatedIVIMDataset(bvals, batch_size=64, steps_per_epoch=20, SNR=50)
+    net = learn_IVIM_streaming(dataset, bvals, arg, validation_size=1024)
+    X_val = torch.from_numpy(dataset.validation_data(1024))
+    net.eval()
+    with torch.no_grad():
+        loss = torch.mean((net(X_val)[0] - X_val) ** 2).item()
+    # the loss of predicting a flat signal of 0.5 is orders of magnitude above a trained network
+    assert loss < 0.1 * torch.mean((X_val - 0.5) ** 2).item()
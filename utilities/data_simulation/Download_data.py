@@ -1,9 +1,27 @@
 import zipfile
 import os
+import json
+import hashlib
+import pathlib
 import subprocess
-import time
+import numpy as np
+from scipy.io import loadmat
 import zenodo_get
 
+ZENODO_RECORD = 'https://zenodo.org/records/14605039'
+ARCHIVE = 'OSIPI_TF24_data_phantoms.zip'
+MANIFEST = 'manifest.json'
+NPY_CACHE = 'npy_cache'
+# files read by the phantoms; the download is skipped when all of them are present and match the manifest
+REQUIRED_FILES = [f'Phantoms/XCAT_MAT_RESP/XCAT5D_RP_{state}_CP_1.mat' for state in range(1, 21)] + \
+                 ['Phantoms/brain/ground_truth/hrgt_icbm_2009a_nls_3t.nii.gz']
+# size and sha256 of the required files of the Zenodo record, in the format of the manifest entries. Unlike the
+# manifest, which is written from whatever was downloaded, these also catch a corrupt or changed download. Files
+# without an entry are only compared with the manifest; entries are taken from the manifest.json of a download
+# whose archive matched the checksum published on the record.
+CHECKSUMS = {}
+
+
 def unzip_file(zip_file_path, extracted_folder_path):
     # Open the zip file
     with zipfile.ZipFile(zip_file_path, 'r') as zip_ref:
@@ -12,22 +30,148 @@ def unzip_file(zip_file_path, extracted_folder_path):
             zip_ref.extract(file_info, extracted_folder_path)
 
 
-def download_data(force=False):
-    # Check if the folder exists, and create it if not
-    curdir=os.getcwd()
-    base_folder = os.path.abspath(os.path.dirname(__file__))
-    base_folder = os.path.split(os.path.split(base_folder)[0])[0]
-    if not os.path.exists(os.path.join(base_folder,'download')):
-        os.makedirs(os.path.join(base_folder,'download'))
-        print(f"Folder '{'download'}' created.")
-        # Change to the specified folder
-    os.chdir(os.path.join(base_folder,'download'))
-    subprocess.check_call(["zenodo_get", 'https://zenodo.org/records/14605039'])
-    # Open the zip file
-    if force or not os.path.exists('Data'):
-        # Unzip the file
-        unzip_file('OSIPI_TF24_data_phantoms.zip', '.')
-    os.chdir(curdir)
+def data_folder(cache_dir=None):
+    """
+    Folder holding the downloaded data: cache_dir, else the OSIPI_IVIM_DATA environment variable, else the download
+    folder in the root of the repository
+    """
+    if cache_dir is None:
+        cache_dir = os.environ.get('OSIPI_IVIM_DATA')
+    if cache_dir is None:
+        base_folder = os.path.abspath(os.path.dirname(__file__))
+        cache_dir = os.path.join(os.path.split(os.path.split(base_folder)[0])[0], 'download')
+    return pathlib.Path(cache_dir)
+
+
+def file_checksum(path):
+    """sha256 of the content of a file"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(2 ** 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def write_manifest(folder):
+    """
+    Records the size and sha256 of every downloaded file in the manifest of the folder
+    """
+    folder = pathlib.Path(folder)
+    manifest = {}
+    for path in sorted(folder.rglob('*')):
+        relative = path.relative_to(folder).as_posix()
+        if path.is_file() and relative not in (ARCHIVE, MANIFEST) and not relative.startswith((NPY_CACHE, '.')):
+            manifest[relative] = {'size': path.stat().st_size, 'sha256': file_checksum(path)}
+    with open(folder / MANIFEST, 'w') as f:
+        json.dump(manifest, f, indent=4)
+    return manifest
+
+
+def read_manifest(folder):
+    path = pathlib.Path(folder) / MANIFEST
+    if not path.exists():
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def check_data(folder, verify=False):
+    """
+    Checks that the required files are in the folder and match CHECKSUMS, or the manifest for files not in CHECKSUMS
+    Args:
+        folder: data folder
+        verify: also compare the sha256 of every required file (slow), instead of only its size
+
+    Returns:
+        problems: list of the required files that are missing or do not match the manifest
+    """
+    folder = pathlib.Path(folder)
+    missing = [name for name in REQUIRED_FILES if not (folder / name).is_file()]
+    if missing:
+        return missing
+    manifest = read_manifest(folder)
+    if manifest is None:
+        # data downloaded before there was a manifest; record what is there
+        manifest = write_manifest(folder)
+    problems = []
+    for name in REQUIRED_FILES:
+        expected = CHECKSUMS.get(name, manifest.get(name))
+        if expected is None or (folder / name).stat().st_size != expected['size'] or \
+                (verify and file_checksum(folder / name) != expected['sha256']):
+            problems.append(name)
+    return problems
+
+
+def download_data(force=False, cache_dir=None, offline=None, verify=False):
+    """
+    Makes sure the phantom data of the Zenodo record are in the data folder, downloading them only if they are not
+
+    Args:
+        force: download and unzip again, even if the data are present
+        cache_dir: data folder; see data_folder
+        offline: never use the network, and raise if data are missing; defaults to the OSIPI_IVIM_OFFLINE environment
+            variable
+        verify: compare the checksums of the data, instead of only the file sizes
+
+    Returns:
+        folder: the data folder
+
+    Raises:
+        FileNotFoundError: if data are missing or corrupt in offline mode
+        OSError: if the downloaded files do not match CHECKSUMS
+    """
+    folder = data_folder(cache_dir)
+    if offline is None:
+        offline = os.environ.get('OSIPI_IVIM_OFFLINE', '').lower() in ('1', 'true', 'yes')
+    problems = [] if force else check_data(folder, verify=verify)
+    if not force and not problems:
+        return folder
+    if offline:
+        raise FileNotFoundError(f"phantom data missing or corrupt in {folder} and offline mode is on: {problems}")
+    from utilities.ivim.artifact_store import FileLock
+    folder.mkdir(parents=True, exist_ok=True)
+    # concurrent processes download once
+    with FileLock(folder / '.download.lock'):
+        if force or check_data(folder, verify=verify):
+            subprocess.check_call(["zenodo_get", ZENODO_RECORD], cwd=folder)
+            unzip_file(folder / ARCHIVE, folder)
+            write_manifest(folder)
+            corrupt = [name for name in CHECKSUMS if name in check_data(folder, verify=True)]
+            if corrupt:
+                raise OSError(f"downloaded phantom data in {folder} do not match the published checksums: {corrupt}")
+    return folder
+
+
+def load_mat_variable(path, variable, folder=None):
+    """
+    Loads a variable of a .mat file, decoding it once into a .npy file in the npy_cache of the data folder that is
+    named after the content hash of the .mat file; later calls memory-map the .npy file instead of decoding the .mat
+    file again
+
+    Args:
+        path: path of the .mat file
+        variable: name of the variable
+        folder: data folder whose manifest provides the content hash; defaults to data_folder()
+
+    Returns:
+        array: read-only memory-mapped array
+    """
+    path = pathlib.Path(path)
+    folder = data_folder() if folder is None else pathlib.Path(folder)
+    manifest = read_manifest(folder) or {}
+    try:
+        entry = manifest.get(path.resolve().relative_to(folder.resolve()).as_posix())
+    except ValueError:
+        entry = None
+    digest = entry['sha256'] if entry is not None else file_checksum(path)
+    cached = folder / NPY_CACHE / f'{digest}_{variable}.npy'
+    if not cached.exists():
+        cached.parent.mkdir(parents=True, exist_ok=True)
+        temporary = cached.with_name(f'.{cached.name}.{os.getpid()}.tmp.npy')
+        np.save(temporary, loadmat(path, variable_names=[variable])[variable])
+        os.replace(temporary, cached)
+    return np.load(cached, mmap_mode='r')
+
 
 if __name__ == "__main__":
-    download_data(force=True)
\ No newline at end of file
+    download_data(force=True)
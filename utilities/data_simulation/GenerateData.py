@@ -22,25 +22,38 @@ class GenerateData:
         else:
             self._rng = rng
 
-    def ivim_signal(self, D, Dp, f, S0, bvalues, snr=None, rician_noise=False):
+    def ivim_signal(self, D, Dp, f, S0, bvalues, snr=None, rician_noise=False, out=None, dtype='float64'):
         """
         Generates IVIM (biexponential) signal
 
+        The parameters may be scalars or arrays (e.g. parameter maps) of any broadcastable shape; the signal has the
+        broadcast shape of the parameters with the b-values as last axis.
+
         Parameters
         ----------
-        D : float
+        D : float or array
             The tissue diffusion value
-        Dp : float
+        Dp : float or array
             The pseudo perfusion value
-        f : float
+        f : float or array
             The fraction of the signal from perfusion
-        S0 : float
+        S0 : float or array
             The baseline signal (magnitude at no diffusion)
         bvalues : list or array of float
             The diffusion (b-values)
+        snr : float, optional
+            The signal to noise ratio; no noise is added if None
+        rician_noise : bool, optional
+            Adds Rician instead of Gaussian noise
+        out : array, optional
+            Array of shape (..., len(bvalues)) the signal is written to
+        dtype : str, optional
+            'float64' or 'float32'
         """
-        signal = self.multiexponential_signal([D, Dp], [1 - f, f], S0, self._op.asarray(bvalues, dtype='float64'))
-        return self.add_noise(signal, snr, rician_noise)
+        signal = self.multiexponential_signal([D, Dp], [1 - self._asarray(f, dtype), f], S0, bvalues, out=out, dtype=dtype)
+        if snr is None:
+            return signal
+        return self.add_noise(signal, snr, rician_noise, out=signal)
 
     def exponential_signal(self, D, bvalues):
         """
@@ -54,54 +67,86 @@ class GenerateData:
             The diffusion (b-values)
         """
         assert np.all(D >= 0), 'all values in D must be >= 0'
-        return self._op.exp(-self._op.asarray(bvalues, dtype='float64') * D)
+        return self._op.exp(-self._asarray(bvalues) * D)
 
-    def multiexponential_signal(self, D, F, S0, bvalues):
+    def multiexponential_signal(self, D, F, S0, bvalues, out=None, dtype='float64'):
         """
         Generates multiexponential signal
         The combination of exponential signals
 
+        The compartment parameters may be scalars or arrays of any broadcastable shape; the signal
+        S0 * sum_i F_i exp(-b D_i) has their broadcast shape with the b-values as last axis.
+
         Parameters
         ----------
         D : list or arrray of float
-            The tissue diffusion value
+            The diffusion value of each compartment
         F : list or array of float
-            The fraction of the signal from perfusion
-        S0 : list or array of float
+            The signal fraction of each compartment
+        S0 : float or array
             The baseline signal (magnitude at no diffusion)
         bvalues : list or array of float
             The diffusion (b-values)
+        out : array, optional
+            Array of shape (..., len(bvalues)) the signal is written to
+        dtype : str, optional
+            'float64' or 'float32'
         """
         assert len(D) == len(F), 'D and F must be the same length'
-        signal = self._op.zeros_like(bvalues)
-        for [d, f] in zip(D, F):
-            signal += f * self.exponential_signal(d, bvalues)
-        signal *= S0
-        return signal
+        bvalues = self._asarray(bvalues, dtype)
+        params = self._broadcast(*[self._asarray(p, dtype) for p in list(D) + list(F)])
+        D = self._op.stack(params[:len(D)])[..., None]
+        F = self._op.stack(params[len(D):])[..., None]
+        S0 = self._asarray(S0, dtype)[..., None]
+        signal = self._op.sum(F * self._op.exp(-bvalues * D), 0, out=out)
+        return self._op.multiply(signal, S0, out=out)
 
-    def add_noise(self, real_signal, snr=None, rician_noise=True, imag_signal=None):
+    def add_noise(self, real_signal, snr=None, rician_noise=True, imag_signal=None, out=None):
         """
         Adds Rician noise to a real or complex signal
 
+        Without an imaginary channel and Rician noise, the magnitude of the signal plus Gaussian noise is returned.
+
         Parameters
         ----------
         real_signal : list or array of float
             The real channel float
         snr : float
             The signal to noise ratio
+        rician_noise : bool, optional
+            Adds noise to the imaginary channel as well, giving Rician noise in the magnitude
         imag_signal : list or array of float
             The imaginary channel float
+        out : array, optional
+            Array the noisy magnitude is written to; may be real_signal
         """
-        if imag_signal is None:
-            imag_signal = self._op.zeros_like(real_signal)
-        real_noise = self._op.zeros_like(real_signal)
-        imag_noise = self._op.zeros_like(real_signal)
-        if snr is not None:
-            real_noise = self._rng.normal(0, 1 / snr, real_signal.shape)
-            if rician_noise:
-                imag_noise = self._rng.normal(0, 1 / snr, imag_signal.shape)
-        noisy_data = self._op.sqrt(self._op.power(real_signal + real_noise, 2) + self._op.power(imag_signal + imag_noise, 2))
-        return noisy_data
+        real_signal = self._asarray(real_signal, None)
+        noisy_real = real_signal if snr is None else real_signal + self._normal(1 / snr, real_signal.shape, real_signal.dtype)
+        if imag_signal is None and not (rician_noise and snr is not None):
+            return self._op.abs(noisy_real, out=out)
+        noisy_imag = self._op.zeros_like(real_signal) if imag_signal is None else self._asarray(imag_signal, None)
+        if rician_noise and snr is not None:
+            noisy_imag = noisy_imag + self._normal(1 / snr, real_signal.shape, real_signal.dtype)
+        return self._op.hypot(noisy_real, noisy_imag, out=out)
+
+    def _asarray(self, values, dtype='float64'):
+        # dtype names resolve to np.float64/torch.float64 etc., so this works for both operators
+        if dtype is None:
+            return self._op.asarray(values)
+        return self._op.asarray(values, dtype=getattr(self._op, dtype))
+
+    def _broadcast(self, *arrays):
+        if self._op is np:
+            return np.broadcast_arrays(*arrays)
+        return self._op.broadcast_tensors(*arrays)
+
+    def _normal(self, std, shape, dtype):
+        # Gaussian noise from the random number generator, as an array of the operator
+        if hasattr(self._rng, 'normal'):
+            noise = self._rng.normal(0, std, shape)
+            return noise.astype(dtype, copy=False) if self._op is np else self._op.asarray(noise, dtype=dtype)
+        generator = self._rng if isinstance(self._rng, self._op.Generator) else None
+        return std * self._op.randn(shape, generator=generator, dtype=dtype)
 
     def linear_signal(self, D, bvalues, offset=0):
         """
@@ -185,36 +230,133 @@ class GenerateData:
          - Noise is applied after generating noise-free IVIM signals, using either Gaussian or Rician noise.
          - Simulated signals are normalized by the mean S0 (b = 0) signal.
          """
-        test = self._rng.uniform(0, 1, (n, 4))
+        bvalues = np.array(bvalues)
+        data_sim = np.empty((n, len(bvalues)))
+        D, f, Dp = self._simulate_training_block(self._rng, bvalues, n, SNR, Drange, frange, Dprange, rician_noise, data_sim)
+        return data_sim, D, f, Dp
+
+    def simulate_training_chunk(self, bvalues, index, chunk_size, n, seed, SNR = (5,100), Drange = (0.0005,0.0034), frange = (0,1), Dprange = (0.005,0.1), rician_noise = False, dtype = np.float64, out = None):
+        """
+         Simulates one chunk of the training data of simulate_training_chunks, independently of the other chunks.
+
+         Chunk ``index`` covers voxels ``index * chunk_size`` up to ``min((index + 1) * chunk_size, n)`` and is drawn
+         from its own ``numpy.random.Generator``, seeded with ``SeedSequence(seed, spawn_key=(index,))``, which is
+         the ``index``-th child of ``SeedSequence(seed).spawn``. Chunks can therefore be simulated in any order and in
+         separate processes, and the result is the same as simulating them in sequence.
+
+         Parameters:
+         ----------
+         bvalues : array-like
+             b-values of the simulated signals.
+         index : int
+             Index of the chunk.
+         chunk_size : int
+             Number of voxels per chunk.
+         n : int
+             Total number of voxels; the last chunk may be smaller than chunk_size.
+         seed : int
+             Seed of the simulation.
+         SNR, Drange, frange, Dprange, rician_noise : optional
+             As in simulate_training_data.
+         dtype : numpy dtype, optional
+             Data type of the signals. Default is float64.
+         out : ndarray, optional
+             Array of shape (chunk voxels, len(bvalues)) the signals are written to.
+
+         Returns:
+         -------
+         data_sim, D, f, Dp : ndarrays
+             As in simulate_training_data, for the voxels of this chunk.
+         """
+        bvalues = np.array(bvalues)
+        size = min(chunk_size, n - index * chunk_size)
+        if size <= 0:
+            raise ValueError(f"chunk {index} is out of range for n = {n} and chunk_size = {chunk_size}")
+        if out is None:
+            out = np.empty((size, len(bvalues)), dtype=dtype)
+        rng = np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(index,)))
+        D, f, Dp = self._simulate_training_block(rng, bvalues, size, SNR, Drange, frange, Dprange, rician_noise, out)
+        return out, D, f, Dp
+
+    def simulate_training_chunks(self, bvalues, n = 1000000, chunk_size = 100000, seed = None, SNR = (5,100), Drange = (0.0005,0.0034), frange = (0,1), Dprange = (0.005,0.1), rician_noise = False, dtype = np.float64, out = None):
+        """
+         Simulates training data as simulate_training_data, in chunks, such that memory is bounded by the chunk size.
+
+         Every chunk is drawn from an independent random stream (see simulate_training_chunk), so the data only
+         depend on seed and chunk_size, not on the number of processes that simulate the chunks.
+
+         Parameters:
+         ----------
+         bvalues : array-like
+             b-values of the simulated signals.
+         n : int, optional
+             Total number of voxels. Default is 1,000,000.
+         chunk_size : int, optional
+             Number of voxels per chunk. Default is 100,000.
+         seed : int, optional
+             Seed of the simulation. If None, fresh entropy is drawn from the operating system.
+         SNR, Drange, frange, Dprange, rician_noise : optional
+             As in simulate_training_data.
+         dtype : numpy dtype, optional
+             Data type of the signals. Default is float64.
+         out : ndarray, optional
+             Preallocated (or numpy.memmap) array of shape (n, len(bvalues)); every chunk is written to its rows, and
+             the yielded signals are views of out.
+
+         Yields:
+         -------
+         data_sim, D, f, Dp : ndarrays
+             As in simulate_training_data, for chunks of up to chunk_size voxels.
+         """
+        if seed is None:
+            seed = np.random.SeedSequence().entropy
+        if out is not None and out.shape != (n, len(bvalues)):
+            raise ValueError(f"out has shape {out.shape}, expected {(n, len(bvalues))}")
+        for index, start in enumerate(range(0, n, chunk_size)):
+            chunk_out = None if out is None else out[start:start + chunk_size]
+            yield self.simulate_training_chunk(bvalues, index, chunk_size, n, seed, SNR=SNR, Drange=Drange, frange=frange, Dprange=Dprange, rician_noise=rician_noise, dtype=dtype, out=chunk_out)
+
+    @staticmethod
+    def _simulate_training_block(rng, bvalues, n, SNR, Drange, frange, Dprange, rician_noise, out):
+        # Writes n normalised training signals into out and returns the parameters. The signals are computed in a
+        # single float64 work array, so the temporaries are one work array and one noise array of the block size.
+        test = rng.uniform(0, 1, (n, 4))
         D = Drange[0] + test[:, [0]] * (Drange[1] - Drange[0])
         f = frange[0] + test[:, [1]] * (frange[1] - frange[0])
         Dp = Dprange[0] + test[:, [2]] * (Dprange[1] - Dprange[0])
-        #data_sim = np.zeros([len(D), len(bvalues)])
-        bvalues = np.array(bvalues)
         if type(SNR) == tuple:
             noise_std = 1/SNR[1] + test[:,3] * (1/SNR[0] - 1/SNR[1])
             addnoise = True
         elif SNR == 0:
             addnoise = False
-            noise_std = np.ones((n, 1))
         else:
-            noise_std = np.full((n, 1), 1/SNR)
+            noise_std = np.full(n, 1/SNR)
             addnoise = True
-        noise_std = noise_std[:, np.newaxis]
-        # loop over array to fill with simulated IVIM data
-        bvalues = np.array(bvalues).reshape(1, -1)
-        data_sim = 1 * (f * np.exp(-bvalues * Dp) + (1 - f) * np.exp(-bvalues * D))
+        bvalues = bvalues.reshape(1, -1)
+        data_sim = out if out.dtype == np.float64 else np.empty(out.shape)
+        # f * exp(-b Dp) + (1 - f) * exp(-b D), without allocating each term
+        np.multiply(-bvalues, Dp, out=data_sim)
+        np.exp(data_sim, out=data_sim)
+        data_sim *= f
+        tissue = np.multiply(-bvalues, D)
+        np.exp(tissue, out=tissue)
+        tissue *= 1 - f
+        data_sim += tissue
+        del tissue
 
         # if SNR is set to zero, don't add noise
         if addnoise:
-            noise_real = self._rng.normal(0, noise_std, data_sim.shape)
-            noise_imag = self._rng.normal(0, noise_std, data_sim.shape)
-
+            noise_std = noise_std[:, np.newaxis]
+            data_sim += rng.normal(0, noise_std, data_sim.shape)
             if rician_noise:
-                data_sim = np.sqrt((data_sim + noise_real) ** 2 + noise_imag ** 2)
-            else:
-                data_sim = data_sim + noise_real
+                data_sim **= 2
+                noise_imag = rng.normal(0, noise_std, data_sim.shape)
+                noise_imag **= 2
+                data_sim += noise_imag
+                del noise_imag
+                np.sqrt(data_sim, out=data_sim)
         S0_noisy = np.mean(data_sim[:, bvalues.flatten() == 0], axis=1)
-        data_sim = data_sim / S0_noisy[:, None]
-        return data_sim, D, f, Dp
-
+        data_sim /= S0_noisy[:, None]
+        if data_sim is not out:
+            out[...] = data_sim
+        return D, f, Dp
@@ -0,0 +1,122 @@
+import numpy as np
+import torch
+from utilities.data_simulation.GenerateData import GenerateData
+
+
+class SimulatedIVIMDataset(torch.utils.data.IterableDataset):
+    """
+    Streams freshly simulated IVIM training batches instead of materializing the full training set
+
+    Every batch is drawn with GenerateData.simulate_training_data, so the parameter and SNR sampling and the
+    Gaussian/Rician noise options are identical to the in-memory training data, while memory stays at one batch
+    per worker. Each DataLoader worker draws from its own numpy Generator, seeded from (seed, epoch, worker), so
+    a training run is reproducible for a given number of workers.
+    """
+    def __init__(self, bvalues, batch_size=128, steps_per_epoch=500, SNR=(5, 100), Drange=(0.0003, 0.0035), frange=(0, 1), Dprange=(0.005, 0.12), rician_noise=False, seed=42, dtype=np.float32):
+        """
+        Parameters
+        ----------
+        bvalues : array-like
+            b-values of the simulated signals
+        batch_size : int, optional
+            Number of simulated voxels per batch. Default is 128.
+        steps_per_epoch : int or None, optional
+            Number of batches per pass over the dataset, shared between the workers. If None, the dataset is
+            infinite. Default is 500.
+        SNR, Drange, frange, Dprange, rician_noise : optional
+            Simulation settings, as in GenerateData.simulate_training_data.
+        seed : int, optional
+            Base seed of the random streams. Default is 42.
+        dtype : numpy dtype, optional
+            Data type of the returned batches. Default is float32.
+        """
+        super().__init__()
+        self.bvalues = np.array(bvalues)
+        self.batch_size = batch_size
+        self.steps_per_epoch = steps_per_epoch
+        self.SNR = SNR
+        self.Drange = Drange
+        self.frange = frange
+        self.Dprange = Dprange
+        self.rician_noise = rician_noise
+        self.seed = seed
+        self.dtype = dtype
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        """
+        Sets the epoch used to seed the next pass over the dataset, so every epoch sees new data
+        """
+        self.epoch = epoch
+
+    def _worker_steps(self, worker_id, num_workers):
+        if self.steps_per_epoch is None:
+            return None
+        steps, remainder = divmod(self.steps_per_epoch, num_workers)
+        return steps + (worker_id < remainder)
+
+    def simulate_batch(self, rng, n=None):
+        """
+        Simulates one batch of normalized training signals
+
+        Parameters
+        ----------
+        rng : numpy.random.Generator
+            Random number generator used for the parameters and the noise
+        n : int, optional
+            Number of voxels; defaults to the batch size
+
+        Returns
+        -------
+        data : ndarray of shape (n, len(bvalues))
+        """
+        gen = GenerateData(rng=rng)
+        data, _, _, _ = gen.simulate_training_data(self.bvalues, SNR=self.SNR, n=self.batch_size if n is None else n, Drange=self.Drange, frange=self.frange, Dprange=self.Dprange, rician_noise=self.rician_noise)
+        return data.astype(self.dtype)
+
+    def validation_data(self, n):
+        """
+        Simulates a fixed validation set from a random stream that is independent of the training batches
+
+        Parameters
+        ----------
+        n : int
+            Number of validation voxels
+
+        Returns
+        -------
+        data : ndarray of shape (n, len(bvalues))
+        """
+        rng = np.random.default_rng(np.random.SeedSequence(self.seed, spawn_key=(2 ** 32 - 1,)))
+        return self.simulate_batch(rng, n)
+
+    def __iter__(self):
+        worker_info = torch.utils.data.get_worker_info()
+        worker_id, num_workers = (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+        rng = np.random.default_rng(np.random.SeedSequence(self.seed, spawn_key=(self.epoch, worker_id)))
+        steps = self._worker_steps(worker_id, num_workers)
+        step = 0
+        while steps is None or step < steps:
+            yield torch.from_numpy(self.simulate_batch(rng))
+            step += 1
+
+    def __len__(self):
+        if self.steps_per_epoch is None:
+            raise TypeError("an infinite SimulatedIVIMDataset has no length")
+        return self.steps_per_epoch
+
+    def loader(self, num_workers=0, **kwargs):
+        """
+        DataLoader over the dataset; the dataset already yields whole batches, so automatic batching is disabled
+
+        Parameters
+        ----------
+        num_workers : int, optional
+            Number of worker processes simulating batches in parallel with training. Default is 0.
+        **kwargs
+            Further DataLoader options. The workers are spawned unless multiprocessing_context says otherwise, as
+            forking a process that already runs a thread pool (e.g. of the Numba kernels) can deadlock.
+        """
+        if num_workers > 0:
+            kwargs.setdefault("multiprocessing_context", "spawn")
+        return torch.utils.data.DataLoader(self, batch_size=None, num_workers=num_workers, **kwargs)
@@ -0,0 +1,138 @@
+import hashlib
+import json
+import os
+import pathlib
+import shutil
+import tempfile
+import time
+import numpy as np
+
+METADATA_FILE = "artifact.json"
+
+
+def _jsonable(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    if hasattr(value, "__dict__"):
+        return vars(value)
+    return str(value)
+
+
+def artifact_key(params):
+    """
+    Content hash of the parameters an artifact was created with
+    Args:
+        params: JSON serializable dictionary; numpy arrays and simple objects (such as hyperparameter classes) are
+            converted to lists and dictionaries
+
+    Returns:
+        key: hexadecimal key of 16 characters
+    """
+    canonical = json.dumps(params, sort_keys=True, default=_jsonable)
+    return hashlib.sha256(canonical.encode()).hexdigest()[:16]
+
+
+def default_artifact_dir():
+    """
+    Directory of the artifact store used when an algorithm is not given one: the OSIPI_IVIM_ARTIFACTS environment
+    variable, else models in the root of the repository
+    """
+    root = pathlib.Path(__file__).resolve().parents[2]
+    return pathlib.Path(os.environ.get("OSIPI_IVIM_ARTIFACTS", root / "models"))
+
+
+class FileLock:
+    """
+    Exclusive inter-process lock on a file, using fcntl on POSIX and msvcrt on Windows
+    """
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+        self._file = None
+
+    def __enter__(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._file = open(self.path, "a+")
+        if os.name == "nt":
+            import msvcrt
+            while True:
+                try:
+                    # blocks for up to 10 seconds before raising
+                    msvcrt.locking(self._file.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    time.sleep(0.1)
+        else:
+            import fcntl
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        if os.name == "nt":
+            import msvcrt
+            self._file.seek(0)
+            msvcrt.locking(self._file.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+        self._file.close()
+        self._file = None
+
+
+class ArtifactStore:
+    """
+    Directory of artifacts (such as trained networks), each in a subdirectory named after the hash of the parameters
+    it was created with.
+
+    An artifact is created in a temporary directory that is renamed into place once complete, so a directory in the
+    store is never partially written. Creation is serialized with a lock per key, such that concurrent processes
+    asking for the same artifact create it once and the others reuse it.
+    """
+    def __init__(self, root):
+        """
+        Args:
+            root: directory of the store; created if it does not exist
+        """
+        self.root = pathlib.Path(root)
+
+    def path(self, params):
+        """Directory of the artifact created with params (which may not exist yet)"""
+        return self.root / artifact_key(params)
+
+    def exists(self, params):
+        """Whether the artifact created with params is in the store"""
+        return (self.path(params) / METADATA_FILE).exists()
+
+    def get_or_create(self, params, create):
+        """
+        Returns the artifact created with params, creating it if it is not in the store
+        Args:
+            params: parameters that determine the artifact, see artifact_key
+            create: function that writes the artifact into the directory it is passed
+
+        Returns:
+            path: directory of the artifact
+        """
+        path = self.path(params)
+        if self.exists(params):
+            return path
+        self.root.mkdir(parents=True, exist_ok=True)
+        with FileLock(self.root / f".{path.name}.lock"):
+            # another process may have created the artifact while we waited for the lock
+            if self.exists(params):
+                return path
+            # left behind by a process that was killed while creating the artifact
+            for stale in self.root.glob(f".{path.name}.tmp*"):
+                shutil.rmtree(stale, ignore_errors=True)
+            if path.exists():
+                shutil.rmtree(path)
+            tmp = pathlib.Path(tempfile.mkdtemp(prefix=f".{path.name}.tmp", dir=self.root))
+            try:
+                create(tmp)
+                with open(tmp / METADATA_FILE, "w") as f:
+                    json.dump(params, f, indent=4, sort_keys=True, default=_jsonable)
+                os.replace(tmp, path)
+            finally:
+                shutil.rmtree(tmp, ignore_errors=True)
+        return path
@@ -0,0 +1,152 @@
+import json
+import numpy as np
+import torch
+from joblib import Parallel, delayed, effective_n_jobs
+from utilities.data_simulation.GenerateData import GenerateData
+from utilities.ivim.artifact_store import ArtifactStore, default_artifact_dir
+
+PARAMETERS = ["D", "f", "Dp"]
+
+
+class SurrogateNet(torch.nn.Module):
+    """
+    Small fully connected network mapping normalised signals to D, f and Dp, each squashed by a sigmoid into the
+    range of the teacher's estimates
+    """
+    def __init__(self, n_bvalues, lower, upper, width=64, depth=3):
+        super().__init__()
+        layers = []
+        for i in range(depth):
+            layers += [torch.nn.Linear(n_bvalues if i == 0 else width, width), torch.nn.ELU()]
+        self.layers = torch.nn.Sequential(*layers, torch.nn.Linear(width, len(PARAMETERS)))
+        self.register_buffer("lower", torch.as_tensor(lower, dtype=torch.float32))
+        self.register_buffer("upper", torch.as_tensor(upper, dtype=torch.float32))
+
+    def forward(self, X):
+        """Estimates in units of the teacher's outputs (voxels x [D, f, Dp])"""
+        return self.lower + (self.upper - self.lower) * torch.sigmoid(self.layers(X))
+
+
+def normalise(signals, bvalues):
+    """Divides the signals by their mean at the lowest b-value, as OsipiBase.osipi_fit does"""
+    bvalues = np.asarray(bvalues)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return signals / np.mean(signals[..., bvalues == np.min(bvalues)], axis=-1, keepdims=True)
+
+
+def _fit_chunk(teacher, signals):
+    fit = teacher.osipi_fit(signals)
+    return np.stack([np.asarray(fit[key], dtype=float) for key in PARAMETERS], axis=-1)
+
+
+def teacher_estimates(teacher, signals, njobs=1):
+    """
+    Fits the signals with the teacher algorithm, in chunks of voxels distributed over njobs processes
+    Args:
+        teacher: initialised standardized algorithm (OsipiBase)
+        signals: 2D array of signals (voxels x b-values)
+        njobs: number of processes; -1 uses all CPUs
+
+    Returns:
+        estimates: 2D array (voxels x [D, f, Dp])
+    """
+    njobs = effective_n_jobs(njobs)
+    if njobs == 1:
+        return _fit_chunk(teacher, signals)
+    chunks = np.array_split(signals, 4 * njobs)
+    return np.concatenate(Parallel(n_jobs=njobs)(delayed(_fit_chunk)(teacher, chunk) for chunk in chunks))
+
+
+def train_surrogate(signals, estimates, bvalues, width=64, depth=3, lr=1e-3, batch_size=256, max_epochs=200, patience=10, split=0.9, seed=0):
+    """
+    Trains a SurrogateNet to reproduce the teacher's estimates from the signals, with early stopping on a
+    validation split; the loss is the mean squared error relative to the range of each parameter
+    Args:
+        signals: 2D array of normalised signals (voxels x b-values)
+        estimates: 2D array of teacher estimates (voxels x [D, f, Dp])
+        bvalues: 1D array of b-values
+        width, depth: size of the network
+        lr, batch_size, max_epochs, patience, split: training settings
+        seed: seed of the initialisation, split and shuffling
+
+    Returns:
+        net: the trained network with the lowest validation loss
+    """
+    valid = np.isfinite(signals).all(axis=1) & np.isfinite(estimates).all(axis=1)
+    X = torch.from_numpy(signals[valid].astype(np.float32))
+    Y = torch.from_numpy(estimates[valid].astype(np.float32))
+    lower, upper = Y.min(dim=0).values, Y.max(dim=0).values
+    scale = torch.where(upper > lower, upper - lower, torch.ones_like(upper))
+    generator = torch.Generator().manual_seed(seed)
+    order = torch.randperm(len(X), generator=generator)
+    n_train = int(split * len(X))
+    train, val = order[:n_train], order[n_train:]
+
+    with torch.random.fork_rng():
+        torch.manual_seed(seed)
+        net = SurrogateNet(len(bvalues), lower, upper, width=width, depth=depth)
+    optimizer = torch.optim.Adam(net.parameters(), lr=lr)
+    best, bad_epochs, best_state = np.inf, 0, net.state_dict()
+    for epoch in range(max_epochs):
+        net.train()
+        for batch in torch.split(train[torch.randperm(len(train), generator=generator)], batch_size):
+            optimizer.zero_grad()
+            loss = torch.mean(((net(X[batch]) - Y[batch]) / scale) ** 2)
+            loss.backward()
+            optimizer.step()
+        net.eval()
+        with torch.no_grad():
+            val_loss = torch.mean(((net(X[val]) - Y[val]) / scale) ** 2).item()
+        if val_loss < best:
+            best, bad_epochs = val_loss, 0
+            best_state = {key: value.clone() for key, value in net.state_dict().items()}
+        else:
+            bad_epochs += 1
+            if bad_epochs == patience:
+                break
+    net.load_state_dict(best_state)
+    net.validation_loss = best
+    return net.eval()
+
+
+def distill(teacher, bvalues, n=10000, SNR=(5, 100), njobs=1, teacher_kwargs=None, width=64, depth=3, seed=0, cache_dir=None):
+    """
+    Trains (or loads from the cache) a surrogate network that reproduces a standardized algorithm: the teacher fits
+    n signals simulated with GenerateData.simulate_training_data, and a SurrogateNet is trained on its estimates
+    Args:
+        teacher: name of the standardized algorithm, as in src/standardized
+        bvalues: b-values of the protocol
+        n: number of simulated training signals
+        SNR: SNR of the training signals, see simulate_training_data
+        njobs: number of processes running the teacher; -1 uses all CPUs
+        teacher_kwargs: keyword arguments of the teacher (bounds, initial_guess, ...)
+        width, depth: size of the network
+        seed: seed of the simulation and training
+        cache_dir: directory of the ArtifactStore keeping the trained surrogates; defaults to default_artifact_dir()
+
+    Returns:
+        net: the trained SurrogateNet
+        metadata: the settings the surrogate was trained with and its validation loss
+    """
+    from src.wrappers.OsipiBase import OsipiBase
+    bvalues = np.asarray(bvalues, dtype=float)
+    teacher_kwargs = teacher_kwargs or {}
+    params = {"teacher": teacher, "teacher_kwargs": teacher_kwargs, "bvalues": bvalues, "n": n, "SNR": SNR,
+              "width": width, "depth": depth, "seed": seed}
+
+    def create(path):
+        signals = GenerateData(rng=np.random.default_rng(seed)).simulate_training_data(bvalues, SNR=SNR, n=n)[0]
+        model = OsipiBase(bvalues=bvalues, algorithm=teacher, **teacher_kwargs)
+        estimates = teacher_estimates(model, signals, njobs=njobs)
+        net = train_surrogate(normalise(signals, bvalues), estimates, bvalues, width=width, depth=depth, seed=seed)
+        torch.save(net.state_dict(), path / "surrogate.pt")
+        with open(path / "surrogate.json", "w") as f:
+            json.dump({"validation_loss": net.validation_loss, "parameters": PARAMETERS}, f, indent=4)
+
+    path = ArtifactStore(default_artifact_dir() if cache_dir is None else cache_dir).get_or_create(params, create)
+    with open(path / "surrogate.json") as f:
+        metadata = {**json.load(f), **params}
+    state = torch.load(path / "surrogate.pt", map_location="cpu")
+    net = SurrogateNet(len(bvalues), state["lower"], state["upper"], width=width, depth=depth)
+    net.load_state_dict(state)
+    return net.eval(), metadata
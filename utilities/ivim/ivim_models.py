@@ -0,0 +1,191 @@
+import numpy as np
+
+
+def monoexp(bvalues, D, S0=1):
+    """
+    mono-exponential signal S0 * exp(-b * D)
+    Args:
+        bvalues: b-values
+        D: diffusion coefficient
+        S0: signal at b=0
+
+    Returns:
+        signal: signal at the specified b-values
+    """
+    return S0 * np.exp(-bvalues * D)
+
+
+def monoexp_jacobian(bvalues, D, S0=None):
+    """
+    Jacobian of monoexp with respect to its parameters
+    Args:
+        bvalues: b-values
+        D: diffusion coefficient
+        S0: signal at b=0; None if S0 is fixed to 1 rather than fitted
+
+    Returns:
+        jacobian: derivatives to D and (if given) S0 in the last dimension, shape (..., b-values, 1 or 2)
+    """
+    decay = np.exp(-bvalues * D)
+    if S0 is None:
+        return np.stack((-bvalues * decay,), axis=-1)
+    return np.stack((-bvalues * S0 * decay, decay), axis=-1)
+
+
+def biexp(bvalues, D, f, Dp, S0=1):
+    """
+    bi-exponential IVIM signal S0 * (f * exp(-b * Dp) + (1 - f) * exp(-b * D))
+    Args:
+        bvalues: b-values
+        D: diffusion coefficient
+        f: perfusion fraction
+        Dp: pseudo diffusion coefficient
+        S0: signal at b=0
+
+    Returns:
+        signal: signal at the specified b-values
+    """
+    return S0 * (f * np.exp(-bvalues * Dp) + (1 - f) * np.exp(-bvalues * D))
+
+
+def biexp_jacobian(bvalues, D, f, Dp, S0=None):
+    """
+    Jacobian of biexp with respect to its parameters
+    Args:
+        bvalues: b-values
+        D: diffusion coefficient
+        f: perfusion fraction
+        Dp: pseudo diffusion coefficient
+        S0: signal at b=0; None if S0 is fixed to 1 rather than fitted
+
+    Returns:
+        jacobian: derivatives to D, f, Dp and (if given) S0 in the last dimension, shape (..., b-values, 3 or 4)
+    """
+    diffusion = np.exp(-bvalues * D)
+    perfusion = np.exp(-bvalues * Dp)
+    scale = 1 if S0 is None else S0
+    columns = (-bvalues * scale * (1 - f) * diffusion,
+               scale * (perfusion - diffusion),
+               -bvalues * scale * f * perfusion)
+    if S0 is not None:
+        columns = columns + (f * perfusion + (1 - f) * diffusion,)
+    return np.stack(columns, axis=-1)
+
+
+def triexp(bvalues, D, f1, Dp1, f2, Dp2, S0=1, weights=None):
+    """
+    tri-exponential IVIM signal, with a diffusion compartment of fraction 1 - f1 - f2 and two pseudo diffusion
+    compartments of fraction f1 and f2
+    Args:
+        bvalues: b-values
+        D: diffusion coefficient
+        f1: fraction of the first pseudo diffusion compartment
+        Dp1: pseudo diffusion coefficient of the first pseudo diffusion compartment
+        f2: fraction of the second pseudo diffusion compartment
+        Dp2: pseudo diffusion coefficient of the second pseudo diffusion compartment
+        S0: signal at b=0
+        weights: optional relative signal weights (e.g. relaxation) of the diffusion, first and second compartment;
+            the weighted signal is normalised to S0 at b=0
+
+    Returns:
+        signal: signal at the specified b-values
+    """
+    if weights is None:
+        return S0 * (f1 * np.exp(-bvalues * Dp1) + f2 * np.exp(-bvalues * Dp2) + (1 - f1 - f2) * np.exp(-bvalues * D))
+    w0, w1, w2 = weights
+    a0, a1, a2 = w0 * (1 - f1 - f2), w1 * f1, w2 * f2
+    return S0 * (a0 * np.exp(-bvalues * D) + a1 * np.exp(-bvalues * Dp1) + a2 * np.exp(-bvalues * Dp2)) / (a0 + a1 + a2)
+
+
+def triexp_jacobian(bvalues, D, f1, Dp1, f2, Dp2, S0=None, weights=None):
+    """
+    Jacobian of triexp with respect to its parameters
+    Args:
+        bvalues: b-values
+        D: diffusion coefficient
+        f1: fraction of the first pseudo diffusion compartment
+        Dp1: pseudo diffusion coefficient of the first pseudo diffusion compartment
+        f2: fraction of the second pseudo diffusion compartment
+        Dp2: pseudo diffusion coefficient of the second pseudo diffusion compartment
+        S0: signal at b=0; None if S0 is fixed to 1 rather than fitted
+        weights: optional relative signal weights of the three compartments, as in triexp
+
+    Returns:
+        jacobian: derivatives to D, f1, Dp1, f2, Dp2 and (if given) S0 in the last dimension,
+            shape (..., b-values, 5 or 6)
+    """
+    w0, w1, w2 = (1, 1, 1) if weights is None else weights
+    scale = 1 if S0 is None else S0
+    e0, e1, e2 = np.exp(-bvalues * D), np.exp(-bvalues * Dp1), np.exp(-bvalues * Dp2)
+    a0, a1, a2 = w0 * (1 - f1 - f2), w1 * f1, w2 * f2
+    norm = a0 + a1 + a2
+    relative = (a0 * e0 + a1 * e1 + a2 * e2) / norm
+    columns = (-bvalues * scale * a0 * e0 / norm,
+               scale * (w1 * e1 - w0 * e0 - relative * (w1 - w0)) / norm,
+               -bvalues * scale * a1 * e1 / norm,
+               scale * (w2 * e2 - w0 * e0 - relative * (w2 - w0)) / norm,
+               -bvalues * scale * a2 * e2 / norm)
+    if S0 is not None:
+        columns = columns + (relative,)
+    return np.stack(columns, axis=-1)
+
+
+def multiexp_jacobian(bvalues, *params):
+    """
+    Jacobian of a sum of exponentials with free amplitudes, A0 * exp(-b * D0) + A1 * exp(-b * D1) + ...
+    Args:
+        bvalues: b-values
+        params: amplitude and diffusion coefficient of every exponential, in the order A0, D0, A1, D1, ...
+
+    Returns:
+        jacobian: derivatives to the parameters, in the same order, in the last dimension
+    """
+    columns = []
+    for amplitude, D in zip(params[::2], params[1::2]):
+        decay = np.exp(-bvalues * D)
+        columns += [decay, -bvalues * amplitude * decay]
+    return np.stack(columns, axis=-1)
+
+
+def rescaled(jacobian, scale):
+    """
+    Jacobian of a model fitted in rescaled parameters p * scale, as used to give the parameters comparable magnitudes
+    (e.g. D * 1000, f * 10, Dp * 10) in the OGC AmsterdamUMC fits
+    Args:
+        jacobian: Jacobian function of the model in the original parameters, called as jacobian(bvalues, *params)
+        scale: scale factor of every parameter
+
+    Returns:
+        rescaled_jacobian: Jacobian function in the rescaled parameters, called as rescaled_jacobian(bvalues, *params)
+    """
+    scale = np.asarray(scale, dtype=float)
+
+    def rescaled_jacobian(bvalues, *params):
+        factors = scale[:len(params)]
+        return jacobian(bvalues, *(p / s for p, s in zip(params, factors))) / factors
+
+    return rescaled_jacobian
+
+
+def weighted_linreg(x, Y, W):
+    """
+    weighted linear regression y = a + b * x of many voxels at once, with the 2x2 weighted normal equations solved in
+    closed form
+    Args:
+        x: independent variable, shared by all voxels, shape (observations,)
+        Y: dependent variable, shape (voxels, observations)
+        W: weights of the observations, shape (voxels, observations)
+
+    Returns:
+        intercept, slope: arrays of shape (voxels,); non-finite for voxels with a singular system
+    """
+    Sw = np.sum(W, axis=-1)
+    Swx = W @ x
+    Swxx = W @ (x * x)
+    Swy = np.sum(W * Y, axis=-1)
+    Swxy = np.sum(W * Y * x, axis=-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        det = Sw * Swxx - Swx ** 2
+        intercept = (Swxx * Swy - Swx * Swxy) / det
+        slope = (Sw * Swxy - Swx * Swy) / det
+    return intercept, slope
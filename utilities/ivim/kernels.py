@@ -0,0 +1,478 @@
+"""
+Compiled per-voxel fitting kernels for the IVIM models.
+
+Every kernel fits one voxel in scalar code: a bounded Levenberg-Marquardt
+fit with analytic Jacobians and Cholesky-solved 1x1 to 4x4 normal
+equations, a segmented fit and a weighted log-linear (WLS) mono-exponential
+fit. With Numba installed the kernels are compiled with ``njit`` and looped
+over the voxels in compiled code with ``prange``; without Numba the same
+algorithms run as vectorized NumPy over all voxels at once. Both engines
+take the same steps, so they agree to rounding error.
+
+The public functions take the engine as "auto" (Numba if installed,
+otherwise NumPy), "numba" or "numpy".
+
+Importing this module leaves Numba's threading layer alone. With the TBB
+layer, forking a process after a parallel kernel has run (e.g. DataLoader
+workers started with fork) deadlocks the interpreter at exit. Such
+processes should call configure_threading() before the first kernel runs,
+or set NUMBA_THREADING_LAYER=workqueue.
+
+requirements:
+numpy
+numba (optional)
+"""
+
+import warnings
+import numpy as np
+from utilities.ivim.ivim_models import weighted_linreg
+
+try:
+    import numba
+    from numba import njit, prange
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+    prange = range
+
+    def njit(*args, **kwargs):
+        # without numba the kernels are plain python functions
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda function: function
+
+
+# models fitted by the Levenberg-Marquardt kernel
+BIEXP = 0  # parameters D, f, Dp (, S0): S0 * (f * exp(-b * Dp) + (1 - f) * exp(-b * D))
+MONOEXP = 1  # parameters D, S0: S0 * exp(-b * D)
+PERFUSION = 2  # parameter Dp, with D and f fixed: f * exp(-b * Dp) + (1 - f) * exp(-b * D)
+
+LAMBDA_START = 1e-3
+LAMBDA_MIN = 1e-15
+LAMBDA_MAX = 1e15
+
+
+def configure_threading(layer="workqueue"):
+    """
+    Selects the Numba threading layer of the parallel kernels, by default the fork-safe workqueue layer (see the
+    module docstring). Numba picks the layer when the first parallel kernel runs, so call this before that.
+    Does nothing without Numba.
+    Args:
+        layer: Numba threading layer, e.g. "workqueue", "omp" or "tbb"
+    """
+    if not NUMBA_AVAILABLE:
+        return
+    try:
+        active = numba.threading_layer()
+    except ValueError:
+        # no parallel kernel has run yet
+        active = None
+    if active is not None:
+        warnings.warn(f"Numba already runs on the {active} threading layer, configure_threading has no effect")
+    numba.config.THREADING_LAYER = layer
+
+
+def resolve_engine(engine):
+    """
+    Selects the engine that runs the kernels
+    Args:
+        engine: "auto", "numba" or "numpy"
+
+    Returns:
+        engine: "numba" or "numpy"
+    """
+    if engine == "auto":
+        return "numba" if NUMBA_AVAILABLE else "numpy"
+    if engine == "numba":
+        if not NUMBA_AVAILABLE:
+            warnings.warn('numba is not installed, the kernels fall back to NumPy', UserWarning, stacklevel=3)
+            return "numpy"
+        return "numba"
+    if engine == "numpy":
+        return "numpy"
+    raise ValueError(f"Unknown engine '{engine}'. Use 'auto', 'numba' or 'numpy'.")
+
+
+# ----------------------------------------------------------------------------
+# scalar kernels, compiled by numba
+# ----------------------------------------------------------------------------
+
+@njit(cache=True)
+def _evaluate(model, b, y, p, const, r, J):
+    """residuals r and Jacobian J of the model at p; returns the sum of squared residuals"""
+    cost = 0.0
+    for i in range(b.shape[0]):
+        if model == BIEXP:
+            S0 = p[3] if p.shape[0] == 4 else 1.0
+            diffusion = np.exp(-b[i] * p[0])
+            perfusion = np.exp(-b[i] * p[2])
+            relative = p[1] * perfusion + (1 - p[1]) * diffusion
+            r[i] = S0 * relative - y[i]
+            J[i, 0] = -b[i] * S0 * (1 - p[1]) * diffusion
+            J[i, 1] = S0 * (perfusion - diffusion)
+            J[i, 2] = -b[i] * S0 * p[1] * perfusion
+            if p.shape[0] == 4:
+                J[i, 3] = relative
+        elif model == MONOEXP:
+            decay = np.exp(-b[i] * p[0])
+            r[i] = p[1] * decay - y[i]
+            J[i, 0] = -b[i] * p[1] * decay
+            J[i, 1] = decay
+        else:
+            perfusion = np.exp(-b[i] * p[0])
+            r[i] = const[1] * perfusion + (1 - const[1]) * np.exp(-b[i] * const[0]) - y[i]
+            J[i, 0] = -b[i] * const[1] * perfusion
+        cost += r[i] * r[i]
+    return cost
+
+
+@njit(cache=True)
+def _cholesky_solve(A, g, x):
+    """solves A x = g for a small symmetric positive definite A"""
+    n = g.shape[0]
+    L = np.zeros((n, n))
+    for j in range(n):
+        s = A[j, j]
+        for k in range(j):
+            s -= L[j, k] * L[j, k]
+        L[j, j] = np.sqrt(s)
+        for i in range(j + 1, n):
+            s = A[i, j]
+            for k in range(j):
+                s -= L[i, k] * L[j, k]
+            L[i, j] = s / L[j, j]
+    for i in range(n):
+        s = g[i]
+        for k in range(i):
+            s -= L[i, k] * x[k]
+        x[i] = s / L[i, i]
+    for i in range(n - 1, -1, -1):
+        s = x[i]
+        for k in range(i + 1, n):
+            s -= L[k, i] * x[k]
+        x[i] = s / L[i, i]
+
+
+@njit(cache=True)
+def _lm_voxel(model, b, y, x0, lower, upper, const, max_iter, ftol, xtol, out):
+    """bounded Levenberg-Marquardt fit of one voxel, result written to out"""
+    n = x0.shape[0]
+    m = b.shape[0]
+    p = np.minimum(np.maximum(x0, lower), upper)
+    trial = np.empty(n)
+    step = np.empty(n)
+    g = np.empty(n)
+    A = np.empty((n, n))
+    r = np.empty(m)
+    J = np.empty((m, n))
+    r_trial = np.empty(m)
+    J_trial = np.empty((m, n))
+    cost = _evaluate(model, b, y, p, const, r, J)
+    lam = LAMBDA_START
+    for iteration in range(max_iter):
+        # damped normal equations, with the parameters held at an active bound taken out
+        max_diag = 0.0
+        for j in range(n):
+            g[j] = 0.0
+            for k in range(n):
+                A[j, k] = 0.0
+            for i in range(m):
+                g[j] -= J[i, j] * r[i]
+                for k in range(n):
+                    A[j, k] += J[i, j] * J[i, k]
+            max_diag = max(max_diag, A[j, j])
+        floor = 1e-12 * max_diag if max_diag > 0 else 1.0
+        for j in range(n):
+            A[j, j] += lam * max(A[j, j], floor)
+        for j in range(n):
+            if (p[j] <= lower[j] and g[j] < 0) or (p[j] >= upper[j] and g[j] > 0):
+                for k in range(n):
+                    A[j, k] = 0.0
+                    A[k, j] = 0.0
+                A[j, j] = 1.0
+                g[j] = 0.0
+        _cholesky_solve(A, g, step)
+
+        unchanged = True
+        small_step = True
+        for j in range(n):
+            trial[j] = min(max(p[j] + step[j], lower[j]), upper[j])
+            if trial[j] != p[j]:
+                unchanged = False
+            if abs(trial[j] - p[j]) > xtol * (abs(p[j]) + xtol):
+                small_step = False
+        if unchanged:
+            break
+        new_cost = _evaluate(model, b, y, trial, const, r_trial, J_trial)
+        if new_cost < cost:
+            small_decrease = cost - new_cost <= ftol * cost
+            p[:] = trial
+            r[:] = r_trial
+            J[:, :] = J_trial
+            cost = new_cost
+            lam = max(lam * 0.1, LAMBDA_MIN)
+            if small_step or small_decrease:
+                break
+        else:
+            lam *= 10
+            if lam > LAMBDA_MAX:
+                break
+    out[:] = p
+
+
+@njit(cache=True)
+def _monoexp_wls_voxel(b, y, out):
+    """weighted log-linear fit of S0 * exp(-b * D) with weights y^2; out = D, S0"""
+    Sw = 0.0
+    Swx = 0.0
+    Swxx = 0.0
+    Swy = 0.0
+    Swxy = 0.0
+    for i in range(b.shape[0]):
+        s = max(y[i], 1e-16)
+        w = s * s
+        log_s = np.log(s)
+        Sw += w
+        Swx += w * b[i]
+        Swxx += w * b[i] * b[i]
+        Swy += w * log_s
+        Swxy += w * b[i] * log_s
+    det = Sw * Swxx - Swx * Swx
+    out[0] = -(Sw * Swxy - Swx * Swy) / det
+    out[1] = np.exp((Swxx * Swy - Swx * Swxy) / det)
+
+
+@njit(cache=True)
+def _segmented_voxel(b, y, high, lower, upper, p0, max_iter, ftol, xtol, out):
+    """segmented fit of one voxel; out = D, f, Dp"""
+    n_high = 0
+    for i in range(b.shape[0]):
+        if high[i]:
+            n_high += 1
+    b_high = np.empty(n_high)
+    y_high = np.empty(n_high)
+    k = 0
+    for i in range(b.shape[0]):
+        if high[i]:
+            b_high[k] = b[i]
+            y_high[k] = y[i]
+            k += 1
+
+    # D and the intercept (1 - f) from the high b-values
+    start = np.empty(2)
+    _monoexp_wls_voxel(b_high, y_high, start)
+    if not (np.isfinite(start[0]) and np.isfinite(start[1])):
+        start[0] = p0[0]
+        start[1] = p0[3] - p0[1]
+    mono_lower = np.array([lower[0], 0.0])
+    mono_upper = np.array([upper[0], 1e10])
+    mono = np.empty(2)
+    _lm_voxel(MONOEXP, b_high, y_high, start, mono_lower, mono_upper, mono_lower, max_iter, ftol, xtol, mono)
+    D = mono[0]
+    f = min(max(1 - mono[1], lower[1]), upper[1])
+
+    # D* with D and f fixed
+    const = np.array([D, f])
+    perfusion = np.empty(1)
+    _lm_voxel(PERFUSION, b, y, p0[2:3], lower[2:3], upper[2:3], const, max_iter, ftol, xtol, perfusion)
+    out[0] = D
+    out[1] = f
+    out[2] = perfusion[0]
+
+
+@njit(cache=True, parallel=True)
+def _lm_loop(model, b, Y, X0, lower, upper, const, max_iter, ftol, xtol):
+    out = np.empty(X0.shape)
+    for v in prange(Y.shape[0]):
+        _lm_voxel(model, b, Y[v], X0[v], lower, upper, const[v], max_iter, ftol, xtol, out[v])
+    return out
+
+
+@njit(cache=True, parallel=True)
+def _segmented_loop(b, Y, high, lower, upper, p0, max_iter, ftol, xtol):
+    out = np.empty((Y.shape[0], 3))
+    for v in prange(Y.shape[0]):
+        _segmented_voxel(b, Y[v], high, lower, upper, p0, max_iter, ftol, xtol, out[v])
+    return out
+
+
+@njit(cache=True, parallel=True)
+def _monoexp_wls_loop(b, Y):
+    out = np.empty((Y.shape[0], 2))
+    for v in prange(Y.shape[0]):
+        _monoexp_wls_voxel(b, Y[v], out[v])
+    return out
+
+
+# ----------------------------------------------------------------------------
+# NumPy engine: the same algorithms, vectorized over the voxels
+# ----------------------------------------------------------------------------
+
+def _evaluate_numpy(model, b, Y, P, const):
+    if model == BIEXP:
+        S0 = P[:, 3:4] if P.shape[1] == 4 else 1.0
+        f = P[:, 1:2]
+        diffusion = np.exp(-b * P[:, 0:1])
+        perfusion = np.exp(-b * P[:, 2:3])
+        relative = f * perfusion + (1 - f) * diffusion
+        r = S0 * relative - Y
+        columns = [-b * S0 * (1 - f) * diffusion, S0 * (perfusion - diffusion), -b * S0 * f * perfusion]
+        if P.shape[1] == 4:
+            columns.append(relative)
+    elif model == MONOEXP:
+        decay = np.exp(-b * P[:, 0:1])
+        r = P[:, 1:2] * decay - Y
+        columns = [-b * P[:, 1:2] * decay, decay]
+    else:
+        perfusion = np.exp(-b * P[:, 0:1])
+        f = const[:, 1:2]
+        r = f * perfusion + (1 - f) * np.exp(-b * const[:, 0:1]) - Y
+        columns = [-b * f * perfusion]
+    J = np.broadcast_arrays(*columns)
+    return np.sum(r * r, axis=-1), r, np.stack(J, axis=-1)
+
+
+def _lm_numpy(model, b, Y, X0, lower, upper, const, max_iter, ftol, xtol):
+    n = X0.shape[1]
+    P = np.minimum(np.maximum(X0, lower), upper)
+    cost, r, J = _evaluate_numpy(model, b, Y, P, const)
+    lam = np.full(len(P), LAMBDA_START)
+    active = np.ones(len(P), dtype=bool)
+    for iteration in range(max_iter):
+        idx = np.flatnonzero(active)
+        if len(idx) == 0:
+            break
+        p = P[idx]
+        A = np.einsum('vij,vik->vjk', J[idx], J[idx])
+        g = -np.einsum('vij,vi->vj', J[idx], r[idx])
+        diag = np.diagonal(A, axis1=1, axis2=2)
+        max_diag = diag.max(axis=1, keepdims=True)
+        floor = np.where(max_diag > 0, 1e-12 * max_diag, 1.0)
+        A = A + (lam[idx, np.newaxis] * np.maximum(diag, floor))[:, :, np.newaxis] * np.eye(n)
+        held = ((p <= lower) & (g < 0)) | ((p >= upper) & (g > 0))
+        A = np.where(held[:, :, np.newaxis] | held[:, np.newaxis, :], 0.0, A) + held[:, :, np.newaxis] * np.eye(n)
+        g = np.where(held, 0.0, g)
+        step = np.linalg.solve(A, g[:, :, np.newaxis])[:, :, 0]
+
+        trial = np.minimum(np.maximum(p + step, lower), upper)
+        unchanged = np.all(trial == p, axis=1)
+        small_step = np.all(np.abs(trial - p) <= xtol * (np.abs(p) + xtol), axis=1)
+        new_cost, new_r, new_J = _evaluate_numpy(model, b, Y[idx], trial, const[idx])
+        accepted = (new_cost < cost[idx]) & ~unchanged
+        small_decrease = cost[idx] - new_cost <= ftol * cost[idx]
+
+        acc = idx[accepted]
+        P[acc], cost[acc], r[acc], J[acc] = trial[accepted], new_cost[accepted], new_r[accepted], new_J[accepted]
+        lam[acc] = np.maximum(lam[acc] * 0.1, LAMBDA_MIN)
+        rejected = idx[~accepted & ~unchanged]
+        lam[rejected] *= 10
+        done = unchanged | (accepted & (small_step | small_decrease))
+        active[idx[done]] = False
+        active[rejected[lam[rejected] > LAMBDA_MAX]] = False
+    return P
+
+
+def _monoexp_wls_numpy(b, Y):
+    S = np.maximum(Y, 1e-16)
+    log_S0, slope = weighted_linreg(b, np.log(S), S * S)
+    with np.errstate(over='ignore', invalid='ignore'):
+        return np.column_stack((-slope, np.exp(log_S0)))
+
+
+def _segmented_numpy(b, Y, high, lower, upper, p0, max_iter, ftol, xtol):
+    start = _monoexp_wls_numpy(b[high], Y[:, high])
+    start = np.where(np.all(np.isfinite(start), axis=1, keepdims=True), start, [p0[0], p0[3] - p0[1]])
+    mono_lower = np.array([lower[0], 0.0])
+    mono_upper = np.array([upper[0], 1e10])
+    mono = _lm_numpy(MONOEXP, b[high], Y[:, high], start, mono_lower, mono_upper,
+                     np.zeros((len(Y), 2)), max_iter, ftol, xtol)
+    D = mono[:, 0]
+    f = np.minimum(np.maximum(1 - mono[:, 1], lower[1]), upper[1])
+    Dp = _lm_numpy(PERFUSION, b, Y, np.full((len(Y), 1), p0[2]), lower[2:3], upper[2:3],
+                   np.column_stack((D, f)), max_iter, ftol, xtol)[:, 0]
+    return np.column_stack((D, f, Dp))
+
+
+# ----------------------------------------------------------------------------
+# public functions
+# ----------------------------------------------------------------------------
+
+def fit_biexp(bvalues, signals, x0, bounds, fit_S0=True, engine="auto", max_iter=200, ftol=1e-10, xtol=1e-10):
+    """
+    Bounded Levenberg-Marquardt fit of the bi-exponential IVIM model to every voxel
+    Args:
+        bvalues: 1D array of b-values
+        signals: 2D array (voxels x b-values)
+        x0: starting values [D, f, Dp, S0], shared by all voxels or one row per voxel
+        bounds: ([Dmin, fmin, Dpmin, S0min], [Dmax, fmax, Dpmax, S0max])
+        fit_S0: fit S0 as well; otherwise S0 is fixed to 1
+        engine: "auto", "numba" or "numpy"
+        max_iter: maximum number of Levenberg-Marquardt iterations
+        ftol: tolerance on the relative decrease of the sum of squares
+        xtol: tolerance on the relative change of the parameters
+
+    Returns:
+        params: 2D array (voxels x 4) with D, f, Dp and S0 of every voxel
+    """
+    bvalues = np.asarray(bvalues, dtype=float)
+    signals = np.atleast_2d(np.asarray(signals, dtype=float))
+    n = 4 if fit_S0 else 3
+    X0 = np.array(np.broadcast_to(np.asarray(x0, dtype=float)[..., :n], (len(signals), n)))
+    lower = np.asarray(bounds[0], dtype=float)[:n]
+    upper = np.asarray(bounds[1], dtype=float)[:n]
+    const = np.zeros((len(signals), 1))
+    if resolve_engine(engine) == "numba":
+        params = _lm_loop(BIEXP, bvalues, signals, X0, lower, upper, const, max_iter, ftol, xtol)
+    else:
+        params = _lm_numpy(BIEXP, bvalues, signals, X0, lower, upper, const, max_iter, ftol, xtol)
+    if not fit_S0:
+        params = np.column_stack((params, np.ones(len(params))))
+    return params
+
+
+def fit_segmented(bvalues, signals, cutoff, bounds, p0, engine="auto", max_iter=200, ftol=1e-10, xtol=1e-10):
+    """
+    Segmented fit of every voxel: D and the intercept from a mono-exponential fit to the b-values >= cutoff,
+    f as one minus the intercept, and D* from a fit to all b-values with D and f fixed. The signal should be
+    normalised to S0=1.
+    Args:
+        bvalues: 1D array of b-values
+        signals: 2D array (voxels x b-values), normalised to b=0
+        cutoff: b-value threshold of the D fit
+        bounds: ([Dmin, fmin, Dpmin, S0min], [Dmax, fmax, Dpmax, S0max])
+        p0: starting values [D, f, Dp, S0]
+        engine: "auto", "numba" or "numpy"
+        max_iter: maximum number of Levenberg-Marquardt iterations per step
+        ftol: tolerance on the relative decrease of the sum of squares
+        xtol: tolerance on the relative change of the parameters
+
+    Returns:
+        params: 2D array (voxels x 3) with D, f and Dp of every voxel
+    """
+    bvalues = np.asarray(bvalues, dtype=float)
+    signals = np.atleast_2d(np.asarray(signals, dtype=float))
+    high = bvalues >= cutoff
+    lower = np.asarray(bounds[0], dtype=float)
+    upper = np.asarray(bounds[1], dtype=float)
+    p0 = np.asarray(p0, dtype=float)
+    if resolve_engine(engine) == "numba":
+        return _segmented_loop(bvalues, signals, high, lower, upper, p0, max_iter, ftol, xtol)
+    return _segmented_numpy(bvalues, signals, high, lower, upper, p0, max_iter, ftol, xtol)
+
+
+def fit_monoexp_wls(bvalues, signals, engine="auto"):
+    """
+    Weighted log-linear fit of S0 * exp(-b * D) to every voxel, with weights S^2 (Veraart et al. 2013)
+    Args:
+        bvalues: 1D array of b-values
+        signals: 2D array (voxels x b-values)
+        engine: "auto", "numba" or "numpy"
+
+    Returns:
+        params: 2D array (voxels x 2) with D and S0 of every voxel
+    """
+    bvalues = np.asarray(bvalues, dtype=float)
+    signals = np.atleast_2d(np.asarray(signals, dtype=float))
+    if resolve_engine(engine) == "numba":
+        return _monoexp_wls_loop(bvalues, signals)
+    return _monoexp_wls_numpy(bvalues, signals)
@@ -0,0 +1,100 @@
+import copy
+import json
+import pathlib
+import numpy as np
+import torch
+
+
+class ExportableIVIMNet(torch.nn.Module):
+    """
+    Wraps a trained bi-exponential IVIM-NET or SUPER-IVIM-DC network such that it maps a batch of normalised
+    signals to a single (voxels x 4) tensor of D, f, Dp and S0, which can be traced to TorchScript and ONNX.
+    The sigmoid constraints (cons_min/cons_max) and b-values of the network become constants of the traced graph.
+    """
+    def __init__(self, net, fitS0):
+        super().__init__()
+        self.net = net
+        self.fitS0 = fitS0
+
+    def forward(self, X):
+        _, Dt, Fp, Dp, S0 = self.net(X)
+        if not self.fitS0:
+            S0 = torch.ones_like(Dt)
+        return torch.cat([Dt, Fp, Dp, S0], dim=1)
+
+
+def network_metadata(bvalues, net_pars, preprocessing):
+    """
+    Metadata that NetworkRunner needs to reproduce the pre- and post-processing of a network
+    Args:
+        bvalues: b-values the network was trained for
+        net_pars: network parameters of the network (fitS0, cons_min, cons_max)
+        preprocessing: "ivimnet" or "super_ivim_dc"
+
+    Returns:
+        metadata: JSON serializable dictionary
+    """
+    return {
+        "preprocessing": preprocessing,
+        "bvalues": np.asarray(bvalues, dtype=float).tolist(),
+        "parameters": ["D", "f", "Dp", "S0"],
+        "fitS0": bool(net_pars.fitS0),
+        "cons_min": np.asarray(net_pars.cons_min, dtype=float).tolist(),
+        "cons_max": np.asarray(net_pars.cons_max, dtype=float).tolist(),
+    }
+
+
+def export_network(net, bvalues, net_pars, path, preprocessing="ivimnet", formats=("torchscript", "onnx")):
+    """
+    Serializes a trained IVIM network for inference with utilities.ivim.network_runtime.NetworkRunner
+    Args:
+        net: trained IVIM-NET (IVIMNET.deep.Net) or SUPER-IVIM-DC (super_ivim_dc.IVIMNET.deep.Net) network
+        bvalues: b-values the network was trained for
+        net_pars: network parameters of the network (fitS0, tri_exp, cons_min, cons_max)
+        path: output path without extension; writes path.pt (TorchScript), path.onnx and path.json (metadata)
+        preprocessing: "ivimnet" to reproduce IVIMNET.deep.predict_IVIM or "super_ivim_dc" to reproduce
+            super_ivim_dc.infer.infer_from_signal
+        formats: formats to export, any of "torchscript" and "onnx"; ONNX export requires the onnx package
+
+    Returns:
+        path: path of the metadata file
+    """
+    if getattr(net_pars, "tri_exp", False):
+        raise ValueError("only bi-exponential networks can be exported")
+    if preprocessing not in ("ivimnet", "super_ivim_dc"):
+        raise ValueError(f"unknown preprocessing {preprocessing}; choose 'ivimnet' or 'super_ivim_dc'")
+    unknown = set(formats) - {"torchscript", "onnx"}
+    if unknown:
+        raise ValueError(f"unknown export formats {sorted(unknown)}; choose from 'torchscript' and 'onnx'")
+    path = pathlib.Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    bvalues = np.asarray(bvalues, dtype=float)
+
+    net = copy.deepcopy(net)
+    if hasattr(net, "supervised"):
+        # SUPER-IVIM-DC networks copy.copy their outputs unless supervised, which tracing does not record
+        net.supervised = True
+    model = ExportableIVIMNet(net, bool(net_pars.fitS0)).cpu().eval()
+    # IVIM-like example signals; more than one voxel, as batch normalisation refuses single voxel batches
+    example = torch.exp(-torch.outer(torch.linspace(0.5, 3, 3), torch.tensor(bvalues, dtype=torch.float32)) / 1000)
+    if "torchscript" in formats:
+        with torch.no_grad():
+            traced = torch.jit.trace(model, example[:2])
+            if not torch.allclose(traced(example), model(example)):
+                raise RuntimeError("the traced network does not reproduce the network")
+        traced.save(str(path.with_suffix(".pt")))
+    if "onnx" in formats:
+        try:
+            import onnx  # noqa: F401
+        except ImportError as e:
+            raise ImportError("exporting to ONNX requires the onnx package; install osipi-ivim[onnx]") from e
+        with torch.no_grad():
+            torch.onnx.export(model, (example[:2],), str(path.with_suffix(".onnx")), dynamo=False,
+                              input_names=["signals"], output_names=["params"],
+                              dynamic_axes={"signals": {0: "voxels"}, "params": {0: "voxels"}})
+
+    metadata = network_metadata(bvalues, net_pars, preprocessing)
+    metadata["formats"] = list(formats)
+    with path.with_suffix(".json").open("w") as f:
+        json.dump(metadata, f, indent=4)
+    return path.with_suffix(".json")
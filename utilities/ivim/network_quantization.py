@@ -0,0 +1,97 @@
+import copy
+import json
+import pathlib
+import warnings
+import numpy as np
+import torch
+from utilities.ivim.ivim_models import biexp
+from utilities.ivim.network_export import ExportableIVIMNet, network_metadata
+from utilities.ivim.network_runtime import NetworkRunner
+
+GENERIC_DL_FILE = pathlib.Path(__file__).resolve().parents[2] / "tests" / "IVIMmodels" / "unit_tests" / "generic_DL.json"
+QUANTIZATION_MODES = ("int8", "float16")
+# largest accepted deviation of the quantized from the float network on the generic_DL.json cases
+default_tolerances = {"D": 1e-4, "f": 2e-2, "Dp": 5e-3}
+
+
+def quantize_network(net, mode="int8"):
+    """
+    Dynamically quantizes the fully-connected layers of a network for CPU inference
+    Args:
+        net: trained network
+        mode: "int8" for int8 weights and dynamically quantized int8 activations of the linear layers, or "float16" for
+            float16 storage of the linear layer weights
+
+    Returns:
+        net: quantized copy of the network
+    """
+    if mode not in QUANTIZATION_MODES:
+        raise ValueError(f"unknown quantization mode {mode}; choose from {QUANTIZATION_MODES}")
+    dtype = torch.qint8 if mode == "int8" else torch.float16
+    return torch.ao.quantization.quantize_dynamic(copy.deepcopy(net).cpu().eval(), {torch.nn.Linear}, dtype=dtype)
+
+
+def reference_signals(bvalues, filename=GENERIC_DL_FILE):
+    """
+    Noise-free signals of the generic_DL.json test cases (D, f and Dp per tissue) at the given b-values
+    Args:
+        bvalues: b-values of the network
+        filename: JSON file with the test cases
+
+    Returns:
+        signals: 2D array (cases x b-values)
+    """
+    with open(filename) as f:
+        cases = json.load(f)
+    cases.pop("config")
+    params = np.array([[case["D"], case["f"], case["Dp"]] for case in cases.values()])
+    return biexp(np.asarray(bvalues, dtype=float), params[:, [0]], params[:, [1]], params[:, [2]])
+
+
+def quantization_error(reference, quantized, signals):
+    """
+    Largest absolute difference between the parameters estimated by two runners
+    Args:
+        reference: NetworkRunner of the float network
+        quantized: NetworkRunner of the quantized network
+        signals: 2D array of signals (voxels x b-values)
+
+    Returns:
+        errors: dictionary with the largest difference in "D", "f" and "Dp"
+    """
+    reference, quantized = reference.predict(signals), quantized.predict(signals)
+    errors = {}
+    for key in ["D", "f", "Dp"]:
+        difference = np.abs(quantized[key] - reference[key])
+        errors[key] = float(np.max(difference[np.isfinite(difference)], initial=0))
+    return errors
+
+
+def quantized_runner(net, bvalues, net_pars, preprocessing, mode="int8", tolerances=None):
+    """
+    Quantizes a trained IVIM network and checks its accuracy against the float network on the generic_DL.json cases
+    Args:
+        net: trained IVIM-NET or SUPER-IVIM-DC network
+        bvalues: b-values the network was trained for
+        net_pars: network parameters of the network
+        preprocessing: "ivimnet" or "super_ivim_dc", see utilities.ivim.network_export.export_network
+        mode: quantization mode, see quantize_network
+        tolerances: largest accepted deviation per parameter; defaults to default_tolerances
+
+    Returns:
+        runner: NetworkRunner of the quantized network, or of the float network if the quantized network exceeds the
+            tolerances
+        errors: deviation of the quantized from the float network per parameter
+    """
+    tolerances = {**default_tolerances, **(tolerances or {})}
+    metadata = network_metadata(bvalues, net_pars, preprocessing)
+    model = ExportableIVIMNet(copy.deepcopy(net).cpu(), bool(net_pars.fitS0)).eval()
+    reference = NetworkRunner.from_module(model, metadata)
+    quantized = NetworkRunner.from_module(quantize_network(model, mode), metadata)
+    errors = quantization_error(reference, quantized, reference_signals(bvalues))
+    exceeded = {key: error for key, error in errors.items() if error > tolerances[key]}
+    if exceeded:
+        warnings.warn(f"{mode} quantized network deviates from the float network by {exceeded} on the generic_DL "
+                      f"cases, more than the tolerances {tolerances}; using the float network", UserWarning)
+        return reference, errors
+    return quantized, errors
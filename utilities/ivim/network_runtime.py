@@ -0,0 +1,135 @@
+import json
+import pathlib
+import numpy as np
+
+
+def _percentile_mask(data, bvalues, percentile, limits):
+    keep = np.ones(len(data), dtype=bool)
+    for (low, high), limit in limits:
+        selection = (bvalues > low) & (bvalues < high)
+        keep &= np.percentile(data[:, selection], percentile, axis=1) < limit
+    return keep
+
+
+class NetworkRunner:
+    """
+    CPU inference for IVIM networks exported with utilities.ivim.network_export.export_network
+
+    Only numpy and one inference backend are imported: ONNX Runtime when it is installed and an ONNX file was
+    exported, TorchScript otherwise. The pre- and post-processing (normalisation, removal of non-IVIM-like signals
+    and the D/Dp swap) of the package the network was trained with are reproduced, so the results match the
+    eager-mode inference of IVIMNET.deep.predict_IVIM and super_ivim_dc.infer.infer_from_signal.
+    """
+    def __init__(self, path, backend="auto", batch_size=65536, num_threads=None):
+        """
+        Args:
+            path: path of the exported network, with or without extension
+            backend: "auto", "onnx" or "torchscript"
+            batch_size: number of voxels passed to the network at once
+            num_threads: number of CPU threads used by the backend; None leaves the backend default
+        """
+        path = pathlib.Path(path)
+        self.path = path.with_suffix("") if path.suffix in (".json", ".pt", ".onnx") else path
+        with self.path.with_suffix(".json").open() as f:
+            self.metadata = json.load(f)
+        self.bvalues = np.array(self.metadata["bvalues"])
+        self.batch_size = batch_size
+        if backend == "auto":
+            backend = "onnx" if self.path.with_suffix(".onnx").exists() and self._has_onnxruntime() else "torchscript"
+        if backend == "onnx":
+            import onnxruntime
+            options = onnxruntime.SessionOptions()
+            if num_threads is not None:
+                options.intra_op_num_threads = num_threads
+            self._session = onnxruntime.InferenceSession(str(self.path.with_suffix(".onnx")), options, providers=["CPUExecutionProvider"])
+        elif backend == "torchscript":
+            import torch
+            if num_threads is not None:
+                torch.set_num_threads(num_threads)
+            self._module = torch.jit.load(str(self.path.with_suffix(".pt")), map_location="cpu")
+        else:
+            raise ValueError(f"unknown backend {backend}; choose 'auto', 'onnx' or 'torchscript'")
+        self.backend = backend
+
+    @classmethod
+    def from_module(cls, module, metadata, batch_size=65536):
+        """
+        Runner around an in-memory torch module, such as a quantized ExportableIVIMNet
+        Args:
+            module: torch module mapping normalised signals to a (voxels x 4) tensor of D, f, Dp and S0
+            metadata: metadata as written by export_network (see utilities.ivim.network_export.network_metadata)
+            batch_size: number of voxels passed to the network at once
+        """
+        runner = cls.__new__(cls)
+        runner.path = None
+        runner.metadata = metadata
+        runner.bvalues = np.array(metadata["bvalues"])
+        runner.batch_size = batch_size
+        runner._module = module.eval()
+        runner.backend = "torch"
+        return runner
+
+    @staticmethod
+    def _has_onnxruntime():
+        try:
+            import onnxruntime  # noqa: F401
+        except ImportError:
+            return False
+        return True
+
+    def predict_params(self, signals):
+        """
+        Runs the network on normalised signals
+        Args:
+            signals: 2D array of normalised signals (voxels x b-values)
+
+        Returns:
+            params: 2D array (voxels x 4) of the network outputs D, f, Dp and S0
+        """
+        signals = np.ascontiguousarray(signals, dtype=np.float32)
+        params = np.empty((len(signals), 4), dtype=np.float32)
+        for start in range(0, len(signals), self.batch_size):
+            batch = signals[start:start + self.batch_size]
+            if self.backend == "onnx":
+                params[start:start + len(batch)] = self._session.run(None, {"signals": batch})[0]
+            else:
+                import torch
+                with torch.no_grad():
+                    params[start:start + len(batch)] = self._module(torch.from_numpy(batch)).numpy()
+        return params
+
+    def predict(self, signals):
+        """
+        Estimates the IVIM parameters of (unnormalised) signals
+        Args:
+            signals: 2D array of signals (voxels x b-values)
+
+        Returns:
+            results: dictionary with arrays "D", "f", "Dp" and "S0" with a value per voxel; voxels that are not
+                IVIM-like are 0 for IVIM-NET networks and NaN for SUPER-IVIM-DC networks, as in the original packages
+        """
+        signals = np.asarray(signals, dtype=float)
+        if signals.shape[-1] != len(self.bvalues):
+            raise ValueError(f"the signals have {signals.shape[-1]} b-values, the network expects {len(self.bvalues)}")
+        with np.errstate(divide="ignore", invalid="ignore"):
+            data = signals / np.mean(signals[:, self.bvalues == 0], axis=1)[:, None]
+        valid = ~np.isnan(np.mean(data, axis=1))
+        if self.metadata["preprocessing"] == "ivimnet":
+            # IVIMNET.deep.predict_IVIM selects on the 0.95th (not 95th) percentile
+            percentile, fill = 0.95, 0.
+        else:
+            percentile, fill = 95, np.nan
+        limits = [((-np.inf, 50), 1.3), ((50, np.inf), 1.2), ((150, np.inf), 1.0)]
+        valid[valid] = _percentile_mask(data[valid], self.bvalues, percentile, limits)
+
+        D, f, Dp, S0 = self.predict_params(data[valid]).astype(float).T
+        # the network may have swapped D and Dp
+        if len(D) > 0 and np.mean(Dp) < np.mean(D):
+            D, Dp = Dp, D
+            f = 1 - f
+
+        results = {}
+        for name, values in zip(["D", "f", "Dp", "S0"], [D, f, Dp, S0]):
+            results[name] = np.full(len(signals), fill)
+            results[name][valid] = values
+        return results
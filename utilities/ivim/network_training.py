@@ -0,0 +1,379 @@
+import copy
+import hashlib
+import itertools
+import json
+import os
+import pathlib
+import time
+import warnings
+import numpy as np
+import torch
+import IVIMNET.deep as deep
+
+
+def select_ivim_like(X_batch, bvalues, arg):
+    """
+    Removes non-IVIM-like signals from a batch of normalised signals, with the same criteria as deep.learn_IVIM
+    Args:
+        X_batch: 2D tensor of signals (voxels x b-values)
+        bvalues: 1D array of b-values
+        arg: network arguments; nothing is removed if arg.norm_data_full is set
+
+    Returns:
+        X_batch: the IVIM-like signals, clipped at 1.5
+    """
+    if arg.norm_data_full:
+        return X_batch
+    bvalues = torch.as_tensor(bvalues)
+    keep = torch.quantile(X_batch[:, bvalues < 50], 0.95, dim=1) < 1.3
+    keep &= torch.quantile(X_batch[:, bvalues > 50], 0.95, dim=1) < 1.2
+    keep &= torch.quantile(X_batch[:, bvalues > 150], 0.95, dim=1) < 1.0
+    return torch.clamp(X_batch[keep], max=1.5)
+
+
+class ArrayIVIMDataset:
+    """
+    Training data held in memory, prepared and split as deep.learn_IVIM does, with the epoch interface of
+    SimulatedIVIMDataset; every epoch draws up to maxit shuffled batches, seeded from (seed, epoch)
+    """
+    def __init__(self, X_train, bvalues, arg, seed=0):
+        """
+        Args:
+            X_train: 2D array of training signals (voxels x b-values)
+            bvalues: 1D array of b-values
+            arg: network arguments (see IVIM_NEToptim.Arg)
+            seed: seed of the split in training and validation data and of the shuffling
+        """
+        X_train = deep.normalise(X_train, bvalues, arg, min(bvalues))
+        X_train = select_ivim_like(torch.from_numpy(X_train.astype(np.float32)), bvalues, arg)
+        X_train = X_train[~torch.isnan(X_train).any(dim=1)]
+        split = int(np.floor(len(X_train) * arg.train_pars.split))
+        order = torch.randperm(len(X_train), generator=torch.Generator().manual_seed(seed))
+        self.train = X_train[order[:split]]
+        self.validation = X_train[order[split:]]
+        self.batch_size = arg.train_pars.batch_size
+        self.steps_per_epoch = int(min(arg.train_pars.maxit, split // self.batch_size))
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def loader(self, num_workers=0):
+        generator = torch.Generator().manual_seed(int(np.random.SeedSequence([self.seed, self.epoch]).generate_state(1)[0]))
+        loader = torch.utils.data.DataLoader(self.train, batch_size=self.batch_size, shuffle=True, drop_last=True,
+                                             generator=generator, num_workers=num_workers)
+        return itertools.islice(loader, self.steps_per_epoch)
+
+
+def save_checkpoint(path, state):
+    """
+    Writes a training checkpoint atomically, such that a pre-empted job never leaves a partial checkpoint behind
+    """
+    path = pathlib.Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temporary = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    torch.save(state, temporary)
+    os.replace(temporary, path)
+
+
+def load_checkpoint(path, bvalues):
+    """
+    Loads a training checkpoint written by train_IVIM
+    Args:
+        path: path of the checkpoint
+        bvalues: b-values of the network that is trained; the checkpoint must be for the same b-values
+
+    Returns:
+        state: the checkpoint, or None if there is no checkpoint at path
+    """
+    if path is None or not pathlib.Path(path).exists():
+        return None
+    state = torch.load(path, map_location="cpu", weights_only=False)
+    if not np.array_equal(np.asarray(state["bvalues"]), np.asarray(bvalues, dtype=float)):
+        raise ValueError(f"checkpoint {path} was trained for different b-values")
+    return state
+
+
+def uses_training_controls(train_pars):
+    """
+    Whether train_pars set a training budget, checkpointing or telemetry, which only train_IVIM supports and
+    deep.learn_IVIM does not
+    """
+    return (getattr(train_pars, 'max_epochs', 1000) != 1000 or getattr(train_pars, 'max_time', None) is not None
+            or getattr(train_pars, 'checkpoint_path', None) is not None
+            or getattr(train_pars, 'telemetry_path', None) is not None)
+
+
+def train_IVIM(dataset, X_val, bvalues, arg, net=None, num_workers=0):
+    """
+    Trains IVIM-NET as deep.learn_IVIM does, on the batches of a dataset, within the training budgets of
+    arg.train_pars and with checkpointing and telemetry. Supported train_pars, besides those of deep.learn_IVIM:
+        max_epochs: maximum number of epochs (default 1000, as deep.learn_IVIM)
+        max_time: wall-clock budget in seconds of this call; training stops after the running epoch (default None)
+        checkpoint_path: file the training state is written to every checkpoint_every epochs and at the end;
+            an existing checkpoint is resumed from, and one that stopped early is returned without training
+            (default None)
+        checkpoint_every: number of epochs between checkpoints (default 1)
+        telemetry_path: JSON lines file to which a record per epoch is appended (default None)
+    Args:
+        dataset: ArrayIVIMDataset or SimulatedIVIMDataset providing set_epoch(epoch) and loader(num_workers)
+        X_val: 2D tensor of normalised validation signals
+        bvalues: 1D array of b-values
+        arg: network arguments (see IVIM_NEToptim.Arg)
+        net: optional pre-trained network to continue training from
+        num_workers: number of DataLoader worker processes
+
+    Returns:
+        net: the trained network; net.training_log holds the per-epoch telemetry records
+    """
+    arg = deep.checkarg(arg)
+    train_pars = arg.train_pars
+    max_epochs = getattr(train_pars, 'max_epochs', 1000)
+    max_time = getattr(train_pars, 'max_time', None)
+    checkpoint_path = getattr(train_pars, 'checkpoint_path', None)
+    checkpoint_every = getattr(train_pars, 'checkpoint_every', 1)
+    telemetry_path = getattr(train_pars, 'telemetry_path', None)
+    device = train_pars.device
+    start = time.time()
+
+    if net is None:
+        net = deep.Net(torch.FloatTensor(bvalues[:]).to(device), arg.net_pars).to(device)
+    else:
+        net.to(device)
+    if train_pars.loss_fun == 'L1':
+        criterion = torch.nn.L1Loss(reduction='mean').to(device)
+    else:
+        criterion = torch.nn.MSELoss(reduction='mean').to(device)
+    if train_pars.scheduler:
+        optimizer, scheduler = deep.load_optimizer(net, arg)
+    else:
+        optimizer, scheduler = deep.load_optimizer(net, arg), None
+
+    best = 1e16
+    num_bad_epochs = 0
+    prev_lr = 0
+    first_epoch = 0
+    finished = False
+    training_log = []
+    final_model = copy.deepcopy(net.state_dict())
+    state = load_checkpoint(checkpoint_path, bvalues)
+    if state is not None:
+        net.load_state_dict(state["net"])
+        optimizer.load_state_dict(state["optimizer"])
+        if scheduler is not None and state["scheduler"] is not None:
+            scheduler.load_state_dict(state["scheduler"])
+        best, num_bad_epochs, prev_lr = state["best"], state["num_bad_epochs"], state["prev_lr"]
+        final_model, training_log, finished = state["final_model"], state["training_log"], state["finished"]
+        first_epoch = state["epoch"] + 1
+        net.best_loss = best
+
+    def predict(X_batch):
+        X_pred = net(X_batch)[0]
+        # removing nans and too high/low predictions to prevent overshooting
+        X_pred[deep.isnan(X_pred)] = 0
+        return torch.clamp(X_pred, 0, 3)
+
+    def checkpoint(epoch):
+        if checkpoint_path is not None:
+            save_checkpoint(checkpoint_path, {
+                "epoch": epoch, "bvalues": np.asarray(bvalues, dtype=float), "net": net.state_dict(),
+                "optimizer": optimizer.state_dict(), "scheduler": None if scheduler is None else scheduler.state_dict(),
+                "best": best, "num_bad_epochs": num_bad_epochs, "prev_lr": prev_lr, "final_model": final_model,
+                "training_log": training_log, "finished": finished})
+
+    val_batches = torch.split(X_val, 32 * train_pars.batch_size)
+    epoch = first_epoch - 1
+    out_of_time = False
+    for epoch in range(first_epoch, first_epoch if finished else max_epochs):
+        epoch_start = time.time()
+        dataset.set_epoch(epoch)
+        net.train()
+        running_loss_train = 0.
+        train_batches = 0
+        samples = 0
+        for X_batch in dataset.loader(num_workers=num_workers):
+            X_batch = select_ivim_like(X_batch, bvalues, arg).to(device)
+            if len(X_batch) < 2:
+                continue
+            optimizer.zero_grad()
+            loss = criterion(predict(X_batch), X_batch)
+            loss.backward()
+            optimizer.step()
+            running_loss_train += loss.item()
+            train_batches += 1
+            samples += len(X_batch)
+            if max_time is not None and time.time() - start > max_time:
+                out_of_time = True
+                break
+        net.eval()
+        running_loss_val = 0.
+        with torch.no_grad():
+            for X_batch in val_batches:
+                X_batch = X_batch.to(device)
+                running_loss_val += criterion(predict(X_batch), X_batch).item() * len(X_batch)
+        running_loss_val = running_loss_val / len(X_val)
+        running_loss_train = running_loss_train / max(train_batches, 1)
+        if scheduler is not None:
+            scheduler.step(running_loss_val)
+            if optimizer.param_groups[0]['lr'] < prev_lr:
+                net.load_state_dict(final_model)
+            prev_lr = optimizer.param_groups[0]['lr']
+        # early stopping criteria
+        if running_loss_val < best:
+            final_model = copy.deepcopy(net.state_dict())
+            best = running_loss_val
+            net.best_loss = running_loss_val
+            num_bad_epochs = 0
+        else:
+            num_bad_epochs = num_bad_epochs + 1
+            finished = num_bad_epochs == train_pars.patience
+        seconds = time.time() - epoch_start
+        record = {"epoch": epoch, "train_loss": running_loss_train, "val_loss": running_loss_val, "best_val_loss": best,
+                  "bad_epochs": num_bad_epochs, "lr": optimizer.param_groups[0]['lr'], "samples": samples,
+                  "seconds": seconds, "samples_per_second": samples / seconds if seconds > 0 else 0.,
+                  "elapsed": time.time() - start}
+        training_log.append(record)
+        if telemetry_path is not None:
+            pathlib.Path(telemetry_path).parent.mkdir(parents=True, exist_ok=True)
+            with open(telemetry_path, "a") as f:
+                f.write(json.dumps(record) + "\n")
+        if finished or out_of_time or epoch == max_epochs - 1 or (epoch + 1 - first_epoch) % checkpoint_every == 0:
+            checkpoint(epoch)
+        if finished or out_of_time:
+            break
+    if out_of_time and not finished:
+        warnings.warn(f"training stopped after the time budget of {max_time} s at epoch {epoch}"
+                      + ("" if checkpoint_path is None else f"; resume from {checkpoint_path}"), UserWarning)
+    if train_pars.select_best:
+        net.load_state_dict(final_model)
+    net.training_log = training_log
+    return net
+
+
+def learn_IVIM_streaming(dataset, bvalues, arg, net=None, num_workers=0, validation_size=None):
+    """
+    Trains IVIM-NET on batches streamed from a SimulatedIVIMDataset instead of on a training array (see train_IVIM)
+    Args:
+        dataset: SimulatedIVIMDataset yielding batches of normalised training signals; one pass over the dataset is
+            one epoch
+        bvalues: 1D array of b-values
+        arg: network arguments (see IVIM_NEToptim.Arg)
+        net: optional pre-trained network to continue training from
+        num_workers: number of DataLoader worker processes simulating batches in parallel with training
+        validation_size: number of voxels in the fixed validation set; defaults to 32 batches
+
+    Returns:
+        net: the trained network
+    """
+    arg = deep.checkarg(arg)
+    if validation_size is None:
+        validation_size = 32 * arg.train_pars.batch_size
+    X_val = select_ivim_like(torch.from_numpy(dataset.validation_data(validation_size)), bvalues, arg)
+    return train_IVIM(dataset, X_val, bvalues, arg, net=net, num_workers=num_workers)
+
+
+def learn_IVIM_array(X_train, bvalues, arg, net=None, num_workers=0, seed=0):
+    """
+    Trains IVIM-NET on a training array, as deep.learn_IVIM does but within budgets and with checkpoints (see
+    train_IVIM)
+    Args:
+        X_train: 2D array of training signals (voxels x b-values)
+        bvalues: 1D array of b-values
+        arg: network arguments (see IVIM_NEToptim.Arg)
+        net: optional pre-trained network to continue training from
+        num_workers: number of DataLoader worker processes
+        seed: seed of the split in training and validation data and of the shuffling
+
+    Returns:
+        net: the trained network
+    """
+    arg = deep.checkarg(arg)
+    dataset = ArrayIVIMDataset(X_train, bvalues, arg, seed=seed)
+    return train_IVIM(dataset, dataset.validation, bvalues, arg, net=net, num_workers=num_workers)
+
+
+def volume_hash(signals):
+    """
+    Content hash of a volume (or any array) of signals, used to cache results per input volume
+    """
+    signals = np.ascontiguousarray(signals, dtype=float)
+    digest = hashlib.sha256(str(signals.shape).encode())
+    digest.update(signals.tobytes())
+    return digest.hexdigest()
+
+
+def network_hash(net):
+    """
+    Content hash of the weights of a network
+    """
+    digest = hashlib.sha256()
+    for name, tensor in net.state_dict().items():
+        digest.update(name.encode())
+        digest.update(tensor.detach().cpu().numpy().tobytes())
+    return digest.hexdigest()
+
+
+def stratified_subsample(signals, bvalues, n, strata=5, seed=0):
+    """
+    Draws a subsample of the foreground voxels of a volume, stratified by b=0 intensity and signal decay, such that
+    bright and dark tissue and fast and slow decaying signals are represented as in the full volume
+    Args:
+        signals: 2D array of (unnormalised) signals (voxels x b-values)
+        bvalues: 1D array of b-values
+        n: number of voxels to draw; all foreground voxels are returned if there are fewer
+        strata: number of quantile bins of both the b=0 intensity and the decay
+        seed: seed of the draw
+
+    Returns:
+        indices: sorted indices of the drawn voxels
+    """
+    bvalues = np.asarray(bvalues)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        b0 = np.mean(signals[:, bvalues == np.min(bvalues)], axis=1)
+        decay = np.mean(signals[:, bvalues == np.max(bvalues)], axis=1) / b0
+    # background voxels have a b=0 signal close to the noise floor
+    foreground = np.isfinite(signals).all(axis=1) & np.isfinite(decay) & (b0 > 0.1 * np.percentile(b0[np.isfinite(b0)], 99))
+    indices = np.flatnonzero(foreground)
+    if len(indices) <= n:
+        return indices
+    edges = np.linspace(0, 1, strata + 1)[1:-1]
+    stratum = (np.digitize(b0[indices], np.quantile(b0[indices], edges)) * strata
+               + np.digitize(decay[indices], np.quantile(decay[indices], edges)))
+    rng = np.random.default_rng(seed)
+    sample = []
+    for label in np.unique(stratum):
+        members = indices[stratum == label]
+        # proportional allocation, keeping at least one voxel of every stratum
+        size = max(1, int(round(n * len(members) / len(indices))))
+        sample.append(rng.choice(members, size=min(size, len(members)), replace=False))
+    return np.sort(np.concatenate(sample))
+
+
+def finetune_IVIM(net, signals, bvalues, arg, voxels=20000, max_epochs=10, patience=2, maxit=100, seed=0):
+    """
+    Fine-tunes a trained IVIM-NET on a stratified subsample of the foreground voxels of a volume (see
+    stratified_subsample), for a bounded number of epochs with early stopping; the best network is returned
+    Args:
+        net: trained network; it is not modified
+        signals: 2D array of (unnormalised) signals (voxels x b-values)
+        bvalues: 1D array of b-values
+        arg: network arguments (see IVIM_NEToptim.Arg)
+        voxels: number of voxels to fine-tune on
+        max_epochs: maximum number of epochs
+        patience: number of epochs without improvement of the validation loss after which fine-tuning stops
+        maxit: maximum number of batches per epoch
+        seed: seed of the subsample, split and shuffling
+
+    Returns:
+        net: the fine-tuned copy of the network
+    """
+    arg = copy.deepcopy(deep.checkarg(arg))
+    arg.train_pars.max_epochs = max_epochs
+    arg.train_pars.patience = patience
+    arg.train_pars.maxit = maxit
+    arg.train_pars.select_best = True
+    arg.train_pars.max_time = None
+    arg.train_pars.checkpoint_path = None
+    sample = signals[stratified_subsample(signals, bvalues, voxels, seed=seed)]
+    return learn_IVIM_array(sample, bvalues, arg, net=copy.deepcopy(net), seed=seed)